@@ -0,0 +1,670 @@
+#!/usr/bin/env python3
+"""
+SmolLM2 API Benchmark / Load Test
+
+Drives /v1/chat/completions and /v1/messages at a fixed concurrency with
+randomised prompt and response lengths, and reports p50/p95/p99 latency,
+time-to-first-token and tokens/sec. Results are written as JSON so runs
+can be compared across commits. Uses only the standard library and runs
+fully offline.
+
+Usage:
+    # Real server with a tiny local GGUF (needs the `gguf` package to build it)
+    python benchmark.py --make-tiny-model model/tiny.gguf
+    python benchmark.py --target main --model model/tiny.gguf
+
+    # Mock server: pure framework overhead, no model
+    python benchmark.py --target mock
+
+    # Already running server
+    python benchmark.py --url http://localhost:8000
+
+    # Compare two result files
+    python benchmark.py --compare benchmark_results/main-abc123.json benchmark_results/main-def456.json
+
+    # Per-request framework overhead, in process: mock vs main with stock and fast JSON paths
+    python benchmark.py --overhead --model model/tiny.gguf
+
+    # /v1/embeddings throughput in inputs/sec, float vs base64, per inputs-per-request
+    python benchmark.py --embeddings --model model/tiny.gguf --embedding-batch 1,16,64
+
+    # Several sampled choices per OpenAI request (n), sharing one prompt evaluation
+    python benchmark.py --target main --model model/tiny.gguf --api openai --choices 4
+"""
+
+import argparse
+import asyncio
+import http.client
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlparse
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+ENDPOINTS = {
+    "openai": "/v1/chat/completions",
+    "anthropic": "/v1/messages",
+}
+WORDS = (
+    "the quick brown fox jumps over a lazy dog while the model explains "
+    "how attention layers read tokens and write answers for every user"
+).split()
+
+# ============================================================================
+# SERVER MANAGEMENT
+# ============================================================================
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_server(target: str, model_path: Optional[str], env_overrides: Dict[str, str], timeout: float):
+    """Launch src/main.py or src/mock_main.py under uvicorn and wait until it serves /health."""
+    port = free_port()
+    env = dict(os.environ, **env_overrides)
+    if target == "main":
+        if not model_path:
+            sys.exit("--target main needs --model PATH (see --make-tiny-model)")
+        env["MODEL_PATH"] = os.path.abspath(model_path)
+    module = "main:app" if target == "main" else "mock_main:app"
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", module, "--app-dir", os.path.join(ROOT, "src"),
+         "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            sys.exit(f"{target} server exited with code {process.returncode}")
+        try:
+            status, body = request_json(url, "GET", "/health")
+            if status == 200 and body.get("model_loaded", True):
+                return process, url
+        except OSError:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    sys.exit(f"{target} server did not become ready within {timeout:.0f}s")
+
+def stop_server(process: subprocess.Popen):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+# ============================================================================
+# HTTP CLIENT
+# ============================================================================
+
+def connect(url: str) -> http.client.HTTPConnection:
+    parsed = urlparse(url)
+    if parsed.scheme == "https":
+        return http.client.HTTPSConnection(parsed.hostname, parsed.port or 443, timeout=300)
+    return http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=300)
+
+def request_json(url: str, method: str, path: str, payload: Optional[Dict[str, Any]] = None):
+    conn = connect(url)
+    try:
+        body = json.dumps(payload) if payload is not None else None
+        conn.request(method, path, body=body, headers={"Content-Type": "application/json"})
+        response = conn.getresponse()
+        data = response.read()
+        return response.status, json.loads(data) if data else {}
+    finally:
+        conn.close()
+
+def build_payload(api: str, prompt_words: int, max_tokens: int, temperature: float,
+                  stream: bool, rng: random.Random, choices: int = 1) -> Dict[str, Any]:
+    content = " ".join(rng.choice(WORDS) for _ in range(prompt_words))
+    payload = {
+        "messages": [{"role": "user", "content": content}],
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+    }
+    if stream:
+        payload["stream"] = True
+    if choices > 1 and api == "openai":
+        payload["n"] = choices
+    if api == "anthropic":
+        payload["model"] = "claude-3-haiku-20240307"
+    return payload
+
+def run_request(url: str, api: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Send one request and time it. TTFT is the first content-bearing event for streams."""
+    conn = connect(url)
+    started = time.perf_counter()
+    first_token = None
+    completion_tokens = 0
+    try:
+        conn.request("POST", ENDPOINTS[api], body=json.dumps(payload),
+                     headers={"Content-Type": "application/json"})
+        response = conn.getresponse()
+        if response.status != 200:
+            response.read()
+            return {"ok": False, "status": response.status, "latency": time.perf_counter() - started}
+
+        if response.getheader("Content-Type", "").startswith("text/event-stream"):
+            chunks = 0
+            while True:
+                line = response.readline()
+                if not line:
+                    break
+                if not line.startswith(b"data: ") or line.strip() == b"data: [DONE]":
+                    continue
+                event = json.loads(line[6:])
+                if api == "openai":
+                    if event.get("choices") and event["choices"][0]["delta"].get("content"):
+                        chunks += 1
+                        first_token = first_token or time.perf_counter()
+                elif event.get("type") == "content_block_delta":
+                    chunks += 1
+                    first_token = first_token or time.perf_counter()
+                elif event.get("type") == "message_delta":
+                    completion_tokens = event["usage"]["output_tokens"]
+            # OpenAI chunks carry no usage; one chunk is roughly one token
+            completion_tokens = completion_tokens or chunks
+        else:
+            body = json.loads(response.read())
+            usage = body.get("usage", {})
+            completion_tokens = usage.get("completion_tokens", usage.get("output_tokens", 0))
+    except (OSError, http.client.HTTPException, ValueError) as e:
+        return {"ok": False, "error": f"{type(e).__name__}: {e}", "latency": time.perf_counter() - started}
+    finally:
+        conn.close()
+
+    finished = time.perf_counter()
+    return {
+        "ok": True,
+        "latency": finished - started,
+        "ttft": (first_token or finished) - started,
+        "completion_tokens": completion_tokens,
+    }
+
+# ============================================================================
+# LOAD GENERATION AND REPORTING
+# ============================================================================
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def pick(q: float) -> float:
+        return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+    return {
+        "mean": round(statistics.fmean(ordered) * 1000, 3),
+        "p50": round(pick(0.50) * 1000, 3),
+        "p95": round(pick(0.95) * 1000, 3),
+        "p99": round(pick(0.99) * 1000, 3),
+        "max": round(ordered[-1] * 1000, 3),
+    }
+
+def run_load(url: str, api: str, args: argparse.Namespace) -> Dict[str, Any]:
+    """Issue args.requests requests with args.concurrency in flight and summarise them."""
+    rng = random.Random(args.seed)
+    payloads = [
+        build_payload(api, rng.choice(args.prompt_words), rng.choice(args.max_tokens),
+                      args.temperature, args.stream, rng, args.choices)
+        for _ in range(args.requests + args.warmup)
+    ]
+    for payload in payloads[:args.warmup]:
+        run_request(url, api, payload)
+
+    results: List[Dict[str, Any]] = []
+    lock = threading.Lock()
+
+    def worker(payload):
+        result = run_request(url, api, payload)
+        with lock:
+            results.append(result)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(worker, payloads[args.warmup:]))
+    wall = time.perf_counter() - started
+
+    ok = [r for r in results if r["ok"]]
+    errors = [r for r in results if not r["ok"]]
+    total_tokens = sum(r["completion_tokens"] for r in ok)
+    per_request_tps = [
+        r["completion_tokens"] / (r["latency"] - r["ttft"])
+        for r in ok if r["completion_tokens"] > 1 and r["latency"] > r["ttft"]
+    ]
+    return {
+        "requests": len(results),
+        "errors": len(errors),
+        "error_samples": sorted({r.get("error") or f"HTTP {r.get('status')}" for r in errors})[:5],
+        "wall_seconds": round(wall, 3),
+        "requests_per_second": round(len(ok) / wall, 3) if wall else 0.0,
+        "latency_ms": percentiles([r["latency"] for r in ok]),
+        "ttft_ms": percentiles([r["ttft"] for r in ok]),
+        "completion_tokens": total_tokens,
+        "tokens_per_second": round(total_tokens / wall, 2) if wall else 0.0,
+        "decode_tokens_per_second_p50": round(statistics.median(per_request_tps), 2) if per_request_tps else None,
+    }
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_summary(name: str, summary: Dict[str, Any]):
+    latency, ttft = summary["latency_ms"], summary["ttft_ms"]
+    print(f"  {name:<10} {summary['requests']:>5} req  {summary['errors']:>3} err  "
+          f"{summary['requests_per_second']:>8.2f} req/s  {summary['tokens_per_second']:>9.2f} tok/s")
+    if latency:
+        print(f"  {'':<10} latency p50/p95/p99 {latency['p50']:.1f}/{latency['p95']:.1f}/{latency['p99']:.1f} ms  "
+              f"ttft p50/p95/p99 {ttft['p50']:.1f}/{ttft['p95']:.1f}/{ttft['p99']:.1f} ms")
+
+def compare(old_path: str, new_path: str):
+    """Print the relative change of the headline numbers between two result files."""
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"{old['meta'].get('commit')} -> {new['meta'].get('commit')}")
+    for api in sorted(set(old["results"]) & set(new["results"])):
+        before, after = old["results"][api], new["results"][api]
+        print(f"  {api}")
+        rows = [("tokens_per_second", before["tokens_per_second"], after["tokens_per_second"])]
+        for field in ("latency_ms", "ttft_ms"):
+            for q in ("p50", "p95", "p99"):
+                if q in before[field] and q in after[field]:
+                    rows.append((f"{field}.{q}", before[field][q], after[field][q]))
+        for label, a, b in rows:
+            change = f"{(b - a) / a * 100:+.1f}%" if a else "n/a"
+            print(f"    {label:<22} {a:>10.2f} -> {b:>10.2f}  {change}")
+
+# ============================================================================
+# EMBEDDINGS
+# ============================================================================
+
+def run_embedding_request(url: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+    conn = connect(url)
+    started = time.perf_counter()
+    try:
+        conn.request("POST", "/v1/embeddings", body=json.dumps(payload), headers={"Content-Type": "application/json"})
+        response = conn.getresponse()
+        data = response.read()
+        if response.status != 200:
+            return {"ok": False, "status": response.status, "latency": time.perf_counter() - started}
+        body = json.loads(data)
+    except (OSError, http.client.HTTPException, ValueError) as e:
+        return {"ok": False, "error": f"{type(e).__name__}: {e}", "latency": time.perf_counter() - started}
+    finally:
+        conn.close()
+    return {
+        "ok": True,
+        "latency": time.perf_counter() - started,
+        "inputs": len(body["data"]),
+        "tokens": body["usage"]["prompt_tokens"],
+        "bytes": len(data),
+    }
+
+def run_embeddings(url: str, args: argparse.Namespace) -> Dict[str, Any]:
+    """Embedding throughput for each --embedding-batch size, with float and base64 responses."""
+    results = {}
+    for batch_size in args.embedding_batch:
+        for encoding in ("float", "base64"):
+            rng = random.Random(args.seed)
+            payloads = [
+                {
+                    "input": [" ".join(rng.choice(WORDS) for _ in range(rng.choice(args.prompt_words)))
+                              for _ in range(batch_size)],
+                    "encoding_format": encoding,
+                }
+                for _ in range(args.requests + args.warmup)
+            ]
+            for payload in payloads[:args.warmup]:
+                run_embedding_request(url, payload)
+            
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+                outcomes = list(pool.map(lambda payload: run_embedding_request(url, payload), payloads[args.warmup:]))
+            wall = time.perf_counter() - started
+            
+            ok = [r for r in outcomes if r["ok"]]
+            inputs = sum(r["inputs"] for r in ok)
+            summary = {
+                "requests": len(outcomes),
+                "errors": len(outcomes) - len(ok),
+                "wall_seconds": round(wall, 3),
+                "inputs_per_second": round(inputs / wall, 2) if wall else 0.0,
+                "tokens_per_second": round(sum(r["tokens"] for r in ok) / wall, 2) if wall else 0.0,
+                "latency_ms": percentiles([r["latency"] for r in ok]),
+                "response_bytes_per_input": round(sum(r["bytes"] for r in ok) / inputs) if inputs else None,
+            }
+            results[f"{encoding}-{batch_size}"] = summary
+            latency = summary["latency_ms"]
+            print(f"  {encoding:<7} {batch_size:>4} inputs/request  {summary['errors']:>3} err  "
+                  f"{summary['inputs_per_second']:>9.2f} inputs/s  {summary['tokens_per_second']:>10.2f} tok/s  "
+                  f"p50 {latency.get('p50', 0):.1f} ms  {summary['response_bytes_per_input']} B/input")
+    return results
+
+# ============================================================================
+# FRAMEWORK OVERHEAD
+# ============================================================================
+
+# Server configurations timed by --overhead: (name, target, environment)
+OVERHEAD_VARIANTS = [
+    ("mock", "mock", {}),
+    ("main-stock", "main", {"FAST_JSON": "0"}),
+    ("main-fast", "main", {"FAST_JSON": "1"}),
+    ("main-traced", "main", {"FAST_JSON": "1", "TRACE_LOG": os.devnull}),
+]
+
+async def asgi_post(app, path: str, body: bytes):
+    """Call an ASGI app directly, without sockets; returns (status, response body)."""
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+        "method": "POST" if body else "GET", "scheme": "http",
+        "path": path, "raw_path": path.encode(), "query_string": b"", "root_path": "",
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        "client": ("127.0.0.1", 50000), "server": ("127.0.0.1", 8000),
+    }
+    received = False
+    status = 0
+    chunks = []
+
+    async def receive():
+        nonlocal received
+        if not received:
+            received = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await asyncio.sleep(3600)
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body":
+            chunks.append(message.get("body", b""))
+
+    await app(scope, receive, send)
+    return status, b"".join(chunks)
+
+def overhead_payload(api: str, messages: int) -> bytes:
+    """A deterministic multi-turn request, so main answers it from its response cache."""
+    rng = random.Random(0)
+    turns = [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": " ".join(rng.choice(WORDS) for _ in range(12))}
+        for i in range(messages - 1 | 1)
+    ]
+    payload = build_payload(api, 8, 16, 0.0, False, rng)
+    payload["messages"] = turns + payload["messages"]
+    return json.dumps(payload).encode()
+
+async def measure_overhead(target: str, iterations: int, messages: int) -> Dict[str, Any]:
+    """Time requests through the app in this process. main must answer from its response cache."""
+    sys.path.insert(0, os.path.join(ROOT, "src"))
+    module = __import__("main" if target == "main" else "mock_main")
+    app = module.app
+    results = {}
+    async with app.router.lifespan_context(app):
+        if target == "main":
+            while (await asgi_post(app, "/health", b""))[0] != 200:
+                await asyncio.sleep(0.1)
+        for api, path in ENDPOINTS.items():
+            body = overhead_payload(api, messages)
+            # Warms the response cache and any lazily built state
+            for _ in range(10):
+                status, _ = await asgi_post(app, path, body)
+                if status != 200:
+                    raise RuntimeError(f"{target} {path} answered HTTP {status}")
+            timings = []
+            for _ in range(iterations):
+                started = time.perf_counter()
+                await asgi_post(app, path, body)
+                timings.append(time.perf_counter() - started)
+            # percentiles() reports milliseconds; overhead reads better in microseconds
+            results[api] = {q: round(value * 1000, 1) for q, value in percentiles(timings).items()}
+            # Mean of the quietest 100 consecutive requests, the least disturbed by the machine
+            blocks = [statistics.fmean(timings[i:i + 100]) for i in range(0, len(timings) - 99, 100)]
+            results[api]["best"] = round(min(blocks or [statistics.fmean(timings)]) * 1e6, 1)
+    return results
+
+def run_overhead(args: argparse.Namespace) -> Dict[str, Any]:
+    """
+    Run every OVERHEAD_VARIANTS entry in its own interpreter, args.overhead_rounds
+    times in alternation, and compare the variants by their quietest stretch
+    of requests so that noise from the machine does not decide the result.
+    """
+    if not args.model:
+        sys.exit("--overhead needs --model PATH for the main variants (see --make-tiny-model)")
+    results: Dict[str, Dict[str, Any]] = {name: {} for name, _, _ in OVERHEAD_VARIANTS}
+    for _ in range(args.overhead_rounds):
+        for name, target, env_overrides in OVERHEAD_VARIANTS:
+            env = dict(os.environ, MODEL_PATH=os.path.abspath(args.model), RESPONSE_CACHE="memory", **env_overrides)
+            env.update(item.split("=", 1) for item in args.env)
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--overhead-worker", target,
+                 "--requests", str(args.requests), "--overhead-messages", str(args.overhead_messages)],
+                env=env, cwd=ROOT, check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True,
+            ).stdout
+            # The server logs to stdout too; the measurement is the last line
+            for api, timing in json.loads(output.strip().splitlines()[-1]).items():
+                best = results[name].get(api)
+                if best is None or timing["best"] < best["best"]:
+                    results[name][api] = timing
+
+    print(f"Per-request overhead in microseconds, best of {args.overhead_rounds} rounds of "
+          f"{args.requests} sequential requests with {args.overhead_messages} messages")
+    for api in ENDPOINTS:
+        print(f"  {api}")
+        stock = results["main-stock"][api]["best"]
+        for name, _, _ in OVERHEAD_VARIANTS:
+            timing = results[name][api]
+            change = f"{(timing['best'] - stock) / stock * 100:+.1f}% vs main-stock" if name != "main-stock" else ""
+            print(f"    {name:<12} best {timing['best']:>8.1f}  p50 {timing['p50']:>8.1f}  p95 {timing['p95']:>8.1f}  {change}")
+    return results
+
+# ============================================================================
+# TINY MODEL
+# ============================================================================
+
+def make_tiny_model(path: str):
+    """
+    Write a randomly initialised two-layer llama GGUF with a ChatML-aware vocab.
+
+    Output is gibberish but exercises the whole inference path in milliseconds,
+    which makes the harness usable in CI without downloading a model.
+    """
+    try:
+        import numpy as np
+        import gguf
+    except ImportError:
+        sys.exit("--make-tiny-model needs numpy and the gguf package (pip install gguf)")
+
+    rng = np.random.default_rng(0)
+    tokens = ["<unk>", "<s>", "</s>", "<|im_start|>", "<|im_end|>"]
+    types = [gguf.TokenType.UNKNOWN] + [gguf.TokenType.CONTROL] * 4
+    for byte in range(256):
+        tokens.append(f"<0x{byte:02X}>")
+        types.append(gguf.TokenType.BYTE)
+    words = ["▁" + word for word in sorted(set(WORDS))] + list("etaoinshr") + ["▁"]
+    tokens.extend(words)
+    types.extend([gguf.TokenType.NORMAL] * len(words))
+    scores = [0.0] * (len(tokens) - len(words)) + [-float(i) for i in range(len(words))]
+
+    n_vocab, n_embd, n_layer, n_head, n_head_kv, n_ff = len(tokens), 64, 2, 4, 2, 128
+    head_dim = n_embd // n_head
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    writer = gguf.GGUFWriter(path, "llama")
+    writer.add_name("tiny-benchmark")
+    writer.add_vocab_size(n_vocab)
+    writer.add_context_length(4096)
+    writer.add_embedding_length(n_embd)
+    writer.add_block_count(n_layer)
+    writer.add_feed_forward_length(n_ff)
+    writer.add_head_count(n_head)
+    writer.add_head_count_kv(n_head_kv)
+    writer.add_layer_norm_rms_eps(1e-5)
+    writer.add_rope_dimension_count(head_dim)
+    writer.add_file_type(gguf.LlamaFileType.ALL_F32)
+    writer.add_tokenizer_model("llama")
+    writer.add_token_list(tokens)
+    writer.add_token_scores(scores)
+    writer.add_token_types(types)
+    writer.add_bos_token_id(1)
+    writer.add_eos_token_id(4)
+    writer.add_add_bos_token(True)
+
+    def weight(name, shape):
+        writer.add_tensor(name, (rng.standard_normal(shape) * 0.2).astype(np.float32))
+
+    weight("token_embd.weight", (n_vocab, n_embd))
+    writer.add_tensor("output_norm.weight", np.ones(n_embd, np.float32))
+    weight("output.weight", (n_vocab, n_embd))
+    for i in range(n_layer):
+        writer.add_tensor(f"blk.{i}.attn_norm.weight", np.ones(n_embd, np.float32))
+        weight(f"blk.{i}.attn_q.weight", (n_embd, n_embd))
+        weight(f"blk.{i}.attn_k.weight", (n_head_kv * head_dim, n_embd))
+        weight(f"blk.{i}.attn_v.weight", (n_head_kv * head_dim, n_embd))
+        weight(f"blk.{i}.attn_output.weight", (n_embd, n_embd))
+        writer.add_tensor(f"blk.{i}.ffn_norm.weight", np.ones(n_embd, np.float32))
+        weight(f"blk.{i}.ffn_gate.weight", (n_ff, n_embd))
+        weight(f"blk.{i}.ffn_down.weight", (n_embd, n_ff))
+        weight(f"blk.{i}.ffn_up.weight", (n_ff, n_embd))
+    writer.write_header_to_file()
+    writer.write_kv_data_to_file()
+    writer.write_tensors_to_file()
+    writer.close()
+    print(f"Wrote {path} ({n_vocab} tokens)")
+
+# ============================================================================
+# ENTRY POINT
+# ============================================================================
+
+def int_list(value: str) -> List[int]:
+    return [int(item) for item in value.split(",") if item]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the SmolLM2 API")
+    parser.add_argument("--target", choices=["main", "mock"], default="main",
+                        help="Server to launch (ignored with --url)")
+    parser.add_argument("--url", help="Benchmark an already running server instead")
+    parser.add_argument("--model", help="GGUF to load for --target main")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="Extra environment for the launched server (repeatable)")
+    parser.add_argument("--api", choices=["openai", "anthropic", "both"], default="both")
+    parser.add_argument("--requests", type=int, default=50, help="Measured requests per API")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--prompt-words", type=int_list, default=[16, 64, 256],
+                        help="Comma-separated prompt lengths in words, picked at random")
+    parser.add_argument("--max-tokens", type=int_list, default=[16, 64, 128],
+                        help="Comma-separated max_tokens values, picked at random")
+    parser.add_argument("--temperature", type=float, default=0.7)
+    parser.add_argument("--stream", action="store_true", help="Request SSE streams (measures real TTFT)")
+    parser.add_argument("--choices", type=int, default=1, help="Choices per OpenAI request (n)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--startup-timeout", type=float, default=300.0)
+    parser.add_argument("--output", help="Result file (default: benchmark_results/<target>-<commit>.json)")
+    parser.add_argument("--make-tiny-model", metavar="PATH", help="Write a tiny random GGUF and exit")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two result files and exit")
+    parser.add_argument("--overhead", action="store_true",
+                        help="Time per-request framework overhead in process (mock vs main) and exit")
+    parser.add_argument("--overhead-messages", type=int, default=8, help="Messages per --overhead request")
+    parser.add_argument("--overhead-rounds", type=int, default=5, help="Alternating runs per --overhead variant")
+    parser.add_argument("--overhead-worker", choices=["main", "mock"], help=argparse.SUPPRESS)
+    parser.add_argument("--embeddings", action="store_true", help="Benchmark /v1/embeddings instead of generation")
+    parser.add_argument("--embedding-batch", type=int_list, default=[1, 16, 64],
+                        help="Comma-separated inputs per embeddings request, one run each")
+    args = parser.parse_args()
+
+    if args.overhead_worker:
+        print(json.dumps(asyncio.run(measure_overhead(args.overhead_worker, args.requests, args.overhead_messages))))
+        return
+
+    if args.make_tiny_model:
+        make_tiny_model(args.make_tiny_model)
+        return
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.overhead:
+        report = {"meta": {"target": "overhead", "commit": git_commit(), "timestamp": int(time.time()),
+                           "python": sys.version.split()[0], "config": {"requests": args.requests,
+                           "messages": args.overhead_messages, "rounds": args.overhead_rounds,
+                           "env": args.env}},
+                  "results": run_overhead(args)}
+        output = args.output or os.path.join(ROOT, "benchmark_results", f"overhead-{report['meta']['commit'] or 'unknown'}.json")
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {output}")
+        return
+
+    process = None
+    target = "url" if args.url else args.target
+    if args.url:
+        url = args.url.rstrip("/")
+    else:
+        env = dict(item.split("=", 1) for item in args.env)
+        process, url = start_server(args.target, args.model, env, args.startup_timeout)
+
+    try:
+        apis = list(ENDPOINTS) if args.api == "both" else [args.api]
+        print(f"Benchmarking {target} at {url}: {args.requests} requests x {args.concurrency} concurrent")
+        results = {}
+        if args.embeddings:
+            results["embeddings"] = run_embeddings(url, args)
+        else:
+            for api in apis:
+                results[api] = run_load(url, api, args)
+                print_summary(api, results[api])
+    finally:
+        if process is not None:
+            stop_server(process)
+
+    commit = git_commit()
+    report = {
+        "meta": {
+            "target": target,
+            "url": args.url,
+            "model": os.path.basename(args.model) if args.model and not args.url else None,
+            "commit": commit,
+            "timestamp": int(time.time()),
+            "python": sys.version.split()[0],
+            "config": {
+                "requests": args.requests,
+                "concurrency": args.concurrency,
+                "warmup": args.warmup,
+                "prompt_words": args.prompt_words,
+                "max_tokens": args.max_tokens,
+                "temperature": args.temperature,
+                "stream": args.stream,
+                "choices": args.choices,
+                "seed": args.seed,
+                "embedding_batch": args.embedding_batch if args.embeddings else None,
+                "env": args.env,
+            },
+        },
+        "results": results,
+    }
+    name = f"{target}-embeddings" if args.embeddings else target
+    output = args.output or os.path.join(ROOT, "benchmark_results", f"{name}-{commit or 'unknown'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+if __name__ == "__main__":
+    main()
@@ -3,238 +3,5635 @@ SmolLM2-135M-Instruct API with Full OpenAI and Anthropic Compatibility
 Enhanced version with improved multi-turn dialogue, reasoning, and proper model mapping.
 """
 
+import abc
+import asyncio
+import base64
+import bisect
+import codecs
+import concurrent.futures
+import contextlib
+import ctypes
+import hashlib
+import hmac
+import json
+import logging
+import math
+import mmap
+import multiprocessing
 import os
+import queue
+import random
+import struct
+import sys
+import threading
 import time
+import traceback
+import urllib.request
 import uuid
 from contextlib import asynccontextmanager
-from typing import List, Optional, Dict, Any
+from collections import OrderedDict, deque
+from typing import Callable, List, Literal, Optional, Dict, Any, Tuple, Union
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from fastapi.routing import APIRoute
+from pydantic import BaseModel, Field, ValidationError, model_validator
+import numpy as np
+import llama_cpp
 from llama_cpp import Llama
+from llama_cpp.llama_grammar import JSON_GBNF, json_schema_to_gbnf
+
+try:
+    import orjson
+except ImportError:  # Optional: the stdlib json module is used instead
+    orjson = None
 
 # ============================================================================
 # CONFIGURATION
 # ============================================================================
 
-MODEL_PATH = os.environ.get("MODEL_PATH", "model/SmolLM2-135M-Instruct-Q4_K_M.gguf")
-CONTEXT_SIZE = int(os.environ.get("CONTEXT_SIZE", 2048))
-MAX_TOKENS_DEFAULT = int(os.environ.get("MAX_TOKENS_DEFAULT", 512))
-TEMPERATURE_DEFAULT = float(os.environ.get("TEMPERATURE_DEFAULT", 0.7))
+MODEL_PATH = os.environ.get("MODEL_PATH", "model/SmolLM2-135M-Instruct-Q4_K_M.gguf")
+CONTEXT_SIZE = int(os.environ.get("CONTEXT_SIZE", 2048))
+MAX_TOKENS_DEFAULT = int(os.environ.get("MAX_TOKENS_DEFAULT", 512))
+TEMPERATURE_DEFAULT = float(os.environ.get("TEMPERATURE_DEFAULT", 0.7))
+# Upper bound for a request's n and best_of (sequences sampled from one prompt evaluation)
+MAX_CHOICES = int(os.environ.get("MAX_CHOICES", 8))
+# Compiled response_format grammars kept per model (LRU by schema hash)
+GRAMMAR_CACHE_SIZE = int(os.environ.get("GRAMMAR_CACHE_SIZE", 64))
+
+# Chats longer than the context window: truncate (drop the oldest turns, keep
+# system messages), summarize (condense dropped turns into a system note) or error (400)
+CONTEXT_POLICY = os.environ.get("CONTEXT_POLICY", "truncate").lower()
+# Tokens left free for the reply when a chat is trimmed (capped at the request's max_tokens)
+CONTEXT_RESERVE_TOKENS = int(os.environ.get("CONTEXT_RESERVE_TOKENS", 256))
+# Generation that reaches the end of the window discards the older half of the
+# context after the first CONTEXT_SHIFT_KEEP tokens and continues (0 stops with "length")
+CONTEXT_SHIFT = int(os.environ.get("CONTEXT_SHIFT", 1))
+CONTEXT_SHIFT_KEEP = int(os.environ.get("CONTEXT_SHIFT_KEEP", 128))
+
+# Model registry: "name=path;name=path" served side by side and routed by the
+# request's model field (empty serves MODEL_PATH alone); the first entry is the default
+MODELS = os.environ.get("MODELS", "")
+# Bytes of GGUF weights kept loaded; idle models are unloaded LRU beyond it (0 = unlimited)
+MODEL_MEMORY_BUDGET = int(os.environ.get("MODEL_MEMORY_BUDGET", 0))
+# Directory that POST /v1/models/{model_id}/load may load new GGUF files from
+MODEL_DIR = os.environ.get("MODEL_DIR", os.path.dirname(MODEL_PATH) or ".")
+# Token for loading and unloading models over HTTP (Authorization: Bearer or
+# X-Admin-Token); empty disables those endpoints
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+
+# Startup: page the GGUF in before loading it (willneed, read or off), then run a
+# short warm-up generation before the model reports ready (0 tokens disables it)
+MODEL_PREFETCH = os.environ.get("MODEL_PREFETCH", "willneed").lower()
+WARMUP_TOKENS = int(os.environ.get("WARMUP_TOKENS", 4))
+WARMUP_PROMPT = os.environ.get("WARMUP_PROMPT", "Hello")
+# Reference point for startup timings
+PROCESS_STARTED = time.perf_counter()
+
+# CPU threads per model instance (0 = size from the process affinity mask)
+N_THREADS = int(os.environ.get("N_THREADS", 0))
+N_THREADS_BATCH = int(os.environ.get("N_THREADS_BATCH", 0))
+
+# Multi-process worker pool (0 runs inference in the API process)
+WORKER_PROCESSES = int(os.environ.get("WORKER_PROCESSES", 0))
+# Optional explicit core sets, one per worker, e.g. "0-7;8-15"
+WORKER_CPU_SETS = os.environ.get("WORKER_CPU_SETS", "")
+
+# Inference scheduling
+INFERENCE_QUEUE_DEPTH = int(os.environ.get("INFERENCE_QUEUE_DEPTH", 32))
+INFERENCE_QUEUE_TIMEOUT = float(os.environ.get("INFERENCE_QUEUE_TIMEOUT", 60.0))
+
+# Request deadlines and cancellation: seconds a request may take end to end when it sets
+# no timeout field or X-Request-Timeout header (0 = no deadline), and whether a client
+# disconnect stops a non-streaming generation at the next token (streams always stop)
+REQUEST_TIMEOUT = float(os.environ.get("REQUEST_TIMEOUT", 0))
+CANCEL_ON_DISCONNECT = int(os.environ.get("CANCEL_ON_DISCONNECT", 1))
+
+# Admission control, in tokens (prompt plus max_tokens): a budget for all queued and
+# running requests (0 = unlimited) and a per-client token bucket (0 tokens/s = unlimited).
+# Clients are API keys, else addresses; CLIENT_WEIGHTS ("key=2;batch=0.5") sets
+# their round-robin share of the inference queue
+ADMISSION_TOKEN_BUDGET = int(os.environ.get("ADMISSION_TOKEN_BUDGET", 0))
+CLIENT_TOKENS_PER_SECOND = float(os.environ.get("CLIENT_TOKENS_PER_SECOND", 0))
+CLIENT_TOKEN_BURST = int(os.environ.get("CLIENT_TOKEN_BURST", 8192))
+CLIENT_WEIGHTS = os.environ.get("CLIENT_WEIGHTS", "")
+
+# Continuous batching (BATCH_SEQ_SLOTS > 1 enables the batch engine)
+BATCH_SEQ_SLOTS = int(os.environ.get("BATCH_SEQ_SLOTS", 1))
+BATCH_SIZE = int(os.environ.get("BATCH_SIZE", 512))
+
+# Speculative decoding: off, prompt-lookup (n-gram drafts from the context) or draft (DRAFT_MODEL_PATH)
+SPECULATIVE = os.environ.get("SPECULATIVE", "off").lower()
+SPECULATIVE_DRAFT_TOKENS = int(os.environ.get("SPECULATIVE_DRAFT_TOKENS", 8))
+SPECULATIVE_NGRAM_SIZE = int(os.environ.get("SPECULATIVE_NGRAM_SIZE", 3))
+DRAFT_MODEL_PATH = os.environ.get("DRAFT_MODEL_PATH", "")
+
+# Prefix KV cache (0 disables)
+PREFIX_CACHE_BYTES = int(os.environ.get("PREFIX_CACHE_BYTES", 64 * 1024 * 1024))
+PREFIX_CACHE_MIN_TOKENS = int(os.environ.get("PREFIX_CACHE_MIN_TOKENS", 32))
+
+# Persisted KV snapshots: a JSON file listing system prompts whose KV state is
+# precomputed, saved under KV_SNAPSHOT_DIR and memory-mapped when a model loads
+KV_SNAPSHOT_PROMPTS = os.environ.get("KV_SNAPSHOT_PROMPTS", "")
+KV_SNAPSHOT_DIR = os.environ.get("KV_SNAPSHOT_DIR", ".cache/kv_snapshots")
+
+# Response cache for deterministic (temperature=0) requests: memory, file or none
+RESPONSE_CACHE = os.environ.get("RESPONSE_CACHE", "memory").lower()
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", 1024))
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", 3600.0))
+RESPONSE_CACHE_DIR = os.environ.get("RESPONSE_CACHE_DIR", ".cache/responses")
+
+# Attach identical concurrent deterministic requests to one generation (0 disables)
+REQUEST_COALESCING = int(os.environ.get("REQUEST_COALESCING", 1))
+
+# Bulk jobs (/v1/batches)
+BATCH_DIR = os.environ.get("BATCH_DIR", ".cache/batches")
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", 0))  # 0 = one per inference worker
+BATCH_MAX_REQUESTS = int(os.environ.get("BATCH_MAX_REQUESTS", 1000000))
+BATCH_MAX_RETRIES = int(os.environ.get("BATCH_MAX_RETRIES", 8))  # scheduler rejections per line before it fails
+
+# Chat template: auto (from GGUF tokenizer.chat_template) or a PROMPT_TEMPLATES name
+PROMPT_TEMPLATE = os.environ.get("PROMPT_TEMPLATE", "auto").lower()
+PROMPT_TOKEN_CACHE_SIZE = int(os.environ.get("PROMPT_TOKEN_CACHE_SIZE", 8192))
+
+# Compiled stop-sequence automata kept for reuse, keyed by stop set
+STOP_MATCHER_CACHE_SIZE = int(os.environ.get("STOP_MATCHER_CACHE_SIZE", 256))
+
+# Embeddings (/v1/embeddings): tokens and sequences evaluated per batched pass, and
+# inputs accepted per request. An input may be at most EMBEDDING_BATCH_SIZE tokens
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", 2048))
+EMBEDDING_MAX_SEQS = int(os.environ.get("EMBEDDING_MAX_SEQS", 64))
+EMBEDDING_MAX_INPUTS = int(os.environ.get("EMBEDDING_MAX_INPUTS", 2048))
+
+# Streaming
+STREAM_BUFFER_SIZE = int(os.environ.get("STREAM_BUFFER_SIZE", 64))
+STREAM_WRITE_TIMEOUT = float(os.environ.get("STREAM_WRITE_TIMEOUT", 30.0))
+
+# Encode responses with orjson when it is installed (0 = stdlib json)
+FAST_JSON = int(os.environ.get("FAST_JSON", 1))
+
+# Request tracing: one JSON line per request with its spans (validate, template, queue,
+# prefill, decode, serialize), written by a background thread to TRACE_LOG ("-" for
+# stdout, empty disables). TRACE_SAMPLE_RATE of requests are kept up front; errors and
+# requests slower than TRACE_SLOW_MS always are. Traces beyond TRACE_BUFFER waiting
+# to be written are dropped
+TRACE_LOG = os.environ.get("TRACE_LOG", "")
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 1.0))
+TRACE_SLOW_MS = float(os.environ.get("TRACE_SLOW_MS", 1000.0))
+TRACE_BUFFER = int(os.environ.get("TRACE_BUFFER", 10000))
+# Also export kept traces as OTLP/HTTP JSON, e.g. http://localhost:4318/v1/traces
+TRACE_OTLP_ENDPOINT = os.environ.get("TRACE_OTLP_ENDPOINT", "")
+OTEL_SERVICE_NAME = os.environ.get("OTEL_SERVICE_NAME", "smollm2-api")
+
+# Server log level (the API process and inference workers log to stderr)
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+
+logger = logging.getLogger("smollm2-api")
+
+def configure_logging():
+    logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s [%(processName)s] %(message)s")
+
+# ============================================================================
+# JSON ENCODING
+# ============================================================================
+
+def _json_default(value: Any) -> Any:
+    # orjson leaves float subclasses such as numpy.float64 to the caller
+    if isinstance(value, float):
+        return float(value)
+    # Only the stdlib encoder gets here with arrays
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+_json_encoder = json.JSONEncoder(ensure_ascii=False, allow_nan=False, separators=(",", ":"), default=_json_default)
+
+if orjson is not None and FAST_JSON:
+    def json_bytes(data: Any) -> bytes:
+        return orjson.dumps(data, default=_json_default, option=orjson.OPT_SERIALIZE_NUMPY)
+
+    def json_text(data: Any) -> str:
+        return json_bytes(data).decode("utf-8")
+else:
+    json_text = _json_encoder.encode
+
+    def json_bytes(data: Any) -> bytes:
+        return _json_encoder.encode(data).encode("utf-8")
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with json_bytes (orjson when installed)."""
+
+    def render(self, content: Any) -> bytes:
+        return json_bytes(content)
+
+# ============================================================================
+# Pydantic Models for Request/Response Validation
+# ============================================================================
+
+class Message(BaseModel):
+    role: str = Field(..., description="Role: system, user, or assistant")
+    content: str = Field(..., description="Message content")
+
+class AnthropicMessage(BaseModel):
+    role: str = Field(..., description="Role: user or assistant")
+    content: str = Field(..., description="Message content")
+
+class ResponseFormat(BaseModel):
+    type: Literal["text", "json_object", "json_schema"] = "text"
+    # {"name": ..., "schema": {...}, "strict": ...} for json_schema
+    json_schema: Optional[Dict[str, Any]] = None
+
+    @model_validator(mode="after")
+    def check_schema(self):
+        if self.type == "json_schema" and not isinstance((self.json_schema or {}).get("schema"), dict):
+            raise ValueError("response_format json_schema needs a json_schema.schema object")
+        return self
+
+class ChatCompletionRequest(BaseModel):
+    messages: List[Message]
+    model: Optional[str] = None
+    max_tokens: Optional[int] = Field(default=MAX_TOKENS_DEFAULT, ge=1, le=2048)
+    temperature: Optional[float] = Field(default=TEMPERATURE_DEFAULT, ge=0.0, le=2.0)
+    top_p: Optional[float] = Field(default=0.9, ge=0.0, le=1.0)
+    stream: Optional[bool] = False
+    stop: Optional[List[str]] = None
+    n: Optional[int] = Field(default=1, ge=1, le=MAX_CHOICES)
+    best_of: Optional[int] = Field(default=None, ge=1, le=MAX_CHOICES)
+    response_format: Optional[ResponseFormat] = None
+    timeout: Optional[float] = Field(default=None, gt=0, description="Seconds until the request is abandoned")
+
+    @model_validator(mode="after")
+    def check_choices(self):
+        n = self.n or 1
+        if self.best_of is not None and self.best_of < n:
+            raise ValueError("best_of must be greater than or equal to n")
+        if self.stream and self.best_of is not None and self.best_of > n:
+            raise ValueError("best_of cannot be used with stream")
+        return self
+
+class AnthropicCompletionRequest(BaseModel):
+    model: Optional[str] = None
+    messages: List[AnthropicMessage]
+    max_tokens: Optional[int] = Field(default=MAX_TOKENS_DEFAULT, ge=1, le=2048)
+    temperature: Optional[float] = Field(default=TEMPERATURE_DEFAULT, ge=0.0, le=2.0)
+    top_p: Optional[float] = Field(default=0.9, ge=0.0, le=1.0)
+    stream: Optional[bool] = False
+    stop_sequences: Optional[List[str]] = None
+    timeout: Optional[float] = Field(default=None, gt=0, description="Seconds until the request is abandoned")
+
+class EmbeddingRequest(BaseModel):
+    input: Union[str, List[str], List[int], List[List[int]]] = Field(..., description="Text or token ids, or a list of either")
+    model: Optional[str] = None
+    encoding_format: Optional[str] = Field(default="float", pattern="^(float|base64)$")
+    user: Optional[str] = None
+    timeout: Optional[float] = Field(default=None, gt=0, description="Seconds until the request is abandoned")
+
+class ModelLoadRequest(BaseModel):
+    path: Optional[str] = Field(default=None, description="GGUF file under MODEL_DIR; defaults to the registered path")
+
+# ============================================================================
+# MODEL MAPPING
+# ============================================================================
+
+# Map internal model names to display names for different APIs
+OPENAI_MODEL_MAP = {
+    "smollm2-135m-instruct-gguf": "smollm2-135m-instruct",
+    "smolllm2-135m-instruct-gguf": "smollm2-135m-instruct",
+    "default": "smollm2-135m-instruct"
+}
+
+ANTHROPIC_MODEL_MAP = {
+    "smollm2-135m-instruct-gguf": "smolllm2-135m-instruct",
+    "smolllm2-135m-instruct-gguf": "smolllm2-135m-instruct",
+    "default": "smolllm2-135m-instruct"
+}
+
+# ============================================================================
+# PROMPT TEMPLATES
+# ============================================================================
+
+class PromptTemplate:
+    """
+    A chat layout: a prefix and suffix around each message, keyed by role,
+    followed by the generation prompt.
+    
+    Roles are lowercased and mapped through role_aliases; anything else
+    becomes default_role, or is dropped when default_role is None.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        roles: Dict[str, Tuple[str, str]],
+        generation_prompt: str,
+        role_aliases: Optional[Dict[str, str]] = None,
+        default_role: Optional[str] = "user",
+        system_first: bool = False,
+        markers: Tuple[str, ...] = ()
+    ):
+        self.name = name
+        self.roles = roles
+        self.generation_prompt = generation_prompt
+        self.role_aliases = role_aliases or {}
+        self.default_role = default_role
+        self.system_first = system_first
+        # Substrings identifying this layout in a GGUF tokenizer.chat_template
+        self.markers = markers
+
+    def turns(self, messages) -> List[Tuple[str, str, str]]:
+        """(prefix, content, suffix) for every rendered message, in prompt order."""
+        turns = []
+        system = []
+        for msg in messages:
+            role = msg.role.lower()
+            role = self.role_aliases.get(role, role)
+            if role not in self.roles:
+                role = self.default_role
+                if role is None:
+                    continue
+            prefix, suffix = self.roles[role]
+            turn = (prefix, msg.content, suffix)
+            (system if self.system_first and role == "system" else turns).append(turn)
+        return system + turns
+
+    def render_text(self, messages, add_generation_prompt: bool = True) -> str:
+        text = "".join(prefix + content + suffix for prefix, content, suffix in self.turns(messages))
+        return text + self.generation_prompt if add_generation_prompt else text
+
+def _role_layout(roles: Tuple[str, ...], prefix: str, suffix: str) -> Dict[str, Tuple[str, str]]:
+    return {role: (prefix.format(role=role), suffix) for role in roles}
+
+CHATML_TEMPLATE = PromptTemplate(
+    "chatml",
+    _role_layout(("system", "user", "assistant"), "<|im_start|>{role}\n", "<|im_end|>\n"),
+    "<|im_start|>assistant\n",
+    role_aliases={"function": "assistant", "tool": "assistant"},
+    markers=("<|im_start|>",),
+)
+
+# Plain-text Human/Assistant layout served by /v1/messages
+ANTHROPIC_TEXT_TEMPLATE = PromptTemplate(
+    "anthropic-text",
+    {"system": ("", ""), "user": ("\n\nHuman: ", ""), "assistant": ("\n\nAssistant: ", "")},
+    "\n\nAssistant:",
+    default_role=None,
+    system_first=True,
+)
+
+PROMPT_TEMPLATES = {
+    template.name: template
+    for template in (
+        CHATML_TEMPLATE,
+        PromptTemplate(
+            "llama3",
+            _role_layout(("system", "user", "assistant"), "<|start_header_id|>{role}<|end_header_id|>\n\n", "<|eot_id|>"),
+            "<|start_header_id|>assistant<|end_header_id|>\n\n",
+            role_aliases={"function": "assistant", "tool": "assistant"},
+            markers=("<|start_header_id|>", "<|eot_id|>"),
+        ),
+        PromptTemplate(
+            "gemma",
+            {"user": ("<start_of_turn>user\n", "<end_of_turn>\n"), "assistant": ("<start_of_turn>model\n", "<end_of_turn>\n")},
+            "<start_of_turn>model\n",
+            role_aliases={"system": "user", "function": "assistant", "tool": "assistant"},
+            markers=("<start_of_turn>",),
+        ),
+        PromptTemplate(
+            "phi3",
+            {role: (f"<|{role}|>\n", "<|end|>\n") for role in ("system", "user", "assistant")},
+            "<|assistant|>\n",
+            role_aliases={"function": "assistant", "tool": "assistant"},
+            markers=("<|assistant|>", "<|end|>"),
+        ),
+        ANTHROPIC_TEXT_TEMPLATE,
+    )
+}
+
+def select_template(llm: Llama) -> PromptTemplate:
+    """PROMPT_TEMPLATE if set, otherwise the layout matching the GGUF chat template (ChatML by default)."""
+    if PROMPT_TEMPLATE != "auto":
+        if PROMPT_TEMPLATE not in PROMPT_TEMPLATES:
+            raise ValueError(f"Unknown PROMPT_TEMPLATE {PROMPT_TEMPLATE!r}; choose from {sorted(PROMPT_TEMPLATES)}")
+        return PROMPT_TEMPLATES[PROMPT_TEMPLATE]
+    chat_template = (llm.metadata or {}).get("tokenizer.chat_template", "")
+    for template in PROMPT_TEMPLATES.values():
+        if template.markers and all(marker in chat_template for marker in template.markers):
+            return template
+    return CHATML_TEMPLATE
+
+def build_chatml_prompt(messages: List[Message], add_assistant_prompt: bool = True) -> str:
+    """
+    Build a ChatML-formatted prompt from messages.
+    This format is optimal for SmolLM2 instruction tuning.
+    
+    Args:
+        messages: List of message objects with role and content
+        add_assistant_prompt: Whether to add the assistant generation prompt
+    
+    Returns:
+        Formatted prompt string
+    """
+    return CHATML_TEMPLATE.render_text(messages, add_assistant_prompt)
+
+def build_anthropic_prompt(messages: List[AnthropicMessage]) -> str:
+    """
+    Build Anthropic-formatted prompt from messages.
+    
+    Args:
+        messages: List of Anthropic message objects
+    
+    Returns:
+        Formatted prompt string
+    """
+    return ANTHROPIC_TEXT_TEMPLATE.render_text(messages)
+
+class PromptRenderer:
+    """
+    Renders messages straight to token ids, reusing earlier tokenizations.
+    
+    Role scaffolding (prefixes, suffixes, generation prompt) is tokenized
+    once, and message contents are memoized by content hash, so a long
+    multi-turn prompt only tokenizes its newest message. Concatenating
+    separately tokenized pieces is only valid where the tokenizer agrees, so
+    a probe at load time picks the finest granularity that reproduces the
+    full-text tokenization exactly:
+    
+    - split: scaffolding and contents tokenized separately
+    - message: each whole message tokenized separately
+    - full: the rendered text tokenized in one go
+    
+    Contents that are empty or have leading/trailing whitespace can merge
+    with neighbouring text, so they are probed separately: they are
+    tokenized as whole messages where that is exact (boundaries at special
+    tokens, as in ChatML), and otherwise send the whole prompt to full.
+    """
+
+    PROBE_CONTENTS = (
+        "You are a helpful assistant.",
+        "hello world",
+        " leading space",
+        "trailing space ",
+        "multi\n\nline\n",
+        "",
+        "naïve café ☕ 日本",
+        "Human: quoted <b>markup</b>",
+    )
+
+    def __init__(self, template: PromptTemplate, llm: Llama, max_entries: int = PROMPT_TOKEN_CACHE_SIZE):
+        self.template = template
+        self.llm = llm
+        self.max_entries = max_entries
+        self._bos = llm.tokenize(b"", add_bos=True, special=True)
+        self._scaffold: Dict[str, List[int]] = {}
+        self._pieces: "OrderedDict[bytes, List[int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.mode, self.edge_mode = self._probe()
+
+    def _tokenize(self, text: str) -> List[int]:
+        return self.llm.tokenize(text.encode("utf-8"), add_bos=False, special=True)
+
+    def _scaffold_tokens(self, text: str) -> List[int]:
+        tokens = self._scaffold.get(text)
+        if tokens is None:
+            tokens = self._scaffold[text] = self._tokenize(text)
+        return tokens
+
+    def _piece_tokens(self, text: str) -> List[int]:
+        """Tokens for a message or content, memoized by content hash."""
+        key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+        with self._lock:
+            tokens = self._pieces.get(key)
+            if tokens is not None:
+                self._pieces.move_to_end(key)
+                self.hits += 1
+                return tokens
+            self.misses += 1
+        tokens = self._tokenize(text)
+        with self._lock:
+            self._pieces[key] = tokens
+            while len(self._pieces) > self.max_entries:
+                self._pieces.popitem(last=False)
+        return tokens
+
+    def _render(self, messages, mode: str, edge_mode: str, add_generation_prompt: bool = True) -> List[int]:
+        if mode == "full":
+            text = self.template.render_text(messages, add_generation_prompt)
+            return self.llm.tokenize(text.encode("utf-8"), add_bos=True, special=True)
+        tokens = list(self._bos)
+        for prefix, content, suffix in self.template.turns(messages):
+            if content and content.strip() == content:
+                if mode == "split":
+                    # Trailing spaces of the prefix belong to the first word of the content
+                    scaffold = prefix.rstrip(" ")
+                    tokens += self._scaffold_tokens(scaffold)
+                    tokens += self._piece_tokens(prefix[len(scaffold):] + content)
+                    tokens += self._scaffold_tokens(suffix)
+                else:
+                    tokens += self._piece_tokens(prefix + content + suffix)
+            elif edge_mode == "message":
+                tokens += self._piece_tokens(prefix + content + suffix)
+            else:
+                return self._render(messages, "full", "full", add_generation_prompt)
+        if add_generation_prompt:
+            tokens += self._scaffold_tokens(self.template.generation_prompt)
+        return tokens
+
+    def _probe(self) -> Tuple[str, str]:
+        """Finest (mode, edge_mode) that matches full tokenization on the probe conversations."""
+        roles = ("system", "user", "assistant", "user")
+
+        def conversations(contents):
+            return [
+                [Message(role=roles[i % len(roles)], content=contents[(start + i) % len(contents)])
+                 for i in range(len(contents))]
+                for start in range(len(contents))
+            ]
+
+        def matches(convs, mode, edge_mode):
+            return all(
+                self._render(conv, mode, edge_mode) == self._render(conv, "full", "full") for conv in convs
+            )
+
+        plain = conversations([c for c in self.PROBE_CONTENTS if c and c.strip() == c])
+        mode = next((m for m in ("split", "message") if matches(plain, m, "full")), "full")
+        if mode == "full":
+            return "full", "full"
+        edge_mode = "message" if matches(conversations(self.PROBE_CONTENTS), mode, "message") else "full"
+        return mode, edge_mode
+
+    def render(self, messages) -> List[int]:
+        return self._render(messages, self.mode, self.edge_mode)
+
+    def message_tokens(self, message) -> int:
+        """Tokens of one message's turn, memoized with the other rendered pieces."""
+        return sum(len(self._piece_tokens(prefix + content + suffix))
+                   for prefix, content, suffix in self.template.turns([message]))
+
+    def render_prefix(self, messages) -> List[int]:
+        """Tokens that start every prompt opening with these messages (no generation prompt)."""
+        return self._render(messages, self.mode, self.edge_mode, add_generation_prompt=False)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "template": self.template.name,
+            "mode": self.mode,
+            "edge_mode": self.edge_mode,
+            "entries": len(self._pieces),
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+def render_chat_prompt(runtime: "ModelRuntime", messages: List[Message],
+                       max_tokens: int = 0) -> Union[str, List[int]]:
+    """Prompt for /v1/chat/completions: token ids fitted to the context window once the model is loaded."""
+    if runtime.chat_renderer is None:
+        return build_chatml_prompt(messages)
+    return fit_messages(runtime.chat_renderer, messages, prompt_budget(max_tokens))
+
+def render_anthropic_prompt(runtime: "ModelRuntime", messages: List[AnthropicMessage],
+                            max_tokens: int = 0) -> Union[str, List[int]]:
+    """Prompt for /v1/messages: token ids fitted to the context window once the model is loaded."""
+    if runtime.anthropic_renderer is None:
+        return build_anthropic_prompt(messages)
+    return fit_messages(runtime.anthropic_renderer, messages, prompt_budget(max_tokens))
+
+# ============================================================================
+# CONTEXT WINDOW
+# ============================================================================
+
+class ContextLengthExceeded(ValueError):
+    """Raised when a prompt cannot be made to fit the context window."""
+
+def prompt_budget(max_tokens: int) -> int:
+    """Prompt tokens allowed so that the start of the reply fits in the window."""
+    return CONTEXT_SIZE - max(1, min(max_tokens, CONTEXT_RESERVE_TOKENS, CONTEXT_SIZE // 2))
+
+def summarize_turns(messages, limit: int = 480) -> str:
+    """An extractive note of dropped turns: the opening of each, newest kept when space runs out."""
+    lines: List[str] = []
+    used = 0
+    for message in reversed(messages):
+        content = " ".join(message.content.split())
+        line = f"{message.role}: {content[:120]}" + ("..." if len(content) > 120 else "")
+        if lines and used + len(line) > limit:
+            break
+        lines.append(line)
+        used += len(line)
+    return "Earlier in this conversation:\n" + "\n".join(reversed(lines))
+
+def fit_messages(renderer: PromptRenderer, messages, budget: int) -> List[int]:
+    """
+    Render messages, dropping the oldest turns until the prompt fits budget tokens.
+    
+    System messages and the final message are always kept, and a dropped
+    user message takes the replies that followed it along. Which turns to
+    drop is decided from per-message token counts that come out of the
+    renderer's piece cache, so a long chat is not re-tokenized on every
+    request; only the trimmed prompt is rendered again. CONTEXT_POLICY
+    "summarize" replaces the dropped turns with a short system note of them
+    and "error" rejects the request instead.
+    """
+    tokens = renderer.render(messages)
+    if len(tokens) <= budget:
+        return tokens
+    if CONTEXT_POLICY == "error" or len(messages) < 2:
+        raise ContextLengthExceeded(
+            f"Prompt is {len(tokens)} tokens; at most {budget} fit in the context window of {CONTEXT_SIZE}"
+        )
+    
+    droppable = [i for i, message in enumerate(messages[:-1]) if message.role.lower() != "system"]
+    counts = {i: renderer.message_tokens(messages[i]) for i in droppable}
+    excess = len(tokens) - budget
+    dropped = 0
+    note_limit = 480
+    while True:
+        # Drop at least the estimated excess, then check against the real render
+        while dropped < len(droppable) and excess > 0:
+            excess -= counts[droppable[dropped]]
+            dropped += 1
+        # Replies never open the remaining history
+        while dropped < len(droppable) and messages[droppable[dropped]].role.lower() == "assistant":
+            dropped += 1
+        gone = set(droppable[:dropped])
+        kept = [message for i, message in enumerate(messages) if i not in gone]
+        if CONTEXT_POLICY == "summarize":
+            note = type(messages[-1])(role="system", content=summarize_turns([messages[i] for i in sorted(gone)], note_limit))
+            first = next((i for i, message in enumerate(kept) if message.role.lower() != "system"), len(kept))
+            kept.insert(first, note)
+        tokens = renderer.render(kept)
+        if len(tokens) <= budget:
+            metric_context_trimmed.inc(CONTEXT_POLICY, amount=len(gone))
+            return tokens
+        if dropped >= len(droppable):
+            if CONTEXT_POLICY != "summarize" or note_limit < 64:
+                break
+            # Nothing left to drop: shorten the note instead
+            note_limit //= 2
+        excess = len(tokens) - budget
+    raise ContextLengthExceeded(
+        f"Prompt is {len(tokens)} tokens after dropping earlier turns; at most {budget} fit "
+        f"in the context window of {CONTEXT_SIZE}"
+    )
+
+# ============================================================================
+# MODEL LOADING
+# ============================================================================
+
+def available_cpus() -> List[int]:
+    """CPU ids this process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+class InstrumentedLlama(Llama):
+    """
+    Llama that tracks tokenizer calls and the end of prefill.
+    
+    Usage counts are taken from the engine instead of re-tokenizing prompt
+    and output; tokenizer_calls lets benchmarks confirm that each request
+    tokenizes its prompt exactly once. first_sample_time splits a call into
+    prefill and decode time. While grammar is set, every sampled token is
+    checked against it, so constrained generation keeps using Llama.generate.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.tokenizer_calls = 0
+        # perf_counter() of the first sample since the caller last reset it (end of prefill)
+        self.first_sample_time: Optional[float] = None
+        # Grammar the current serial generation is constrained to
+        self.grammar: Optional["GrammarState"] = None
+        self._grammar_rng = np.random.default_rng()
+        self._counter_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False) -> List[int]:
+        with self._counter_lock:
+            self.tokenizer_calls += 1
+        return super().tokenize(text, add_bos, special)
+
+    def sample(self, *args, **kwargs) -> int:
+        token = super().sample(*args, **kwargs)
+        if self.grammar is not None:
+            # Only the last position has logits during generate
+            logits = np.ctypeslib.as_array(self._ctx.get_logits(), shape=(self._n_vocab,))
+            token = self.grammar.constrain(token, logits, kwargs.get("temp", 0.8), kwargs.get("top_p", 0.95),
+                                           self._grammar_rng)
+        if self.first_sample_time is None:
+            self.first_sample_time = time.perf_counter()
+        return token
+
+def end_of_generation_tokens(llm: Llama) -> set:
+    """Token ids that end a generation (EOS and, when the vocab has one, EOT)."""
+    tokens = {llm.token_eos()}
+    token_eot = getattr(llm._model, "token_eot", None)
+    if token_eot is not None and token_eot() >= 0:
+        tokens.add(token_eot())
+    return tokens
+
+def parse_model_specs(spec: str) -> "OrderedDict[str, str]":
+    """Parse "name=path;name=path" into registry entries; the first one is the default model."""
+    models: "OrderedDict[str, str]" = OrderedDict()
+    for item in filter(None, (part.strip() for part in spec.split(";"))):
+        name, separator, path = item.partition("=")
+        if not separator or not name.strip() or not path.strip():
+            raise ValueError(f"MODELS entry {item!r} is not name=path")
+        models[name.strip()] = path.strip()
+    if not models:
+        models[OPENAI_MODEL_MAP["default"]] = MODEL_PATH
+    return models
+
+def prefetch_model_file(path: str, mode: str) -> int:
+    """
+    Pull a GGUF into the page cache ahead of the mmap'd load.
+    
+    willneed asks the kernel for asynchronous readahead and returns at once;
+    read blocks until every page has been read. Either way the load and the
+    first requests stop taking major page faults on cold weights.
+    
+    Returns:
+        Bytes read (0 for willneed)
+    """
+    if mode in ("", "off", "none") or not os.path.exists(path):
+        return 0
+    if mode not in ("willneed", "read"):
+        raise ValueError(f"Unknown MODEL_PREFETCH mode {mode!r}; use willneed, read or off")
+    with open(path, "rb") as f:
+        if mode == "read":
+            buffer = bytearray(16 * 1024 * 1024)
+            total = 0
+            while True:
+                n = f.readinto(buffer)
+                if not n:
+                    return total
+                total += n
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        elif hasattr(mmap, "MADV_WILLNEED") and os.path.getsize(path) > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                mapped.madvise(mmap.MADV_WILLNEED)
+    return 0
+
+class ModelRuntime:
+    """
+    One loaded GGUF and everything built on it: the Llama (or the worker
+    processes serving it), batch engine, prefix cache and prompt renderers.
+    
+    Requests and generations hold leases on the runtime. unload() waits for
+    the last lease to be returned, so a model that is swapped out or evicted
+    finishes its in-flight requests before it is freed.
+    """
+
+    def __init__(self, name: str, path: str):
+        self.name = name
+        self.path = path
+        stat = os.stat(path) if os.path.exists(path) else None
+        self.size_bytes = stat.st_size if stat is not None else 0
+        # Names the weights in response cache keys, so a replaced file never serves stale entries
+        self.fingerprint = f"{path}:{self.size_bytes}:{stat.st_mtime_ns if stat is not None else 0}"
+        
+        self.model = None
+        self.batch_engine = None
+        self.prefix_cache = None
+        self.snapshots: Optional[KVSnapshotStore] = None
+        self.worker_pool = None
+        self.chat_renderer = None
+        self.anthropic_renderer = None
+        self.grammars: Optional["GrammarCache"] = None
+        # Created on the first /v1/embeddings request
+        self._embedding_engine: Optional[EmbeddingEngine] = None
+        self._embedding_lock = threading.Lock()
+        
+        self.loaded_at: Optional[float] = None
+        # Seconds spent in each load phase
+        self.startup: Dict[str, float] = {}
+        self.last_used = 0.0
+        self.requests = 0
+        self.in_flight = 0
+        self.retired = False
+        self.closed = False
+        self._leases = threading.Condition()
+        # Serializes the serial (non-batched) path across inference threads
+        self.lock = threading.Lock()
+
+    @property
+    def ready(self) -> bool:
+        return self.model is not None or (self.worker_pool is not None and self.worker_pool.ready)
+
+    def acquire(self):
+        """Take a lease that keeps the model loaded. Safe to call from any thread."""
+        with self._leases:
+            if self.closed:
+                raise RuntimeError(f"Model {self.name} has been unloaded")
+            self.in_flight += 1
+            self.last_used = time.time()
+
+    def release(self):
+        with self._leases:
+            self.in_flight -= 1
+            self._leases.notify_all()
+
+    def _load_prompt_renderers(self, llm: Llama):
+        self.chat_renderer = PromptRenderer(select_template(llm), llm)
+        self.anthropic_renderer = PromptRenderer(ANTHROPIC_TEXT_TEMPLATE, llm)
+        logger.info("Prompt template: %s (%s tokenization)", self.chat_renderer.template.name, self.chat_renderer.mode)
+
+    def _phase(self, name: str, started: float) -> float:
+        now = time.perf_counter()
+        self.startup[f"{name}_seconds"] = round(now - started, 4)
+        return now
+
+    def load(self):
+        """Load the GGUF quantized model with optimized settings, then warm it up."""
+        started = phase = time.perf_counter()
+        # Page cache is shared, so worker processes load from warm pages too
+        prefetch_model_file(self.path, MODEL_PREFETCH)
+        phase = self._phase("prefetch", phase)
+        
+        if WORKER_PROCESSES > 0:
+            # Each worker process warms up its own model before reporting ready
+            self.worker_pool = WorkerPool(WORKER_PROCESSES, parse_cpu_sets(WORKER_CPU_SETS), self.path)
+            self.worker_pool.start()
+            logger.info("Worker pool started for %s: %d processes", self.name, WORKER_PROCESSES)
+            phase = self._phase("load", phase)
+            # Vocab-only load so prompts are rendered to tokens here, not in the workers,
+            # and response_format grammars are checked before a request is queued
+            vocab = Llama(model_path=self.path, vocab_only=True, verbose=False)
+            self._load_prompt_renderers(vocab)
+            self.grammars = GrammarCache(vocab, GRAMMAR_CACHE_SIZE)
+            self._phase("setup", phase)
+            self._phase("total", started)
+            self.loaded_at = time.time()
+            return
+        
+        n_threads = N_THREADS or len(available_cpus())
+        n_threads_batch = N_THREADS_BATCH or n_threads
+        logger.info("Loading model %s from: %s (%d threads)", self.name, self.path, n_threads)
+        
+        self.model = InstrumentedLlama(
+            model_path=self.path,
+            n_ctx=CONTEXT_SIZE,
+            n_threads=n_threads,
+            n_threads_batch=n_threads_batch,
+            n_gpu_layers=0,  # CPU inference
+            verbose=False,
+            # Optimization settings
+            use_mmap=True,
+            use_mlock=False,
+            # Context settings
+            rope_freq_base=0.0,
+            rope_freq_scale=0.0,
+        )
+        
+        logger.info("Model loaded successfully! Context size: %d", CONTEXT_SIZE)
+        phase = self._phase("load", phase)
+        self._load_prompt_renderers(self.model)
+        self.grammars = GrammarCache(self.model, GRAMMAR_CACHE_SIZE)
+        
+        if PREFIX_CACHE_BYTES > 0 or KV_SNAPSHOT_PROMPTS:
+            self.prefix_cache = PrefixCache(PREFIX_CACHE_BYTES, PREFIX_CACHE_MIN_TOKENS)
+        if KV_SNAPSHOT_PROMPTS:
+            self.snapshots = KVSnapshotStore(KV_SNAPSHOT_DIR, self.name, self.path, CONTEXT_SIZE)
+            self.snapshots.prepare(self, load_snapshot_prompts(KV_SNAPSHOT_PROMPTS))
+            logger.info("KV snapshots: %d loaded, %d built", self.snapshots.loaded, self.snapshots.built)
+            phase = self._phase("snapshots", phase)
+        
+        # Speculative decoding runs in the batch engine, also with a single slot
+        drafter = create_drafter(self.model, BATCH_SEQ_SLOTS, CONTEXT_SIZE, n_threads)
+        if BATCH_SEQ_SLOTS > 1 or drafter is not None:
+            self.batch_engine = BatchEngine(self.model, n_slots=BATCH_SEQ_SLOTS, n_batch=BATCH_SIZE,
+                                            n_ctx_per_slot=CONTEXT_SIZE, drafter=drafter,
+                                            prefix_cache=self.prefix_cache)
+            self.batch_engine.start()
+            logger.info("Batch engine started: %d sequence slots, batch size %d%s", BATCH_SEQ_SLOTS, BATCH_SIZE,
+                        f", {drafter.name} speculation" if drafter is not None else "")
+        phase = self._phase("setup", phase)
+        
+        if WARMUP_TOKENS > 0:
+            self._warm_up()
+            self._phase("warmup", phase)
+        self._phase("total", started)
+        self.loaded_at = time.time()
+
+    def _warm_up(self):
+        """One short generation, so graph setup and first-touch page faults happen before ready."""
+        prompt = render_chat_prompt(self, [Message(role="user", content=WARMUP_PROMPT)])
+        generate_response(self, prompt, max_tokens=WARMUP_TOKENS, temperature=0.0, top_p=1.0)
+
+    def embedding_engine(self) -> "EmbeddingEngine":
+        with self._embedding_lock:
+            if self._embedding_engine is None:
+                self._embedding_engine = EmbeddingEngine(self, EMBEDDING_BATCH_SIZE, EMBEDDING_MAX_SEQS)
+                logger.info("Embedding context created for %s: %d tokens, %d sequences per pass",
+                            self.name, EMBEDDING_BATCH_SIZE, EMBEDDING_MAX_SEQS)
+            return self._embedding_engine
+
+    def unload(self, timeout: Optional[float] = None):
+        """Wait for outstanding leases (up to timeout), then free the model."""
+        with self._leases:
+            self._leases.wait_for(lambda: self.in_flight == 0, timeout)
+            self.closed = True
+        if self.batch_engine is not None:
+            self.batch_engine.stop()
+            drafter = self.batch_engine.drafter
+            if drafter is not None and getattr(drafter, "llm", None) is not None:
+                drafter.llm.close()
+        if self.worker_pool is not None:
+            self.worker_pool.stop()
+        if self._embedding_engine is not None:
+            self._embedding_engine.close()
+            self._embedding_engine = None
+        if self.snapshots is not None:
+            # Pinned prefix cache entries point into the mappings; drop them first
+            self.prefix_cache = None
+            self.snapshots.close()
+        if self.model is not None:
+            # Also frees the batch engine context, which hangs off the same llama_model
+            self.model.close()
+        self.model = self.batch_engine = self.prefix_cache = self.snapshots = self.worker_pool = None
+        self.chat_renderer = self.anthropic_renderer = self.grammars = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "id": self.name,
+            "path": self.path,
+            "size_bytes": self.size_bytes,
+            "loaded": self.ready,
+            "loaded_at": self.loaded_at,
+            "startup": self.startup,
+            "last_used": self.last_used or None,
+            "requests": self.requests,
+            "in_flight": self.in_flight,
+            "batch_engine": self.batch_engine.stats() if self.batch_engine is not None else None,
+            "prefix_cache": self.prefix_cache.stats() if self.prefix_cache is not None else None,
+            "kv_snapshots": self.snapshots.stats() if self.snapshots is not None else None,
+            "worker_pool": self.worker_pool.stats() if self.worker_pool is not None else None,
+            "embeddings": self._embedding_engine.stats() if self._embedding_engine is not None else None,
+            "tokenizer_calls": self.model.tokenizer_calls if self.model is not None else None,
+            "prompt_renderer": self.chat_renderer.stats() if self.chat_renderer is not None else None,
+            "grammars": self.grammars.stats() if self.grammars is not None else None,
+        }
+
+# ============================================================================
+# PREFIX KV CACHE
+# ============================================================================
+
+def common_prefix_length(a, b) -> int:
+    """Number of leading tokens two token sequences share."""
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+def get_sequence_state(ctx, seq_id: int) -> bytes:
+    """Copy the KV cache of one sequence out of a llama context."""
+    size = llama_cpp.llama_state_seq_get_size(ctx, seq_id)
+    buffer = (ctypes.c_uint8 * size)()
+    written = llama_cpp.llama_state_seq_get_data(ctx, buffer, size, seq_id)
+    return ctypes.string_at(buffer, written)
+
+def set_sequence_state(ctx, seq_id: int, state: bytes) -> bool:
+    """Load KV cache data saved by get_sequence_state into a sequence."""
+    buffer = (ctypes.c_uint8 * len(state)).from_buffer_copy(state)
+    return llama_cpp.llama_state_seq_set_data(ctx, buffer, len(state), seq_id) > 0
+
+class PrefixCache:
+    """
+    LRU cache of per-sequence KV state keyed by the evaluated token prefix.
+    
+    A lookup returns the entry sharing the longest token prefix with the new
+    prompt; restoring it means only the suffix after the shared prefix needs
+    prefill. Only the sequence's KV cells are stored (no logits), and the
+    least recently used entries are evicted once the byte budget is exceeded.
+    """
+
+    def __init__(self, capacity_bytes: int, min_tokens: int):
+        self.capacity_bytes = capacity_bytes
+        self.min_tokens = min_tokens
+        self._entries: "OrderedDict[Tuple[int, ...], bytes]" = OrderedDict()
+        # Entries outside the LRU and the byte budget (persisted KV snapshots)
+        self._pinned: Dict[Tuple[int, ...], Any] = {}
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.reused_tokens = 0
+
+    def lookup(self, tokens: List[int]) -> Tuple[int, Optional[Tuple[int, ...]], Optional[bytes]]:
+        """
+        Find the cached state sharing the longest prefix with tokens.
+        
+        Returns:
+            Tuple of (shared_prefix_length, entry_tokens, state); the last two
+            are None on a miss
+        """
+        best_length, best_key, best_entries = 0, None, None
+        with self._lock:
+            for entries in (self._pinned, self._entries):
+                for key in entries:
+                    length = common_prefix_length(key, tokens)
+                    if length > best_length:
+                        best_length, best_key, best_entries = length, key, entries
+            if best_length < self.min_tokens:
+                self.misses += 1
+                return 0, None, None
+            if best_entries is self._entries:
+                self._entries.move_to_end(best_key)
+            self.hits += 1
+            return best_length, best_key, best_entries[best_key]
+
+    def record_reuse(self, n_tokens: int):
+        """Count prompt tokens that skipped prefill thanks to a cached state."""
+        with self._lock:
+            self.reused_tokens += n_tokens
+
+    def pin(self, tokens: List[int], state):
+        """Add an entry that is never evicted; state may be any buffer, such as a memory map."""
+        with self._lock:
+            self._pinned[tuple(tokens)] = state
+
+    def store(self, tokens: List[int], state: bytes):
+        """Insert the KV state for an evaluated token sequence, evicting LRU entries over budget."""
+        if len(tokens) < self.min_tokens or len(state) > self.capacity_bytes:
+            return
+        key = tuple(tokens)
+        with self._lock:
+            if key in self._pinned:
+                return
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous)
+            self._entries[key] = state
+            self._size += len(state)
+            while self._size > self.capacity_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "pinned": len(self._pinned),
+                "size_bytes": self._size,
+                "capacity_bytes": self.capacity_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "reused_tokens": self.reused_tokens,
+            }
+
+# Snapshot file: magic, format version, header length, JSON header, per-sequence KV state
+KV_SNAPSHOT_MAGIC = b"LKVS"
+KV_SNAPSHOT_FORMAT = 1
+_KV_SNAPSHOT_PREAMBLE = struct.Struct("<4sII")
+
+def model_file_hash(path: str, sample_bytes: int = 1 << 20, samples: int = 16) -> str:
+    """
+    Fingerprint of a GGUF's contents: its size, the metadata and tensor
+    index at the start of the file, and evenly spaced samples of the tensor
+    data. Hashing every byte would make each start as slow as a cold read.
+    """
+    size = os.path.getsize(path)
+    digest = hashlib.sha256(str(size).encode())
+    with open(path, "rb") as f:
+        digest.update(f.read(4 * sample_bytes))
+        for i in range(1, samples + 1):
+            f.seek(max(0, size * i // samples - sample_bytes))
+            digest.update(f.read(sample_bytes))
+    return digest.hexdigest()
+
+def load_snapshot_prompts(path: str) -> List[str]:
+    """System prompts to snapshot, from a JSON list of strings."""
+    with open(path, encoding="utf-8") as f:
+        prompts = json.load(f)
+    if not isinstance(prompts, list) or not all(isinstance(prompt, str) for prompt in prompts):
+        raise ValueError(f"{path} must hold a JSON list of system prompt strings")
+    return prompts
+
+class KVSnapshotStore:
+    """
+    KV state of registered prompt prefixes, persisted across restarts.
+    
+    Every registered system prompt is rendered with the model's templates
+    and its prefix evaluated once; the per-sequence KV state is written to
+    disk with a header naming the model hash, context size and llama-cpp
+    version. At load, files are memory-mapped and pinned in the runtime's
+    prefix cache, so any prompt starting with the prefix restores it instead
+    of re-running its prefill, with either inference engine. A header that
+    does not match the loaded model is rejected and the snapshot rebuilt.
+    """
+
+    def __init__(self, directory: str, model_name: str, model_path: str, n_ctx: int):
+        self.directory = directory
+        self.model_name = model_name
+        self.version = {
+            "model_hash": model_file_hash(model_path),
+            "n_ctx": n_ctx,
+            "llama_cpp": getattr(llama_cpp, "__version__", ""),
+        }
+        os.makedirs(directory, exist_ok=True)
+        # Mapped files and the views of them pinned in the prefix cache
+        self._maps: List[Tuple[mmap.mmap, memoryview]] = []
+        self.loaded = 0
+        self.built = 0
+        self.rejected = 0
+        self.mapped_bytes = 0
+
+    def path_for(self, tokens: List[int]) -> str:
+        digest = hashlib.sha256(json.dumps(tokens).encode()).hexdigest()[:24]
+        return os.path.join(self.directory, f"{self.model_name}-{digest}.kvstate")
+
+    def open(self, tokens: List[int]) -> Optional[memoryview]:
+        """Memory-map a valid snapshot for tokens; None when missing or stale."""
+        path = self.path_for(tokens)
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return None
+        with f:
+            try:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                mapped = None
+        header = None
+        if mapped is not None and len(mapped) >= _KV_SNAPSHOT_PREAMBLE.size:
+            magic, file_format, header_length = _KV_SNAPSHOT_PREAMBLE.unpack_from(mapped)
+            start = _KV_SNAPSHOT_PREAMBLE.size
+            if magic == KV_SNAPSHOT_MAGIC and file_format == KV_SNAPSHOT_FORMAT:
+                try:
+                    header = json.loads(mapped[start:start + header_length])
+                except ValueError:
+                    header = None
+        if header is None or header.get("version") != self.version or header.get("tokens") != tokens:
+            logger.warning("Rejecting stale KV snapshot %s", path)
+            self.rejected += 1
+            if mapped is not None:
+                mapped.close()
+            return None
+        view = memoryview(mapped)[_KV_SNAPSHOT_PREAMBLE.size + header_length:]
+        self._maps.append((mapped, view))
+        self.loaded += 1
+        self.mapped_bytes += len(mapped)
+        return view
+
+    def save(self, tokens: List[int], state: bytes):
+        header = json.dumps({"version": self.version, "tokens": tokens, "created": int(time.time())}).encode()
+        path = self.path_for(tokens)
+        temp = f"{path}.tmp-{os.getpid()}"
+        with open(temp, "wb") as f:
+            f.write(_KV_SNAPSHOT_PREAMBLE.pack(KV_SNAPSHOT_MAGIC, KV_SNAPSHOT_FORMAT, len(header)))
+            f.write(header)
+            f.write(state)
+        os.replace(temp, path)
+        self.built += 1
+
+    def prepare(self, runtime: "ModelRuntime", prompts: List[str]):
+        """Load or build the snapshot of every prompt prefix and pin it in the runtime's prefix cache."""
+        llm = runtime.model
+        prefixes = []
+        for prompt in prompts:
+            for renderer in (runtime.chat_renderer, runtime.anthropic_renderer):
+                tokens = renderer.render_prefix([Message(role="system", content=prompt)])
+                if tokens not in prefixes:
+                    prefixes.append(tokens)
+        
+        for tokens in prefixes:
+            if len(tokens) >= llm.n_ctx():
+                logger.warning("Skipping a KV snapshot prompt of %d tokens: it does not fit the context", len(tokens))
+                continue
+            state = self.open(tokens)
+            if state is None:
+                llm.reset()
+                llm.eval(tokens)
+                self.save(tokens, get_sequence_state(llm._ctx.ctx, 0))
+                state = self.open(tokens)
+            runtime.prefix_cache.pin(tokens, state)
+
+    def close(self):
+        """Unmap every snapshot. The views handed to the prefix cache become unusable."""
+        for mapped, view in self._maps:
+            view.release()
+            mapped.close()
+        self._maps.clear()
+        self.mapped_bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "directory": self.directory,
+            "loaded": self.loaded,
+            "built": self.built,
+            "rejected": self.rejected,
+            "mapped_bytes": self.mapped_bytes,
+        }
+
+def restore_prefix(runtime: ModelRuntime, prompt_tokens: List[int]):
+    """
+    Load the best cached KV state into the Llama context before a serial generation.
+    
+    Llama reuses whatever prefix of its evaluated tokens matches the new
+    prompt, so a restore only happens when the cache shares more tokens with
+    the prompt than the live context does.
+    """
+    model, prefix_cache = runtime.model, runtime.prefix_cache
+    if prefix_cache is None:
+        return
+    live = common_prefix_length(model._input_ids.tolist(), prompt_tokens)
+    shared, key, state = prefix_cache.lookup(prompt_tokens)
+    if state is None or shared <= live:
+        return
+    
+    model._ctx.kv_cache_clear()
+    if not set_sequence_state(model._ctx.ctx, 0, state):
+        model.reset()
+        return
+    model.input_ids[:len(key)] = key
+    model.n_tokens = len(key)
+    # Logits for the restored tokens were not saved; Llama re-evaluates at least one token
+    model._requires_eval = True
+    prefix_cache.record_reuse(shared - live)
+
+def shift_context(model: Llama, prompt_length: int) -> bool:
+    """
+    Discard the older half of a full serial context so generation can go on.
+    
+    Same policy as BatchEngine._shift: the first CONTEXT_SHIFT_KEEP tokens
+    stay and later cells move down over the discarded span.
+    """
+    n_past = model.n_tokens
+    if not CONTEXT_SHIFT or n_past + 1 < model.n_ctx():
+        return False
+    n_keep = min(CONTEXT_SHIFT_KEEP, prompt_length, n_past // 2)
+    n_discard = (n_past - n_keep) // 2
+    if n_discard <= 0:
+        return False
+    model._ctx.kv_cache_seq_rm(0, n_keep, n_keep + n_discard)
+    model._ctx.kv_cache_seq_shift(0, n_keep + n_discard, n_past, -n_discard)
+    model.input_ids[n_keep:n_past - n_discard] = model.input_ids[n_keep + n_discard:n_past].copy()
+    model.n_tokens = n_past - n_discard
+    return True
+
+def remember_prefix(runtime: ModelRuntime):
+    """Save the Llama context's KV state after a serial generation."""
+    model, prefix_cache = runtime.model, runtime.prefix_cache
+    if prefix_cache is None or model.n_tokens < prefix_cache.min_tokens:
+        return
+    prefix_cache.store(model._input_ids.tolist(), get_sequence_state(model._ctx.ctx, 0))
+
+# ============================================================================
+# STOP SEQUENCES
+# ============================================================================
+
+class StopMatcher:
+    """
+    Aho-Corasick automaton over a set of stop sequences.
+    
+    Transitions are precomputed for every character that occurs in a stop
+    sequence (any other character returns to the root), so matching costs
+    one dict lookup per generated character however long the completion or
+    the stop set. depth[state] is the length of the longest suffix of the
+    text seen so far that could still grow into a stop sequence: exactly
+    the characters a stream has to hold back.
+    """
+
+    def __init__(self, stops: Tuple[str, ...]):
+        self.stops = stops
+        edges: List[Dict[str, int]] = [{}]
+        self.depth = [0]
+        self.output: List[Optional[str]] = [None]
+        for stop in stops:
+            state = 0
+            for char in stop:
+                child = edges[state].get(char)
+                if child is None:
+                    child = edges[state][char] = len(edges)
+                    edges.append({})
+                    self.depth.append(self.depth[state] + 1)
+                    self.output.append(None)
+                state = child
+            if self.output[state] is None:
+                self.output[state] = stop
+        
+        # Breadth-first over the trie: a state's failure link is shallower, so
+        # its transitions are complete by the time they are copied
+        alphabet = set("".join(stops))
+        self.delta: List[Dict[str, int]] = [{} for _ in edges]
+        fail = [0] * len(edges)
+        order = [0]
+        for state in order:
+            for char in alphabet:
+                child = edges[state].get(char)
+                if child is None:
+                    self.delta[state][char] = self.delta[fail[state]].get(char, 0) if state else 0
+                    continue
+                self.delta[state][char] = child
+                fail[child] = self.delta[fail[state]].get(char, 0) if state else 0
+                # A stop ending here wins over a shorter one ending at the same character
+                if self.output[child] is None:
+                    self.output[child] = self.output[fail[child]]
+                order.append(child)
+
+class StopScanner:
+    """Incremental stop-sequence matching over one generation's decoded text."""
+
+    def __init__(self, matcher: StopMatcher):
+        self.matcher = matcher
+        self.state = 0
+        self.pending = ""
+        self.stop_sequence: Optional[str] = None
+
+    def feed(self, piece: str) -> str:
+        """
+        Consume newly decoded text and return the part that is safe to show.
+        
+        Once a stop sequence completes, stop_sequence is set and the returned
+        text ends right before it.
+        """
+        delta, output = self.matcher.delta, self.matcher.output
+        state = self.state
+        for index, char in enumerate(piece):
+            state = delta[state].get(char, 0)
+            stop = output[state]
+            if stop is not None:
+                text = self.pending + piece[:index + 1]
+                self.pending = ""
+                self.stop_sequence = stop
+                return text[:len(text) - len(stop)]
+        self.state = state
+        text = self.pending + piece
+        held = self.matcher.depth[state]
+        self.pending = text[len(text) - held:] if held else ""
+        return text[:len(text) - held]
+
+    def flush(self) -> str:
+        """The held-back tail, once generation ends without a stop match."""
+        text, self.pending = self.pending, ""
+        return text
+
+_stop_matchers: "OrderedDict[Tuple[str, ...], StopMatcher]" = OrderedDict()
+_stop_matchers_lock = threading.Lock()
+
+def compile_stop_matcher(stop_tokens: List[str]) -> StopMatcher:
+    """The automaton for a stop set, built once and shared by every request using the same set."""
+    key = tuple(dict.fromkeys(stop for stop in stop_tokens if stop))
+    with _stop_matchers_lock:
+        matcher = _stop_matchers.get(key)
+        if matcher is not None:
+            _stop_matchers.move_to_end(key)
+            return matcher
+    matcher = StopMatcher(key)
+    with _stop_matchers_lock:
+        _stop_matchers[key] = matcher
+        while len(_stop_matchers) > STOP_MATCHER_CACHE_SIZE:
+            _stop_matchers.popitem(last=False)
+    return matcher
+
+# ============================================================================
+# CANCELLATION
+# ============================================================================
+
+class RequestCancelled(Exception):
+    """Raised when a request stops early: its client disconnected or its deadline passed."""
+
+    def __init__(self, reason: str):
+        super().__init__("Request deadline exceeded" if reason == "deadline" else f"Request cancelled ({reason})")
+        self.reason = reason
+
+    @property
+    def status_code(self) -> int:
+        # 499 (client closed request) is never seen by the client, only by logs and traces
+        return 504 if self.reason == "deadline" else 499
+
+class Cancellation:
+    """
+    Why a generation should stop early, shared by a request and the thread running it.
+    
+    The event loop cancels it when the client disconnects or the deadline
+    timer fires. Generation loops poll `cancelled` at every token, which also
+    notices a deadline that passed while the event loop was busy. Callbacks
+    forward a cancellation to whatever is waiting on the request (a queued
+    scheduler job, a worker process).
+    """
+
+    __slots__ = ("deadline", "reason", "_callbacks", "_lock", "_timer", "_watcher")
+
+    def __init__(self, deadline: Optional[float] = None):
+        # perf_counter() after which the request is abandoned
+        self.deadline = deadline
+        self.reason: Optional[str] = None
+        self._callbacks: List[Callable[[], Any]] = []
+        self._lock = threading.Lock()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._watcher: Optional[asyncio.Task] = None
+
+    @property
+    def cancelled(self) -> bool:
+        if self.reason is None and self.deadline is not None and time.perf_counter() >= self.deadline:
+            self.cancel("deadline")
+        return self.reason is not None
+
+    def remaining(self) -> Optional[float]:
+        """Seconds left until the deadline, or None without one."""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.perf_counter())
+
+    def cancel(self, reason: str):
+        """Cancel once; later calls keep the first reason. Safe from any thread."""
+        with self._lock:
+            if self.reason is not None:
+                return
+            self.reason = reason
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def add_callback(self, callback: Callable[[], Any]):
+        """Call callback on cancellation, right away if already cancelled."""
+        with self._lock:
+            if self.reason is None:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def watch(self, http_request: Optional[Request] = None):
+        """
+        Arm the deadline timer and, given the request, cancel on client disconnect.
+        
+        Only for non-streaming responses: a StreamingResponse listens for the
+        disconnect itself, and two readers would race for the message.
+        """
+        loop = asyncio.get_running_loop()
+        if self.deadline is not None:
+            self._timer = loop.call_later(self.remaining(), self.cancel, "deadline")
+        if http_request is not None and CANCEL_ON_DISCONNECT:
+            self._watcher = loop.create_task(self._watch_disconnect(http_request.receive))
+
+    async def _watch_disconnect(self, receive):
+        # The body has been read, so the next message is the disconnect
+        while (await receive())["type"] != "http.disconnect":
+            pass
+        self.cancel("disconnect")
+
+    def close(self):
+        """Disarm the timer and the disconnect watcher once the response is ready."""
+        if self._timer is not None:
+            self._timer.cancel()
+        if self._watcher is not None:
+            self._watcher.cancel()
+
+    async def wait(self, awaitable):
+        """
+        Await awaitable, raising RequestCancelled as soon as this is cancelled.
+        
+        The awaitable is cancelled in turn, so wrap it in asyncio.shield() to
+        leave it running for other callers.
+        """
+        if self.reason is not None:
+            raise RequestCancelled(self.reason)
+        loop = asyncio.get_running_loop()
+        fired = loop.create_future()
+        self.add_callback(lambda: loop.call_soon_threadsafe(_resolve_future, fired))
+        task = asyncio.ensure_future(awaitable)
+        try:
+            await asyncio.wait((task, fired), return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        if task.done():
+            fired.cancel()
+            return task.result()
+        task.cancel()
+        raise RequestCancelled(self.reason)
+
+def request_deadline(http_request: Request, timeout: Optional[float]) -> Cancellation:
+    """
+    Cancellation for an API request, with its deadline taken from the timeout
+    field, else the X-Request-Timeout header, else REQUEST_TIMEOUT.
+    """
+    if timeout is None:
+        header = http_request.headers.get("x-request-timeout")
+        if header is not None:
+            try:
+                timeout = float(header)
+            except ValueError:
+                raise HTTPException(status_code=400, detail="X-Request-Timeout must be a number of seconds")
+            if not timeout > 0:
+                raise HTTPException(status_code=400, detail="X-Request-Timeout must be positive")
+        else:
+            timeout = REQUEST_TIMEOUT or None
+    return Cancellation(time.perf_counter() + timeout if timeout else None)
+
+def record_early_stop(cancel: Optional[Cancellation], result: Dict[str, Any], budget: int):
+    """Count a generation its cancellation cut short, with the completion tokens it never generated."""
+    if cancel is None or not cancel.cancelled:
+        return
+    choices = result.get("choices") or (result,)
+    if result["finish_reason"] is not None and all(choice["finish_reason"] is not None for choice in choices):
+        # Finished on its own before the cancellation was noticed
+        return
+    record_cancellation(cancel.reason, budget - result["completion_tokens"])
+
+# ============================================================================
+# INFERENCE
+# ============================================================================
+
+# Role markers only stop generation at the start of a line, so a completion
+# may still mention "User:" mid-sentence
+DEFAULT_STOP_TOKENS = [
+    "<|im_end|>",
+    "<|im_start|>",
+    "\nHuman:",
+    "\nAssistant:",
+    "\nSystem:",
+    "\nUser:"
+]
+
+def tokenize_prompt(llm: Llama, prompt: Union[str, List[int]]) -> List[int]:
+    """Token ids for a prompt that is either rendered text or already tokenized."""
+    if isinstance(prompt, str):
+        return llm.tokenize(prompt.encode("utf-8"), special=True)
+    return prompt
+
+def generation_timings(started: float, first_token: Optional[float], finished: float) -> Dict[str, float]:
+    """Split a generation's wall time into prefill (up to the first sampled token) and decode."""
+    if first_token is None:
+        first_token = finished
+    return {
+        "prefill_seconds": first_token - started,
+        "decode_seconds": finished - first_token,
+    }
+
+def token_logprob(logits: np.ndarray, token: int) -> float:
+    """Log-probability of a token under the model's unscaled distribution."""
+    top = float(logits.max())
+    return float(logits[token]) - top - math.log(float(np.exp(logits - top).sum()))
+
+def merge_choices(candidates: List[Dict[str, Any]], n: int, timings: Dict[str, float]) -> Dict[str, Any]:
+    """
+    Combine the results of several sequences sampled from one prompt.
+    
+    With more candidates than n (best_of), the n with the highest mean token
+    log-probability are kept. Usage counts every sampled token; the top-level
+    text and finish reason are those of the first choice.
+    """
+    ranked = candidates
+    if len(candidates) > n:
+        ranked = sorted(candidates, key=lambda r: r["logprob"] / max(1, r["completion_tokens"]), reverse=True)[:n]
+    choices = [
+        {
+            "index": index,
+            "text": candidate["text"],
+            "finish_reason": candidate["finish_reason"],
+            "stop_sequence": candidate["stop_sequence"],
+        }
+        for index, candidate in enumerate(ranked)
+    ]
+    prompt_tokens = candidates[0]["prompt_tokens"]
+    completion_tokens = sum(candidate["completion_tokens"] for candidate in candidates)
+    result = {
+        "text": choices[0]["text"],
+        "finish_reason": choices[0]["finish_reason"],
+        "stop_sequence": choices[0]["stop_sequence"],
+        "choices": choices,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        **timings
+    }
+    for key in ("context_shifts", "draft_tokens", "accepted_draft_tokens"):
+        if key in candidates[0]:
+            result[key] = sum(candidate[key] for candidate in candidates)
+    return result
+
+@contextlib.contextmanager
+def runtime_lease(runtime: ModelRuntime):
+    """Hold a lease on a runtime for the duration of a blocking generation."""
+    runtime.acquire()
+    try:
+        yield runtime
+    finally:
+        runtime.release()
+
+def generate_response(
+    runtime: ModelRuntime,
+    prompt: Union[str, List[int]],
+    max_tokens: int = 512,
+    temperature: float = 0.7,
+    top_p: float = 0.9,
+    stop_tokens: Optional[List[str]] = None,
+    n: int = 1,
+    best_of: Optional[int] = None,
+    grammar: Optional["CompiledGrammar"] = None,
+    cancel: Optional[Cancellation] = None
+) -> Dict[str, Any]:
+    """
+    Generate a response using the SmolLM2 model.
+    
+    Args:
+        runtime: Loaded model to generate with
+        prompt: Formatted prompt text or its token ids
+        max_tokens: Maximum tokens to generate
+        temperature: Sampling temperature (0.0-2.0)
+        top_p: Top-p sampling parameter
+        stop_tokens: List of stop tokens
+        n: Choices to return, all sampled from one evaluation of the prompt
+        best_of: Sequences to sample when more than n; the n most likely are returned
+        grammar: Grammar every sequence is constrained to (response_format)
+        cancel: Stops generation at the next token once cancelled (client
+            disconnect or deadline)
+    
+    Returns:
+        Dictionary with generated text and metadata (and "choices" when more
+        than one sequence was sampled)
+    """
+    # Default stop tokens
+    if stop_tokens is None:
+        stop_tokens = DEFAULT_STOP_TOKENS
+    
+    with runtime_lease(runtime):
+        engine = runtime.worker_pool or runtime.batch_engine
+        if engine is not None:
+            result = engine.generate(prompt, max_tokens, temperature, top_p, stop_tokens, n=n, best_of=best_of,
+                                     grammar=grammar, cancel=cancel)
+        elif runtime.model is None:
+            raise RuntimeError("Model not loaded")
+        else:
+            with runtime.lock:
+                result = _serial_generate(runtime, prompt, max_tokens, temperature, top_p, stop_tokens, n=n,
+                                          best_of=best_of, grammar=grammar, cancel=cancel)
+    if runtime.worker_pool is None:
+        # A worker process records its own early stop and relays the counters
+        record_early_stop(cancel, result, max_tokens * max(n, best_of or n))
+    return result
+
+def generate_response_stream(
+    runtime: ModelRuntime,
+    prompt: Union[str, List[int]],
+    token_stream: "TokenStream",
+    max_tokens: int = 512,
+    temperature: float = 0.7,
+    top_p: float = 0.9,
+    stop_tokens: Optional[List[str]] = None,
+    n: int = 1,
+    grammar: Optional["CompiledGrammar"] = None,
+    cancel: Optional[Cancellation] = None
+) -> Dict[str, Any]:
+    """
+    Generate a response token by token, pushing text into a TokenStream.
+    
+    Runs on the inference worker. Generation stops at the next token
+    boundary once the stream or cancel is cancelled (client disconnect, a
+    reader too slow to drain its buffer, or the deadline). With n > 1, text
+    is pushed together with the index of the choice it belongs to.
+    
+    Args:
+        runtime: Loaded model to generate with
+        prompt: Formatted prompt text or its token ids
+        token_stream: Stream receiving generated text pieces
+        max_tokens: Maximum tokens to generate
+        temperature: Sampling temperature (0.0-2.0)
+        top_p: Top-p sampling parameter
+        stop_tokens: List of stop tokens
+        n: Choices to sample from one evaluation of the prompt
+        grammar: Grammar every choice is constrained to (response_format)
+        cancel: Deadline and reason for stopping early
+    
+    Returns:
+        Dictionary with generated text and metadata
+    """
+    if stop_tokens is None:
+        stop_tokens = DEFAULT_STOP_TOKENS
+    
+    with runtime_lease(runtime):
+        on_start = lambda count: setattr(token_stream, "prompt_tokens", count)
+        engine = runtime.worker_pool or runtime.batch_engine
+        if engine is not None:
+            result = engine.generate(prompt, max_tokens, temperature, top_p, stop_tokens,
+                                     on_start=on_start, on_text=token_stream.put, n=n, grammar=grammar, cancel=cancel)
+        elif runtime.model is None:
+            raise RuntimeError("Model not loaded")
+        else:
+            with runtime.lock:
+                result = _serial_generate(runtime, prompt, max_tokens, temperature, top_p, stop_tokens,
+                                          on_start=on_start, on_text=token_stream.put, n=n, grammar=grammar,
+                                          cancel=cancel)
+    if token_stream.cancelled.is_set():
+        if cancel is None:
+            cancel = Cancellation()
+        # A stream stopped by its reader: gone, or too slow to drain its buffer
+        cancel.cancel("disconnect")
+    result["cancelled"] = cancel is not None and cancel.reason is not None
+    if runtime.worker_pool is None:
+        record_early_stop(cancel, result, max_tokens * n)
+    return result
+
+def _serial_generate(runtime: ModelRuntime, prompt, max_tokens, temperature, top_p, stop_tokens,
+                     on_start=None, on_text=None, n: int = 1, best_of: Optional[int] = None,
+                     grammar: Optional["CompiledGrammar"] = None,
+                     cancel: Optional[Cancellation] = None) -> Dict[str, Any]:
+    """
+    Generate on the runtime's own Llama, with its lock held.
+    
+    Several choices are sampled one after another. Llama keeps the KV cells
+    of the longest prefix it has already evaluated, so every choice after the
+    first re-evaluates only the last prompt token.
+    """
+    sequences = max(n, best_of or n)
+    if sequences == 1:
+        return _serial_sample(runtime, prompt, max_tokens, temperature, top_p, stop_tokens, on_start, on_text,
+                              grammar=grammar, cancel=cancel)
+    
+    started = time.perf_counter()
+    tokens = tokenize_prompt(runtime.model, prompt)
+    candidates = []
+    for index in range(sequences):
+        emit = None if on_text is None else (lambda text, index=index: on_text(text, index))
+        candidate = _serial_sample(runtime, tokens, max_tokens, temperature, top_p, stop_tokens,
+                                   on_start if index == 0 else None, emit, scored=sequences > n, grammar=grammar,
+                                   cancel=cancel)
+        candidates.append(candidate)
+        if candidate["finish_reason"] is None:
+            # Cancelled: the reader is gone or the deadline passed
+            break
+    first_token = started + candidates[0]["prefill_seconds"]
+    return merge_choices(candidates, n, generation_timings(started, first_token, time.perf_counter()))
+
+def _serial_sample(runtime: ModelRuntime, prompt, max_tokens, temperature, top_p, stop_tokens,
+                   on_start=None, on_text=None, scored: bool = False,
+                   grammar: Optional["CompiledGrammar"] = None,
+                   cancel: Optional[Cancellation] = None) -> Dict[str, Any]:
+    """
+    Sample one sequence on the runtime's own Llama.
+    
+    Mirrors BatchEngine.generate: tokens come straight from Llama.generate
+    and are decoded incrementally, stop sequences are matched by a
+    StopScanner, and on_text receives each piece of visible text and may
+    return False to stop at the next token, as does cancel once it is
+    cancelled. When the window fills before
+    max_tokens, the context is shifted and generation resumes from the
+    shifted tokens, re-evaluating only the last sample. With scored, the
+    log-probability of the sampled tokens is summed for best_of ranking.
+    With a grammar, each sequence starts from its own fresh grammar state,
+    which carries over a context shift.
+    """
+    model = runtime.model
+    started = time.perf_counter()
+    tokens = tokenize_prompt(model, prompt)
+    prompt_tokens = len(tokens)
+    if prompt_tokens >= model.n_ctx():
+        raise ValueError(f"Requested tokens ({prompt_tokens}) exceed context window of {model.n_ctx()}")
+    if on_start is not None:
+        on_start(prompt_tokens)
+    restore_prefix(runtime, tokens)
+    model.first_sample_time = None
+    model.grammar = grammar.state() if grammar is not None else None
+    scanner = StopScanner(compile_stop_matcher(stop_tokens))
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+    eog_tokens = end_of_generation_tokens(model)
+    n_vocab = model.n_vocab()
+    logprob = 0.0 if scored else None
+    pieces = []
+    
+    def emit(text: str) -> bool:
+        # Leading whitespace of the completion is dropped, as in the batch engine
+        if not pieces:
+            text = text.lstrip()
+        if not text:
+            return True
+        pieces.append(text)
+        return on_text is None or on_text(text) is not False
+    
+    finish_reason = None
+    cancelled = False
+    completion_tokens = 0
+    shifts = 0
+    context = tokens
+    try:
+        while finish_reason is None and not cancelled:
+            generator = model.generate(context, temp=temperature, top_p=top_p)
+            try:
+                for token in generator:
+                    if token in eog_tokens:
+                        finish_reason = "stop"
+                        break
+                    if logprob is not None:
+                        # The context's logits are still those the token was sampled from
+                        logits = np.ctypeslib.as_array(model._ctx.get_logits(), shape=(n_vocab,))
+                        logprob += token_logprob(logits, token)
+                    completion_tokens += 1
+                    visible = scanner.feed(decoder.decode(model.detokenize([token])))
+                    if scanner.stop_sequence is not None:
+                        finish_reason = "stop"
+                    if not emit(visible) or (finish_reason is None and cancel is not None and cancel.cancelled):
+                        cancelled = True
+                    elif finish_reason is None and completion_tokens >= max_tokens:
+                        finish_reason = "length"
+                    elif finish_reason is None and model.n_tokens + 1 >= model.n_ctx():
+                        if shift_context(model, prompt_tokens):
+                            # The last sample was never evaluated: it is the one token left to decode
+                            context = model._input_ids.tolist() + [token]
+                            shifts += 1
+                        else:
+                            finish_reason = "length"
+                        break
+                    if finish_reason is not None or cancelled:
+                        break
+            finally:
+                # Closing the generator stops llama-cpp at the current token
+                generator.close()
+        if finish_reason is not None and scanner.stop_sequence is None:
+            emit(scanner.flush())
+    finally:
+        finished = time.perf_counter()
+        model.grammar = None
+        if shifts:
+            # Shifted cells were computed with context that is gone: start the next prompt afresh
+            model.reset()
+        else:
+            remember_prefix(runtime)
+    
+    result = {
+        "text": "".join(pieces).strip(),
+        "finish_reason": None if cancelled else finish_reason,
+        "stop_sequence": scanner.stop_sequence,
+        "context_shifts": shifts,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        **generation_timings(started, model.first_sample_time, finished)
+    }
+    if logprob is not None:
+        result["logprob"] = logprob
+    return result
+
+# ============================================================================
+# CONSTRAINED DECODING
+# ============================================================================
+
+# Memory layout of llama_token_data, for masking a whole vocabulary at once
+TOKEN_DATA_DTYPE = np.dtype([("id", np.intc), ("logit", np.single), ("p", np.single)], align=True)
+
+class GrammarError(ValueError):
+    """Raised when a response_format cannot be turned into a grammar."""
+
+def json_schema_grammar(schema: str) -> str:
+    """GBNF for a JSON schema (given as JSON text)."""
+    gbnf = json_schema_to_gbnf(schema)
+    # The converter lets raw control characters into strings, which JSON does not allow
+    return gbnf.replace('char ::= [^"\\\\] |', 'char ::= [^"\\\\\\x7F\\x00-\\x1F] |')
+
+class CompiledGrammar:
+    """
+    A GBNF grammar parsed once against a model's vocabulary.
+    
+    The parsed rules live in a template llama.cpp grammar sampler. Each
+    sequence decodes with its own clone, which copies the parsed rules
+    instead of parsing the GBNF again.
+    """
+
+    def __init__(self, key: str, gbnf: str, llm: Llama):
+        self.key = key
+        self.gbnf = gbnf
+        self.eos = llm.token_eos()
+        self._ids = np.arange(llm.n_vocab(), dtype=np.intc)
+        self._template = llama_cpp.llama_sampler_init_grammar(llm._model.vocab, gbnf.encode("utf-8"), b"root")
+        if not self._template:
+            raise GrammarError("response_format grammar could not be parsed")
+
+    def state(self) -> "GrammarState":
+        return GrammarState(self)
+
+    def __del__(self):
+        # Clones are independent copies, so an evicted grammar is freed once nothing holds it
+        if getattr(self, "_template", None):
+            llama_cpp.llama_sampler_free(self._template)
+            self._template = None
+
+class GrammarState:
+    """The position of one sequence in a CompiledGrammar."""
+
+    def __init__(self, grammar: CompiledGrammar):
+        self.grammar = grammar
+        self._sampler = llama_cpp.llama_sampler_clone(grammar._template)
+        self._one = llama_cpp.llama_token_data()
+        self._single = llama_cpp.llama_token_data_array(data=ctypes.pointer(self._one), size=1, selected=-1, sorted=False)
+        # Sampled tokens the grammar rejected, which were drawn again from the allowed ones
+        self.resampled = 0
+
+    def constrain(self, token: int, logits: np.ndarray, temperature: float, top_p: float,
+                  rng: np.random.Generator) -> int:
+        """
+        The token to emit instead of a freely sampled one. The grammar then advances past it.
+        
+        Checking the one sampled token is cheap. Only when the grammar rejects
+        it is the whole vocabulary masked and a token sampled again from the
+        allowed ones. Without top-p this gives the same distribution as
+        masking first. An allowed token is kept with its probability
+        renormalized over the allowed set.
+        """
+        if not self._allows(token):
+            masked = self._mask(logits)
+            if not np.isfinite(masked).any():
+                # Nothing can follow: end the sequence
+                return self.grammar.eos
+            token = sample_token(masked, temperature, top_p, rng)
+            self.resampled += 1
+        llama_cpp.llama_sampler_accept(self._sampler, token)
+        return token
+
+    def _allows(self, token: int) -> bool:
+        self._one.id = token
+        self._one.logit = 0.0
+        self._single.size = 1
+        llama_cpp.llama_sampler_apply(self._sampler, ctypes.byref(self._single))
+        return self._one.logit != -math.inf
+
+    def _mask(self, logits: np.ndarray) -> np.ndarray:
+        """Logits with every token the grammar rejects at -inf."""
+        ids = self.grammar._ids
+        data = np.empty(len(ids), dtype=TOKEN_DATA_DTYPE)
+        data["id"] = ids
+        data["logit"] = logits[:len(ids)]
+        data["p"] = 0.0
+        candidates = llama_cpp.llama_token_data_array(
+            data=data.ctypes.data_as(llama_cpp.llama_token_data_p), size=len(ids), selected=-1, sorted=False
+        )
+        llama_cpp.llama_sampler_apply(self._sampler, ctypes.byref(candidates))
+        return data["logit"]
+
+    def __del__(self):
+        if getattr(self, "_sampler", None):
+            llama_cpp.llama_sampler_free(self._sampler)
+            self._sampler = None
+
+class GrammarCache:
+    """
+    LRU of compiled response_format grammars for one model.
+    
+    Entries are keyed by the hash of the JSON schema. A repeated schema
+    therefore skips both the schema-to-GBNF conversion and the llama.cpp
+    grammar parse.
+    """
+
+    def __init__(self, llm: Llama, capacity: int):
+        self.llm = llm
+        self.capacity = max(1, capacity)
+        self._grammars: "OrderedDict[str, CompiledGrammar]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.compile_seconds = 0.0
+
+    def get(self, response_format: Optional["ResponseFormat"]) -> Optional[CompiledGrammar]:
+        """The grammar a response_format asks for, or None for plain text."""
+        spec = self._spec(response_format)
+        if spec is None:
+            return None
+        return self._cached(spec[0]) or self._build(*spec)
+
+    async def get_async(self, response_format: Optional["ResponseFormat"]) -> Optional[CompiledGrammar]:
+        """get() for the event loop: hits return inline, misses compile in a thread."""
+        spec = self._spec(response_format)
+        if spec is None:
+            return None
+        return self._cached(spec[0]) or await asyncio.to_thread(self._build, *spec)
+
+    def compile(self, key: str, gbnf: str) -> CompiledGrammar:
+        """A grammar whose GBNF was already produced (by the API process, for a worker)."""
+        return self._cached(key) or self._build(key, lambda: gbnf)
+
+    @staticmethod
+    def _spec(response_format: Optional["ResponseFormat"]) -> Optional[Tuple[str, Callable[[], str]]]:
+        """Cache key and GBNF builder for a response_format, or None for plain text."""
+        if response_format is None or response_format.type == "text":
+            return None
+        if response_format.type == "json_object":
+            return "json_object", lambda: JSON_GBNF
+        # Property order is kept: it decides the order of the generated fields
+        schema = json.dumps(response_format.json_schema["schema"], separators=(",", ":"))
+        key = "json_schema:" + hashlib.sha256(schema.encode("utf-8")).hexdigest()
+        return key, lambda: json_schema_grammar(schema)
+
+    def _cached(self, key: str) -> Optional[CompiledGrammar]:
+        with self._lock:
+            grammar = self._grammars.get(key)
+            if grammar is not None:
+                self._grammars.move_to_end(key)
+                self.hits += 1
+            return grammar
+
+    def _build(self, key: str, build: Callable[[], str]) -> CompiledGrammar:
+        started = time.perf_counter()
+        try:
+            gbnf = build()
+        except Exception as e:
+            raise GrammarError(f"Unsupported response_format schema: {e}") from e
+        grammar = CompiledGrammar(key, gbnf, self.llm)
+        
+        with self._lock:
+            self.misses += 1
+            self.compile_seconds += time.perf_counter() - started
+            self._grammars[key] = grammar
+            self._grammars.move_to_end(key)
+            while len(self._grammars) > self.capacity:
+                self._grammars.popitem(last=False)
+                self.evictions += 1
+        return grammar
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "size": len(self._grammars),
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "compile_ms": round(self.compile_seconds * 1000, 3),
+            }
+
+# ============================================================================
+# CONTINUOUS BATCHING
+# ============================================================================
+
+def sample_token(logits: np.ndarray, temperature: float, top_p: float, rng: np.random.Generator) -> int:
+    """Sample a token id from raw logits with temperature and nucleus (top-p) filtering."""
+    if temperature <= 0.0:
+        return int(np.argmax(logits))
+    
+    scaled = logits.astype(np.float64) / temperature
+    scaled -= scaled.max()
+    probs = np.exp(scaled)
+    probs /= probs.sum()
+    
+    if top_p < 1.0:
+        order = np.argsort(probs)[::-1]
+        cumulative = np.cumsum(probs[order])
+        cutoff = int(np.searchsorted(cumulative, top_p)) + 1
+        keep = order[:cutoff]
+        kept = probs[keep]
+        return int(keep[rng.choice(len(keep), p=kept / kept.sum())])
+    
+    return int(rng.choice(len(probs), p=probs))
+
+class BatchSequence:
+    """One generation request occupying a sequence slot of the batch engine."""
+
+    def __init__(self, prompt_tokens: List[int], max_tokens: int, temperature: float,
+                 top_p: float, stop_tokens: List[str], index: int = 0,
+                 parent: Optional["BatchSequence"] = None, outbox: Optional["queue.Queue[tuple]"] = None,
+                 scored: bool = False, grammar: Optional[GrammarState] = None,
+                 cancel: Optional[Cancellation] = None):
+        self.prompt_tokens = prompt_tokens
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.stops = StopScanner(compile_stop_matcher(stop_tokens))
+        self.slot: Optional[int] = None
+        # Tokens already in the KV cache for this slot
+        self.n_past = 0
+        # Next token to feed (sampled but not yet decoded)
+        self.next_token: Optional[int] = None
+        self.generated: List[int] = []
+        self.completion_tokens = 0
+        # Visible text sent so far
+        self.text = ""
+        self.text_started = False
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        self.finish_reason: Optional[str] = None
+        # Set by the caller when its reader goes away; cancel is polled by the engine (deadlines)
+        self.cancelled = False
+        self.cancel = cancel
+        # perf_counter() at admission, first sampled token and release
+        self.admitted_at: Optional[float] = None
+        self.first_token_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        # Speculative decoding: draft tokens proposed and accepted for this sequence
+        self.draft_tokens = 0
+        self.accepted_tokens = 0
+        # Times the context was shifted to make room; shifted KV cells are never reused
+        self.shifts = 0
+        # Choice index within its request, and the sequence whose prompt KV it forks
+        self.index = index
+        self.parent = parent
+        # Summed log-probability of the sampled tokens, for best_of ranking
+        self.logprob: Optional[float] = 0.0 if scored else None
+        # response_format grammar this sequence is constrained to
+        self.grammar = grammar
+        # Events sent from the engine thread to the waiting caller, shared by a request's choices
+        self.outbox: "queue.Queue[tuple]" = outbox if outbox is not None else queue.Queue()
+
+    @property
+    def prefilling(self) -> bool:
+        return self.n_past < len(self.prompt_tokens)
+
+    @property
+    def resident_tokens(self) -> List[int]:
+        """Tokens currently held in this sequence's KV cells."""
+        return (self.prompt_tokens + self.generated)[:self.n_past]
+
+    @property
+    def context_tokens(self) -> List[int]:
+        """Prompt and every token sampled so far, including next_token."""
+        return self.prompt_tokens + self.generated
+
+    @property
+    def forkable(self) -> bool:
+        """Whether a held choice can take its slot: the parent's prompt KV is complete (or gone)."""
+        parent = self.parent
+        return parent is None or parent.finished_at is not None or (parent.slot is not None and not parent.prefilling)
+
+class BatchEngine:
+    """
+    Continuous batching over a single llama.cpp context.
+    
+    Every active request owns a sequence id in a shared KV cache. Each step
+    builds one llama_batch holding the pending prompt chunk or the last
+    sampled token of every active sequence, runs a single llama_decode, and
+    samples the next token per sequence. Requests join and leave between
+    steps, so a new request starts prefill without waiting for the others
+    to finish.
+    
+    Finished sequences leave their KV cells in place. A new request is
+    placed in the free slot sharing the longest prefix with its prompt, or
+    gets that prefix copied from another slot or the prefix cache, so
+    multi-turn chats and shared system prompts skip most of their prefill.
+    
+    With a drafter, every decoding sequence also feeds its draft tokens in
+    the same batch with logits on each position. Drafts are accepted while
+    they equal the token sampled at their position, so output is exactly
+    what plain decoding would sample, and the KV cells of rejected drafts
+    are dropped.
+    
+    A request for several choices (n, best_of) runs one sequence per choice.
+    The first prefills the prompt; the others are held back until it has,
+    then copy its prompt cells and sample independently in the same batches.
+    
+    A sequence with a grammar checks each sampled token against its own
+    grammar state (also for draft verification, which samples the same way).
+    """
+
+    def __init__(self, llm: Llama, n_slots: int, n_batch: int, n_ctx_per_slot: int, drafter=None,
+                 prefix_cache: Optional["PrefixCache"] = None):
+        from llama_cpp import _internals, llama_context_params
+
+        self.llm = llm
+        self.n_slots = n_slots
+        self.n_batch = n_batch
+        self.n_ctx_per_slot = n_ctx_per_slot
+        
+        params = llama_context_params.from_buffer_copy(llm.context_params)
+        params.n_ctx = n_ctx_per_slot * n_slots
+        params.n_batch = n_batch
+        params.n_ubatch = min(n_batch, params.n_ubatch or n_batch)
+        params.n_seq_max = n_slots
+        if hasattr(params, "kv_unified"):
+            params.kv_unified = True
+        
+        self._ctx = _internals.LlamaContext(model=llm._model, params=params, verbose=False)
+        self._batch = _internals.LlamaBatch(n_tokens=n_batch, embd=0, n_seq_max=n_slots, verbose=False)
+        self._n_vocab = llm.n_vocab()
+        
+        self._eog_tokens = end_of_generation_tokens(llm)
+        self.drafter = drafter
+        self.prefix_cache = prefix_cache
+        
+        self._rng = np.random.default_rng()
+        self._pending: "queue.Queue[Optional[BatchSequence]]" = queue.Queue()
+        self._free_slots = list(range(n_slots))
+        self._active: List[BatchSequence] = []
+        # Choices waiting for their parent's prefill
+        self._forks: List[BatchSequence] = []
+        # Tokens left in the KV cells of each free slot by its last sequence
+        self._retained: Dict[int, List[int]] = {}
+        self._shared_kv = bool(getattr(params, "kv_unified", False))
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+        
+        self._steps = 0
+        self._prompt_tokens = 0
+        self._reused_tokens = 0
+        self._batched_tokens = 0
+        self._generated_tokens = 0
+        self._decode_time = 0.0
+        self._draft_tokens = 0
+        self._accepted_tokens = 0
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="batch-engine", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        if not self._running:
+            return
+        self._running = False
+        self._pending.put(None)
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def generate(
+        self,
+        prompt: Union[str, List[int]],
+        max_tokens: int,
+        temperature: float,
+        top_p: float,
+        stop_tokens: List[str],
+        on_start=None,
+        on_text=None,
+        n: int = 1,
+        best_of: Optional[int] = None,
+        grammar: Optional[CompiledGrammar] = None,
+        cancel: Optional[Cancellation] = None,
+    ) -> Dict[str, Any]:
+        """
+        Run one generation through the batch and block until it finishes.
+        
+        Called from an inference worker thread. on_text receives each piece of
+        visible text and may return False to cancel the request. With several
+        choices it also receives the choice index. Once cancel is cancelled,
+        the request's sequences leave their slots at the next step.
+        """
+        if not self._running:
+            raise RuntimeError("Batch engine is not running")
+        
+        prompt_tokens = tokenize_prompt(self.llm, prompt)
+        if len(prompt_tokens) >= self.n_ctx_per_slot:
+            raise ValueError(
+                f"Requested tokens ({len(prompt_tokens)}) exceed context window of {self.n_ctx_per_slot}"
+            )
+        if on_start is not None:
+            on_start(len(prompt_tokens))
+        
+        sequences = max(n, best_of or n)
+        outbox: "queue.Queue[tuple]" = queue.Queue()
+        seqs: List[BatchSequence] = []
+        for index in range(sequences):
+            seqs.append(BatchSequence(prompt_tokens, max_tokens, temperature, top_p, stop_tokens, index=index,
+                                      parent=seqs[0] if seqs else None, outbox=outbox, scored=sequences > n,
+                                      grammar=grammar.state() if grammar is not None else None, cancel=cancel))
+        for seq in seqs:
+            self._pending.put(seq)
+        
+        results: Dict[int, Dict[str, Any]] = {}
+        while len(results) < sequences:
+            kind, index, payload = outbox.get()
+            if kind == "text":
+                if on_text is not None and (on_text(payload) if sequences == 1 else on_text(payload, index)) is False:
+                    for seq in seqs:
+                        seq.cancelled = True
+            elif kind == "error":
+                for seq in seqs:
+                    seq.cancelled = True
+                raise payload
+            else:
+                results[index] = self._result(seqs[index], payload, len(prompt_tokens))
+        
+        if sequences == 1:
+            return results[0]
+        timings = generation_timings(min(seq.admitted_at for seq in seqs),
+                                     min((seq.first_token_at for seq in seqs if seq.first_token_at is not None), default=None),
+                                     max(seq.finished_at for seq in seqs))
+        return merge_choices([results[index] for index in range(sequences)], n, timings)
+
+    @staticmethod
+    def _result(seq: BatchSequence, finish_reason: Optional[str], prompt_tokens: int) -> Dict[str, Any]:
+        # seq.prompt_tokens is rewritten by context shifts, so the caller passes the original length
+        result = {
+            "text": seq.text.strip(),
+            "finish_reason": finish_reason,
+            "stop_sequence": seq.stops.stop_sequence,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": seq.completion_tokens,
+            "total_tokens": prompt_tokens + seq.completion_tokens,
+            "draft_tokens": seq.draft_tokens,
+            "accepted_draft_tokens": seq.accepted_tokens,
+            "context_shifts": seq.shifts,
+            **generation_timings(seq.admitted_at, seq.first_token_at, seq.finished_at)
+        }
+        if seq.logprob is not None:
+            result["logprob"] = seq.logprob
+        return result
+
+    def _admit(self, block: bool) -> bool:
+        """Move pending requests into free slots. Returns False on shutdown."""
+        while self._free_slots:
+            seq = next((fork for fork in self._forks if fork.forkable), None)
+            if seq is not None:
+                self._forks.remove(seq)
+            else:
+                try:
+                    seq = self._pending.get(block=block)
+                except queue.Empty:
+                    return True
+                if seq is None:
+                    return False
+                block = False
+                if self._shared_kv and not seq.forkable:
+                    # Admitted once its parent's prompt is in the KV cache, which _assign_slot then copies
+                    self._forks.append(seq)
+                    continue
+            self._assign_slot(seq)
+            self._active.append(seq)
+        return True
+
+    def _assign_slot(self, seq: BatchSequence):
+        """Pick a slot for a new sequence and pre-populate it with the longest known prefix."""
+        prompt = seq.prompt_tokens
+        # At least one prompt token must be evaluated to get logits for the first sample
+        limit = len(prompt) - 1
+        
+        # Free slots are kept least recently used first, so ties evict the coldest prefix
+        slot, retained = self._free_slots[0], 0
+        for candidate in self._free_slots:
+            shared = common_prefix_length(self._retained.get(candidate, ()), prompt)
+            if shared > retained:
+                slot, retained = candidate, shared
+        self._free_slots.remove(slot)
+        self._retained.pop(slot, None)
+        retained = min(retained, limit)
+        
+        source, copied = None, retained
+        if self._shared_kv:
+            for other in self._active:
+                if other.shifts:
+                    continue
+                shared = min(common_prefix_length(other.resident_tokens, prompt), limit)
+                if shared > copied:
+                    source, copied = other.slot, shared
+            for other, tokens in self._retained.items():
+                shared = min(common_prefix_length(tokens, prompt), limit)
+                if shared > copied:
+                    source, copied = other, shared
+        
+        cached, state = 0, None
+        prefix_cache = self.prefix_cache
+        if prefix_cache is not None:
+            cached, _, state = prefix_cache.lookup(prompt)
+            cached = min(cached, limit)
+        
+        if state is not None and cached > max(retained, copied):
+            self._ctx.kv_cache_seq_rm(slot, -1, -1)
+            if set_sequence_state(self._ctx.ctx, slot, state):
+                self._ctx.kv_cache_seq_rm(slot, cached, -1)
+                prefix_cache.record_reuse(cached)
+                reused = cached
+            else:
+                self._ctx.kv_cache_seq_rm(slot, -1, -1)
+                reused = 0
+        elif source is not None:
+            self._ctx.kv_cache_seq_rm(slot, -1, -1)
+            self._ctx.kv_cache_seq_cp(source, slot, 0, copied)
+            reused = copied
+        else:
+            self._ctx.kv_cache_seq_rm(slot, retained, -1)
+            reused = retained
+        
+        seq.slot = slot
+        seq.n_past = reused
+        seq.admitted_at = time.perf_counter()
+        self._prompt_tokens += len(prompt)
+        self._reused_tokens += reused
+
+    def _release(self, seq: BatchSequence, finish_reason: Optional[str], error: Optional[BaseException] = None):
+        seq.finished_at = time.perf_counter()
+        self._active.remove(seq)
+        if error is not None or seq.shifts:
+            # Shifted cells were computed with context that is gone: only an exact prefix may be reused
+            self._ctx.kv_cache_seq_rm(seq.slot, -1, -1)
+        else:
+            resident = seq.resident_tokens
+            self._retained[seq.slot] = resident
+            prefix_cache = self.prefix_cache
+            if prefix_cache is not None and len(resident) >= prefix_cache.min_tokens:
+                prefix_cache.store(resident, get_sequence_state(self._ctx.ctx, seq.slot))
+        self._free_slots.append(seq.slot)
+        if error is not None:
+            seq.outbox.put(("error", seq.index, error))
+        else:
+            seq.outbox.put(("done", seq.index, finish_reason))
+
+    def _emit(self, seq: BatchSequence, piece: str) -> Optional[str]:
+        """Send decoded text, holding back only what may still begin a stop sequence."""
+        self._send(seq, seq.stops.feed(piece))
+        return "stop" if seq.stops.stop_sequence is not None else None
+
+    def _flush(self, seq: BatchSequence):
+        """Emit the held-back tail once the sequence ends without a stop match."""
+        self._send(seq, seq.stops.flush())
+
+    def _send(self, seq: BatchSequence, visible: str):
+        # Match the non-streaming path, which strips leading whitespace
+        if not seq.text_started:
+            visible = visible.lstrip()
+            seq.text_started = bool(visible)
+        if not visible:
+            return
+        seq.text += visible
+        seq.outbox.put(("text", seq.index, visible))
+
+    def _step(self):
+        """Build and decode one batch, then sample for every sequence that produced logits."""
+        self._batch.reset()
+        batch = self._batch.batch
+        sampling = []
+        budget = self.n_batch
+        
+        ready = []
+        for seq in list(self._active):
+            if seq.cancelled or (seq.cancel is not None and seq.cancel.cancelled):
+                self._release(seq, None)
+                continue
+            # Backpressure: a reader that has not drained its buffer skips this step
+            if seq.outbox.qsize() >= STREAM_BUFFER_SIZE:
+                continue
+            ready.append(seq)
+        
+        drafts: Dict[int, List[int]] = {}
+        if self.drafter is not None:
+            decoding = [seq for seq in ready if not seq.prefilling]
+            if decoding:
+                drafts = self.drafter.propose(decoding)
+        
+        for seq in ready:
+            if budget <= 0:
+                break
+            
+            draft: List[int] = []
+            if seq.prefilling:
+                chunk = seq.prompt_tokens[seq.n_past:seq.n_past + budget]
+            else:
+                # Leave room for the token sampled after the last draft
+                limit = min(
+                    budget - 1,
+                    seq.max_tokens - seq.completion_tokens - 1,
+                    self.n_ctx_per_slot - seq.n_past - 2,
+                )
+                draft = drafts.get(seq.slot, [])[:max(0, limit)]
+                chunk = [seq.next_token] + draft
+            
+            for offset, token in enumerate(chunk):
+                i = batch.n_tokens
+                batch.token[i] = token
+                batch.pos[i] = seq.n_past + offset
+                batch.n_seq_id[i] = 1
+                batch.seq_id[i][0] = seq.slot
+                batch.logits[i] = bool(draft)
+                batch.n_tokens += 1
+            seq.n_past += len(chunk)
+            budget -= len(chunk)
+            
+            if not seq.prefilling:
+                batch.logits[batch.n_tokens - 1] = True
+                sampling.append((seq, batch.n_tokens - 1 - len(draft), draft))
+        
+        if batch.n_tokens == 0:
+            return
+        
+        started = time.perf_counter()
+        self._ctx.decode(self._batch)
+        self._decode_time += time.perf_counter() - started
+        self._steps += 1
+        self._batched_tokens += batch.n_tokens
+        
+        for seq, index, draft in sampling:
+            # Draft positions only count once their draft token is accepted
+            seq.n_past -= len(draft)
+            accepted = 0
+            finish_reason = None
+            for offset in range(len(draft) + 1):
+                logits = np.ctypeslib.as_array(self._ctx.get_logits_ith(index + offset), shape=(self._n_vocab,))
+                token = sample_token(logits, seq.temperature, seq.top_p, self._rng)
+                if seq.grammar is not None:
+                    token = seq.grammar.constrain(token, logits, seq.temperature, seq.top_p, self._rng)
+                if seq.logprob is not None and token not in self._eog_tokens:
+                    seq.logprob += token_logprob(logits, token)
+                self._generated_tokens += 1
+                if seq.first_token_at is None:
+                    seq.first_token_at = time.perf_counter()
+                
+                finish_reason = self._advance(seq, token)
+                if finish_reason is not None or offset == len(draft) or token != draft[offset]:
+                    break
+                accepted += 1
+                seq.n_past += 1
+            
+            if draft:
+                seq.draft_tokens += len(draft)
+                seq.accepted_tokens += accepted
+                self._draft_tokens += len(draft)
+                self._accepted_tokens += accepted
+                if accepted < len(draft):
+                    self._ctx.kv_cache_seq_rm(seq.slot, seq.n_past, -1)
+            if finish_reason is not None:
+                self._release(seq, finish_reason)
+
+    def _advance(self, seq: BatchSequence, token: int) -> Optional[str]:
+        """Apply one sampled token to a sequence. Returns a finish reason once it is done."""
+        if token in self._eog_tokens:
+            self._flush(seq)
+            return "stop"
+        seq.completion_tokens += 1
+        
+        piece = seq.decoder.decode(self.llm.detokenize([token]))
+        if self._emit(seq, piece) == "stop":
+            return "stop"
+        if seq.completion_tokens >= seq.max_tokens or (
+                seq.n_past + 1 >= self.n_ctx_per_slot and not self._shift(seq)):
+            self._flush(seq)
+            return "length"
+        seq.next_token = token
+        seq.generated.append(token)
+        return None
+
+    def _shift(self, seq: BatchSequence) -> bool:
+        """
+        Make room in a full slot by discarding the older half of its context.
+        
+        The first CONTEXT_SHIFT_KEEP tokens (BOS and the start of the system
+        prompt) stay; the cells after the discarded span, including pending
+        draft cells, move down so decoding continues without a new prefill.
+        """
+        n_keep = min(CONTEXT_SHIFT_KEEP, len(seq.prompt_tokens), self.n_ctx_per_slot // 2)
+        n_discard = (seq.n_past - n_keep) // 2
+        if not CONTEXT_SHIFT or n_discard <= 0:
+            return False
+        self._ctx.kv_cache_seq_rm(seq.slot, n_keep, n_keep + n_discard)
+        self._ctx.kv_cache_seq_shift(seq.slot, n_keep + n_discard, -1, -n_discard)
+        resident = seq.resident_tokens
+        seq.prompt_tokens = resident[:n_keep] + resident[n_keep + n_discard:]
+        seq.generated = []
+        seq.n_past -= n_discard
+        seq.shifts += 1
+        return True
+
+    def _run(self):
+        while self._running:
+            if not self._admit(block=not self._active):
+                break
+            try:
+                self._step()
+            except Exception as e:
+                # A failed decode leaves the KV cache in an unknown state: fail the batch
+                for seq in list(self._active):
+                    self._release(seq, None, error=e)
+            if self._active and not any(seq.outbox.qsize() < STREAM_BUFFER_SIZE for seq in self._active):
+                # Every reader is behind; yield instead of spinning
+                time.sleep(0.001)
+        
+        for seq in list(self._active):
+            self._release(seq, None, error=RuntimeError("Batch engine stopped"))
+        for seq in self._forks:
+            seq.outbox.put(("error", seq.index, RuntimeError("Batch engine stopped")))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "slots": self.n_slots,
+            "active": len(self._active),
+            "pending": self._pending.qsize() + len(self._forks),
+            "steps": self._steps,
+            "generated_tokens": self._generated_tokens,
+            "prompt_tokens": self._prompt_tokens,
+            "prefix_reused_tokens": self._reused_tokens,
+            "avg_batch_tokens": round(self._batched_tokens / self._steps, 2) if self._steps else 0.0,
+            "tokens_per_second": round(self._generated_tokens / self._decode_time, 2) if self._decode_time else 0.0,
+            "speculative": self.drafter.name if self.drafter is not None else None,
+            "draft_tokens": self._draft_tokens,
+            "accepted_draft_tokens": self._accepted_tokens,
+            "acceptance_rate": round(self._accepted_tokens / self._draft_tokens, 4) if self._draft_tokens else 0.0,
+        }
+
+# ============================================================================
+# SPECULATIVE DECODING
+# ============================================================================
+
+class PromptLookupDrafter:
+    """
+    Drafts by prompt lookup: finds the latest n-gram of a sequence earlier in
+    its own context and proposes the tokens that followed it. Costs no model
+    evaluation and pays off when the output copies from the prompt
+    (extraction, summarization, code edits).
+    """
+
+    name = "prompt-lookup"
+
+    def __init__(self, n_draft: int, max_ngram_size: int):
+        from llama_cpp.llama_speculative import LlamaPromptLookupDecoding
+        self._lookup = LlamaPromptLookupDecoding(max_ngram_size=max_ngram_size, num_pred_tokens=n_draft)
+
+    def propose(self, seqs: List[BatchSequence]) -> Dict[int, List[int]]:
+        drafts = {}
+        for seq in seqs:
+            draft = self._lookup(np.asarray(seq.context_tokens, dtype=np.intc))
+            if len(draft):
+                drafts[seq.slot] = draft.tolist()
+        return drafts
+
+class DraftModelDrafter:
+    """
+    Drafts greedily with a smaller GGUF that shares the target's vocabulary.
+    
+    Keeps one sequence per batch slot in its own context, so each step only
+    evaluates the tokens a sequence gained since its last draft, and drafts
+    for every decoding sequence in the same batched forward passes.
+    """
+
+    name = "draft"
+
+    def __init__(self, model_path: str, target: Llama, n_slots: int, n_ctx_per_slot: int,
+                 n_batch: int, n_draft: int, n_threads: int):
+        from llama_cpp import _internals, llama_context_params
+
+        # The Llama wrapper's own context is unused; keep it tiny
+        self.llm = Llama(model_path=model_path, n_ctx=64, n_batch=64, n_threads=n_threads,
+                         n_threads_batch=n_threads, n_gpu_layers=0, verbose=False)
+        if self.llm.n_vocab() != target.n_vocab():
+            raise ValueError(
+                f"Draft model vocabulary ({self.llm.n_vocab()}) does not match the target ({target.n_vocab()})"
+            )
+        self.n_draft = n_draft
+        self.n_batch = n_batch
+        self.n_ctx_per_slot = n_ctx_per_slot
+        
+        params = llama_context_params.from_buffer_copy(self.llm.context_params)
+        params.n_ctx = n_ctx_per_slot * n_slots
+        params.n_batch = n_batch
+        params.n_ubatch = min(n_batch, params.n_ubatch or n_batch)
+        params.n_seq_max = n_slots
+        if hasattr(params, "kv_unified"):
+            params.kv_unified = True
+        self._ctx = _internals.LlamaContext(model=self.llm._model, params=params, verbose=False)
+        self._batch = _internals.LlamaBatch(n_tokens=n_batch, embd=0, n_seq_max=n_slots, verbose=False)
+        self._n_vocab = self.llm.n_vocab()
+        # Tokens held in the draft KV cells of each slot
+        self._resident: Dict[int, List[int]] = {}
+
+    def _decode(self, items: List[Tuple[int, int, int, bool]]) -> Dict[Tuple[int, int], int]:
+        """Decode (slot, position, token, want_logits) items; returns batch index per (slot, position)."""
+        self._batch.reset()
+        batch = self._batch.batch
+        indices = {}
+        for slot, position, token, want_logits in items:
+            i = batch.n_tokens
+            batch.token[i] = token
+            batch.pos[i] = position
+            batch.n_seq_id[i] = 1
+            batch.seq_id[i][0] = slot
+            batch.logits[i] = want_logits
+            batch.n_tokens += 1
+            if want_logits:
+                indices[(slot, position)] = i
+        self._ctx.decode(self._batch)
+        return indices
+
+    def _greedy(self, index: int) -> int:
+        logits = np.ctypeslib.as_array(self._ctx.get_logits_ith(index), shape=(self._n_vocab,))
+        return int(np.argmax(logits))
+
+    def propose(self, seqs: List[BatchSequence]) -> Dict[int, List[int]]:
+        # Catch each slot's draft KV up to its context, one token short so the last one yields logits
+        pending: List[Tuple[int, int, int, bool]] = []
+        last: Dict[int, int] = {}
+        for seq in seqs:
+            context = seq.context_tokens
+            if len(context) + self.n_draft >= self.n_ctx_per_slot:
+                continue
+            resident = self._resident.get(seq.slot, [])
+            shared = min(common_prefix_length(resident, context), len(context) - 1)
+            self._ctx.kv_cache_seq_rm(seq.slot, shared, -1)
+            for position in range(shared, len(context)):
+                pending.append((seq.slot, position, context[position], position == len(context) - 1))
+            self._resident[seq.slot] = context
+            last[seq.slot] = len(context) - 1
+        
+        indices: Dict[Tuple[int, int], int] = {}
+        for start in range(0, len(pending), self.n_batch):
+            chunk_indices = self._decode(pending[start:start + self.n_batch])
+            if start + self.n_batch >= len(pending):
+                indices = chunk_indices
+        
+        drafts: Dict[int, List[int]] = {slot: [] for slot in last}
+        for step in range(self.n_draft):
+            for slot, position in last.items():
+                drafts[slot].append(self._greedy(indices[(slot, position)]))
+            if step == self.n_draft - 1:
+                break
+            items = [(slot, position + 1, drafts[slot][-1], True) for slot, position in last.items()]
+            indices = self._decode(items)
+            for slot in last:
+                last[slot] += 1
+                self._resident[slot] = self._resident[slot] + [drafts[slot][-1]]
+        return drafts
+
+def create_drafter(llm: Llama, n_slots: int, n_ctx_per_slot: int, n_threads: int):
+    """Drafter for the configured SPECULATIVE mode, or None when it is off."""
+    if SPECULATIVE in ("", "off", "none"):
+        return None
+    if SPECULATIVE == "prompt-lookup":
+        return PromptLookupDrafter(SPECULATIVE_DRAFT_TOKENS, SPECULATIVE_NGRAM_SIZE)
+    if SPECULATIVE == "draft":
+        if not DRAFT_MODEL_PATH:
+            raise ValueError("SPECULATIVE=draft needs DRAFT_MODEL_PATH")
+        return DraftModelDrafter(DRAFT_MODEL_PATH, llm, n_slots, n_ctx_per_slot, BATCH_SIZE,
+                                 SPECULATIVE_DRAFT_TOKENS, n_threads)
+    raise ValueError(f"Unknown SPECULATIVE mode {SPECULATIVE!r}; use off, prompt-lookup or draft")
+
+# ============================================================================
+# WORKER PROCESS POOL
+# ============================================================================
+
+def parse_cpu_sets(spec: str) -> List[List[int]]:
+    """Parse "0-7;8-15"-style core sets into lists of CPU ids."""
+    cpu_sets = []
+    for group in filter(None, (part.strip() for part in spec.split(";"))):
+        cpus = []
+        for item in group.split(","):
+            if "-" in item:
+                start, end = item.split("-", 1)
+                cpus.extend(range(int(start), int(end) + 1))
+            elif item.strip():
+                cpus.append(int(item))
+        cpu_sets.append(cpus)
+    return cpu_sets
+
+def split_cpus(cpus: List[int], n_workers: int) -> List[List[int]]:
+    """Split CPUs into n contiguous, near-equal core sets."""
+    if len(cpus) < n_workers:
+        return [cpus] * n_workers
+    size, extra = divmod(len(cpus), n_workers)
+    cpu_sets, start = [], 0
+    for i in range(n_workers):
+        end = start + size + (1 if i < extra else 0)
+        cpu_sets.append(cpus[start:end])
+        start = end
+    return cpu_sets
+
+class PipeStream:
+    """TokenStream stand-in inside a worker process that forwards text to the API process."""
+
+    def __init__(self, send, request_id: int):
+        self._send = send
+        self.request_id = request_id
+        self.cancelled = threading.Event()
+        self._prompt_tokens: Optional[int] = None
+
+    @property
+    def prompt_tokens(self) -> Optional[int]:
+        return self._prompt_tokens
+
+    @prompt_tokens.setter
+    def prompt_tokens(self, value: int):
+        self._prompt_tokens = value
+        self._send(("start", self.request_id, value))
+
+    def put(self, text: str, index: Optional[int] = None) -> bool:
+        if self.cancelled.is_set():
+            return False
+        # The same arguments are replayed into the API process's on_text
+        self._send(("text", self.request_id, (text,) if index is None else (text, index)))
+        return not self.cancelled.is_set()
+
+def worker_process_main(conn, worker_id: int, cpus: List[int], model_path: str):
+    """
+    Entry point of an inference worker process.
+    
+    Pins itself to its core set, loads the model (the GGUF is mmap'd, so the
+    weight pages are shared with the other workers through the page cache)
+    and serves generate/cancel messages from the API process.
+    """
+    global WORKER_PROCESSES, N_THREADS
+    configure_logging()
+    if cpus and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    WORKER_PROCESSES = 0
+    N_THREADS = N_THREADS or len(available_cpus())
+    runtime = ModelRuntime(os.path.basename(model_path), model_path)
+    runtime.load()
+    
+    send_lock = threading.Lock()
+    
+    def send(message):
+        with send_lock:
+            conn.send(message)
+    
+    streams: Dict[int, PipeStream] = {}
+    # Deadlines arrive as seconds left, so clocks of the two processes never meet
+    cancels: Dict[int, Cancellation] = {}
+    jobs: "queue.Queue[Optional[int]]" = queue.Queue()
+    requests: Dict[int, Dict[str, Any]] = {}
+    
+    def serve():
+        while True:
+            request_id = jobs.get()
+            if request_id is None:
+                return
+            kwargs = requests.pop(request_id)
+            kwargs["cancel"] = cancels[request_id]
+            try:
+                if "grammar" in kwargs:
+                    kwargs["grammar"] = runtime.grammars.compile(*kwargs["grammar"])
+                if kwargs.pop("stream"):
+                    result = generate_response_stream(runtime, token_stream=streams[request_id], **kwargs)
+                else:
+                    result = generate_response(runtime, **kwargs)
+            except Exception as e:
+                message = ("error", request_id, f"{type(e).__name__}: {e}")
+            else:
+                message = ("done", request_id, result)
+            finally:
+                streams.pop(request_id, None)
+                cancels.pop(request_id, None)
+            # Counters recorded here (such as cancellations) reach /metrics before the result does
+            counters = metrics.drain()
+            if counters:
+                send(("metrics", request_id, counters))
+            send(message)
+    
+    threads = [threading.Thread(target=serve, daemon=True) for _ in range(max(1, BATCH_SEQ_SLOTS))]
+    for thread in threads:
+        thread.start()
+    send(("ready", worker_id, {"pid": os.getpid(), "cpus": cpus, "n_threads": N_THREADS, "startup": runtime.startup}))
+    
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        kind = message[0]
+        if kind == "generate":
+            _, request_id, kwargs = message
+            timeout = kwargs.pop("timeout", None)
+            streams[request_id] = PipeStream(send, request_id)
+            cancels[request_id] = Cancellation(time.perf_counter() + timeout if timeout is not None else None)
+            requests[request_id] = kwargs
+            jobs.put(request_id)
+        elif kind == "cancel":
+            _, request_id, reason = message
+            # The reason goes first: a stopped stream would otherwise be counted as a disconnect
+            cancel = cancels.get(request_id)
+            if cancel is not None:
+                cancel.cancel(reason)
+            stream = streams.get(request_id)
+            if stream is not None:
+                stream.cancelled.set()
+        elif kind == "stop":
+            break
+    
+    for _ in threads:
+        jobs.put(None)
+    if runtime.batch_engine is not None:
+        runtime.batch_engine.stop()
+
+class WorkerHandle:
+    """API-process side of one inference worker process."""
+
+    def __init__(self, worker_id: int, cpus: List[int]):
+        self.worker_id = worker_id
+        self.cpus = cpus
+        self.process = None
+        self.conn = None
+        self.info: Dict[str, Any] = {}
+        self.alive = False
+        self.outstanding_tokens = 0
+        self.completed = 0
+        self.send_lock = threading.Lock()
+        # request id -> (estimated cost, event queue)
+        self.pending: Dict[int, Tuple[int, "queue.Queue[tuple]"]] = {}
+
+    def send(self, message):
+        with self.send_lock:
+            self.conn.send(message)
+
+class WorkerPool:
+    """
+    Routes generations to model processes pinned to disjoint core sets.
+    
+    Each process runs its own Llama with n_threads sized from its affinity
+    mask, so workers never compete for cores. Requests go to the live worker
+    with the fewest outstanding tokens (estimated prompt tokens + max_tokens).
+    """
+
+    def __init__(self, n_workers: int, cpu_sets: Optional[List[List[int]]], model_path: str):
+        cpu_sets = cpu_sets or split_cpus(available_cpus(), n_workers)
+        if len(cpu_sets) < n_workers:
+            raise ValueError(f"WORKER_CPU_SETS lists {len(cpu_sets)} core sets for {n_workers} workers")
+        self.workers = [WorkerHandle(i, cpu_sets[i]) for i in range(n_workers)]
+        self.model_path = model_path
+        self._lock = threading.Lock()
+        self._next_id = 0
+
+    def start(self, timeout: float = 300.0):
+        """Spawn the worker processes and wait until every model is loaded."""
+        context = multiprocessing.get_context("spawn")
+        for worker in self.workers:
+            parent_conn, child_conn = context.Pipe()
+            worker.conn = parent_conn
+            worker.process = context.Process(
+                target=worker_process_main,
+                args=(child_conn, worker.worker_id, worker.cpus, self.model_path),
+                name=f"inference-process-{worker.worker_id}",
+                daemon=True,
+            )
+            worker.process.start()
+            child_conn.close()
+        
+        for worker in self.workers:
+            if not worker.conn.poll(timeout):
+                raise RuntimeError(f"Worker {worker.worker_id} did not become ready within {timeout}s")
+            kind, _, info = worker.conn.recv()
+            if kind != "ready":
+                raise RuntimeError(f"Worker {worker.worker_id} failed to start")
+            worker.info = info
+            worker.alive = True
+            threading.Thread(target=self._read, args=(worker,), name=f"worker-reader-{worker.worker_id}", daemon=True).start()
+
+    def stop(self, timeout: float = 10.0):
+        for worker in self.workers:
+            if worker.alive:
+                try:
+                    worker.send(("stop",))
+                except OSError:
+                    pass
+        for worker in self.workers:
+            if worker.process is not None:
+                worker.process.join(timeout)
+                if worker.process.is_alive():
+                    worker.process.terminate()
+
+    @property
+    def ready(self) -> bool:
+        return any(worker.alive for worker in self.workers)
+
+    def _read(self, worker: WorkerHandle):
+        """Dispatch messages from one worker process to the waiting requests."""
+        while True:
+            try:
+                kind, request_id, payload = worker.conn.recv()
+            except (EOFError, OSError):
+                break
+            if kind == "metrics":
+                metrics.merge(payload)
+                continue
+            with self._lock:
+                entry = worker.pending.get(request_id)
+            if entry is not None:
+                entry[1].put((kind, payload))
+        
+        worker.alive = False
+        with self._lock:
+            pending = list(worker.pending.values())
+        for _, events in pending:
+            events.put(("error", f"Worker process {worker.worker_id} exited"))
+
+    def generate(
+        self,
+        prompt: Union[str, List[int]],
+        max_tokens: int,
+        temperature: float,
+        top_p: float,
+        stop_tokens: List[str],
+        on_start=None,
+        on_text=None,
+        n: int = 1,
+        best_of: Optional[int] = None,
+        grammar: Optional[CompiledGrammar] = None,
+        cancel: Optional[Cancellation] = None,
+    ) -> Dict[str, Any]:
+        """
+        Run one generation on the least loaded worker and block until it finishes.
+        
+        The worker enforces cancel's deadline itself and is told to stop when
+        cancel is cancelled here.
+        """
+        # Text prompts only get a rough token estimate
+        cost = (len(prompt) // 4 if isinstance(prompt, str) else len(prompt)) + max_tokens * max(n, best_of or n)
+        events: "queue.Queue[tuple]" = queue.Queue()
+        
+        with self._lock:
+            live = [worker for worker in self.workers if worker.alive]
+            if not live:
+                raise RuntimeError("No inference workers available")
+            worker = min(live, key=lambda w: w.outstanding_tokens)
+            self._next_id += 1
+            request_id = self._next_id
+            worker.pending[request_id] = (cost, events)
+            worker.outstanding_tokens += cost
+        
+        kwargs = {
+            "prompt": prompt,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "top_p": top_p,
+            "stop_tokens": stop_tokens,
+            "n": n,
+            "stream": on_text is not None,
+        }
+        if best_of is not None:
+            # Only non-streaming generations rank candidates
+            kwargs["best_of"] = best_of
+        if grammar is not None:
+            # The worker compiles (and caches) the GBNF converted here against its own model
+            kwargs["grammar"] = (grammar.key, grammar.gbnf)
+        if cancel is not None and cancel.deadline is not None:
+            kwargs["timeout"] = cancel.remaining()
+        try:
+            worker.send(("generate", request_id, kwargs))
+            if cancel is not None:
+                cancel.add_callback(lambda: self._cancel(worker, request_id, cancel.reason))
+            cancelled = False
+            while True:
+                kind, payload = events.get()
+                if kind == "start":
+                    if on_start is not None:
+                        on_start(payload)
+                elif kind == "text":
+                    if not cancelled and on_text is not None and on_text(*payload) is False:
+                        cancelled = True
+                        worker.send(("cancel", request_id, "disconnect"))
+                elif kind == "error":
+                    raise RuntimeError(payload)
+                else:
+                    payload.pop("cancelled", None)
+                    return payload
+        finally:
+            with self._lock:
+                worker.pending.pop(request_id, None)
+                worker.outstanding_tokens -= cost
+                worker.completed += 1
+
+    def _cancel(self, worker: WorkerHandle, request_id: int, reason: str):
+        with self._lock:
+            if request_id not in worker.pending:
+                return
+        try:
+            worker.send(("cancel", request_id, reason))
+        except OSError:
+            # The worker is gone; its reader fails the request
+            pass
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "workers": [
+                    {
+                        "id": worker.worker_id,
+                        "pid": worker.info.get("pid"),
+                        "cpus": worker.cpus,
+                        "n_threads": worker.info.get("n_threads"),
+                        "startup": worker.info.get("startup"),
+                        "alive": worker.alive,
+                        "in_flight": len(worker.pending),
+                        "outstanding_tokens": worker.outstanding_tokens,
+                        "completed": worker.completed,
+                    }
+                    for worker in self.workers
+                ]
+            }
+
+# ============================================================================
+# EMBEDDINGS
+# ============================================================================
+
+class EmbeddingEngine:
+    """
+    Mean-pooled, L2-normalized embeddings from a dedicated llama.cpp context.
+    
+    The context is created with embeddings on and llama.cpp pooling off, on
+    the runtime's already loaded weights (or, with worker processes, on the
+    file mapped once more in this process). Inputs are packed into groups of
+    up to n_batch tokens and max_seqs sequences, and each group is evaluated
+    in a single llama_decode with every token marked as an output. The
+    per-token hidden states are then pooled per sequence with one NumPy
+    reduceat, so pooling costs no Python loop over tokens.
+    """
+
+    def __init__(self, runtime: "ModelRuntime", n_batch: int, max_seqs: int):
+        from llama_cpp import _internals, llama_context_params
+
+        self.n_batch = n_batch
+        self.max_seqs = max_seqs
+        self._llm = None
+        if runtime.model is not None:
+            base_params = runtime.model.context_params
+            model = runtime.model._model
+        else:
+            # Worker processes hold the generating models; this one only embeds
+            self._llm = Llama(model_path=runtime.path, n_ctx=8, n_batch=8, n_threads=N_THREADS or len(available_cpus()),
+                              verbose=False, use_mmap=True)
+            base_params = self._llm.context_params
+            model = self._llm._model
+        
+        params = llama_context_params.from_buffer_copy(base_params)
+        params.n_ctx = n_batch
+        params.n_batch = n_batch
+        # Non-causal encoders need each sequence inside one micro-batch
+        params.n_ubatch = n_batch
+        params.n_seq_max = max_seqs
+        params.embeddings = True
+        params.pooling_type = llama_cpp.LLAMA_POOLING_TYPE_NONE
+        if hasattr(params, "kv_unified"):
+            params.kv_unified = True
+        self._ctx = _internals.LlamaContext(model=model, params=params, verbose=False)
+        self._batch = _internals.LlamaBatch(n_tokens=n_batch, embd=0, n_seq_max=max_seqs, verbose=False)
+        self.n_embd = llama_cpp.llama_model_n_embd(model.model)
+        self._lock = threading.Lock()
+        
+        self.inputs = 0
+        self.tokens = 0
+        self.passes = 0
+        self.decode_seconds = 0.0
+
+    def close(self):
+        self._batch.close()
+        self._ctx.close()
+        if self._llm is not None:
+            self._llm.close()
+
+    def groups(self, inputs: List[List[int]]) -> List[List[int]]:
+        """Indices of inputs packed, in order, into groups that fit one batched pass."""
+        groups: List[List[int]] = []
+        tokens = 0
+        for i, item in enumerate(inputs):
+            if not groups or tokens + len(item) > self.n_batch or len(groups[-1]) >= self.max_seqs:
+                groups.append([])
+                tokens = 0
+            groups[-1].append(i)
+            tokens += len(item)
+        return groups
+
+    def embed(self, inputs: List[List[int]], cancel: Optional[Cancellation] = None) -> np.ndarray:
+        """
+        Embed token sequences of at most n_batch tokens each.
+        
+        Returns:
+            float32 array of shape (len(inputs), n_embd), one unit-length row per input
+        
+        Raises:
+            RequestCancelled: cancel was cancelled between two passes
+        """
+        vectors = np.empty((len(inputs), self.n_embd), dtype=np.float32)
+        with self._lock:
+            groups = self.groups(inputs)
+            for number, group in enumerate(groups):
+                if cancel is not None and cancel.cancelled:
+                    record_cancellation(cancel.reason, sum(len(inputs[i]) for rest in groups[number:] for i in rest))
+                    raise RequestCancelled(cancel.reason)
+                self._batch.reset()
+                batch = self._batch.batch
+                lengths = np.empty(len(group), dtype=np.intp)
+                for seq_id, index in enumerate(group):
+                    tokens = inputs[index]
+                    start = batch.n_tokens
+                    for pos, token in enumerate(tokens):
+                        batch.token[start + pos] = token
+                        batch.pos[start + pos] = pos
+                        batch.n_seq_id[start + pos] = 1
+                        batch.seq_id[start + pos][0] = seq_id
+                        batch.logits[start + pos] = True
+                    batch.n_tokens += len(tokens)
+                    lengths[seq_id] = len(tokens)
+                
+                started = time.perf_counter()
+                self._ctx.kv_cache_clear()
+                self._ctx.decode(self._batch)
+                self.decode_seconds += time.perf_counter() - started
+                
+                hidden = np.ctypeslib.as_array(self._ctx.get_embeddings(), shape=(batch.n_tokens, self.n_embd))
+                starts = np.concatenate(([0], np.cumsum(lengths[:-1])))
+                vectors[group] = np.add.reduceat(hidden, starts, axis=0) / lengths[:, None]
+                self.passes += 1
+            self.inputs += len(inputs)
+            self.tokens += sum(len(item) for item in inputs)
+        
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors /= np.maximum(norms, 1e-12)
+        return vectors
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "n_embd": self.n_embd,
+            "batch_tokens": self.n_batch,
+            "max_seqs": self.max_seqs,
+            "inputs": self.inputs,
+            "tokens": self.tokens,
+            "passes": self.passes,
+            "decode_seconds": round(self.decode_seconds, 4),
+        }
+
+def tokenize_embedding_inputs(runtime: "ModelRuntime", inputs: List[Union[str, List[int]]]) -> List[List[int]]:
+    """
+    Token ids for each embedding input; token arrays are passed through.
+    
+    Raises:
+        ContextLengthExceeded: An input is empty or longer than EMBEDDING_BATCH_SIZE tokens
+    """
+    llm = runtime.chat_renderer.llm
+    sequences = []
+    for i, item in enumerate(inputs):
+        tokens = llm.tokenize(item.encode("utf-8"), add_bos=True, special=False) if isinstance(item, str) else item
+        if not tokens:
+            raise ContextLengthExceeded(f"input[{i}] is empty")
+        if len(tokens) > EMBEDDING_BATCH_SIZE:
+            raise ContextLengthExceeded(
+                f"input[{i}] is {len(tokens)} tokens; at most {EMBEDDING_BATCH_SIZE} can be embedded"
+            )
+        sequences.append(tokens)
+    return sequences
+
+def embed_inputs(runtime: "ModelRuntime", inputs: List[Union[str, List[int]]],
+                 cancel: Optional[Cancellation] = None) -> Tuple[np.ndarray, int]:
+    """
+    Tokenize and embed inputs on an inference worker, stopping between passes once cancel is cancelled.
+    
+    Returns:
+        Tuple of (float32 vectors, one row per input; total input tokens)
+    """
+    with runtime_lease(runtime):
+        sequences = tokenize_embedding_inputs(runtime, inputs)
+        return runtime.embedding_engine().embed(sequences, cancel), sum(len(tokens) for tokens in sequences)
+
+# ============================================================================
+# MODEL REGISTRY
+# ============================================================================
+
+def resolve_model_file(path: str) -> str:
+    """Absolute path of a GGUF under MODEL_DIR; raises ValueError for anything else."""
+    root = os.path.realpath(MODEL_DIR)
+    resolved = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, resolved]) != root:
+        raise ValueError(f"Model path must be inside MODEL_DIR ({MODEL_DIR})")
+    if not resolved.endswith(".gguf") or not os.path.isfile(resolved):
+        raise ValueError(f"No GGUF file at {path}")
+    return resolved
+
+class ModelRegistry:
+    """
+    Named GGUF models loaded side by side and routed by the request's model field.
+    
+    Names that are not registered (including the display names clients
+    already send) go to the default model. load() builds a new runtime in
+    the background and swaps it in once it is ready; the runtime it replaces
+    takes no new requests and is freed after its in-flight ones drain. With
+    a memory budget, idle models are unloaded least recently used first to
+    make room for the one being loaded.
+    
+    Used from the event loop thread only.
+    """
+
+    def __init__(self, models: Dict[str, str], memory_budget: int):
+        self.paths: "OrderedDict[str, str]" = OrderedDict(models)
+        self.default = next(iter(self.paths))
+        self.memory_budget = memory_budget
+        # Runtimes serving requests, least recently used first
+        self.runtimes: "OrderedDict[str, ModelRuntime]" = OrderedDict()
+        # name -> (path, task) of loads in progress
+        self._loading: Dict[str, Tuple[str, asyncio.Task]] = {}
+        # Swapped-out or evicted runtimes waiting for their requests to drain
+        self._retiring: Dict[ModelRuntime, asyncio.Task] = {}
+        self.errors: Dict[str, str] = {}
+        self.loads = 0
+        self.swaps = 0
+        self.evictions = 0
+        self._startup: Optional[asyncio.Task] = None
+        # Seconds from process start until the default model was first ready
+        self.ready_after: Optional[float] = None
+
+    @property
+    def ready(self) -> bool:
+        runtime = self.runtimes.get(self.default)
+        return runtime is not None and runtime.ready
+
+    def resolve(self, requested: Optional[str]) -> str:
+        return requested if requested in self.paths else self.default
+
+    def model_name(self, runtime: ModelRuntime, model_map: Dict[str, str]) -> str:
+        """Name reported in responses; the default model keeps its mapped display name."""
+        if runtime.name == self.default:
+            return model_map.get("default", runtime.name)
+        return runtime.name
+
+    @property
+    def memory_in_use(self) -> int:
+        return sum(runtime.size_bytes for runtime in list(self.runtimes.values()) + list(self._retiring))
+
+    async def get(self, requested: Optional[str]) -> ModelRuntime:
+        """
+        Runtime serving a request's model field, loading it on first use.
+        
+        Returns without yielding to the event loop once the model is loaded,
+        so a lease taken right after the call cannot race an eviction.
+        """
+        name = self.resolve(requested)
+        while name not in self.runtimes:
+            await self.load(name)
+        self.runtimes.move_to_end(name)
+        runtime = self.runtimes[name]
+        runtime.requests += 1
+        return runtime
+
+    async def load(self, name: str, path: Optional[str] = None) -> ModelRuntime:
+        """Load a model (or a new version of a loaded one) and swap it in once ready."""
+        path = path or self.paths.get(name)
+        if path is None:
+            raise KeyError(f"Model {name} is not registered")
+        pending = self._loading.get(name)
+        if pending is None or pending[0] != path:
+            task = asyncio.get_running_loop().create_task(self._load(name, path))
+            self._loading[name] = (path, task)
+
+            def done(finished: asyncio.Task):
+                if self._loading.get(name, (None, None))[1] is finished:
+                    del self._loading[name]
+
+            task.add_done_callback(done)
+            pending = (path, task)
+        return await asyncio.shield(pending[1])
+
+    def load_in_background(self, name: str, path: Optional[str] = None):
+        """Start load() without waiting for it; failures are logged and kept in errors."""
+
+        async def run():
+            try:
+                await self.load(name, path)
+            except Exception as e:
+                logger.error("Loading model %s failed: %s", name, e)
+
+        asyncio.get_running_loop().create_task(run())
+
+    async def _load(self, name: str, path: str) -> ModelRuntime:
+        runtime = ModelRuntime(name, path)
+        await self._make_room(runtime.size_bytes, keep=name)
+        started = time.perf_counter()
+        try:
+            await asyncio.to_thread(runtime.load)
+        except Exception as e:
+            self.errors[name] = f"{type(e).__name__}: {e}"
+            tracer.event("model_load_failed", model=name, path=path, error=self.errors[name])
+            await asyncio.to_thread(runtime.unload)
+            raise
+        self.errors.pop(name, None)
+        
+        self.paths[name] = path
+        previous = self.runtimes.pop(name, None)
+        self.runtimes[name] = runtime
+        self.loads += 1
+        if previous is not None:
+            self.swaps += 1
+            self._retire(previous)
+        logger.info("Model %s ready in %.2fs %s%s", name, time.perf_counter() - started, runtime.startup,
+                    " (previous version draining)" if previous is not None else "")
+        tracer.event("model_loaded", model=name, path=path, swapped=previous is not None, **runtime.startup)
+        for phase, seconds in runtime.startup.items():
+            metric_model_startup.set(seconds, name, phase.replace("_seconds", ""))
+        if name == self.default and self.ready_after is None:
+            self.ready_after = time.perf_counter() - PROCESS_STARTED
+            logger.info("Ready %.2fs after process start", self.ready_after)
+        return runtime
+
+    async def _make_room(self, needed: int, keep: str):
+        """Unload idle models, least recently used first, until needed bytes fit the budget."""
+        if self.memory_budget <= 0:
+            return
+        evicted = []
+        for runtime in list(self.runtimes.values()):
+            if self.memory_in_use + needed <= self.memory_budget:
+                break
+            if runtime.name in (keep, self.default) or runtime.in_flight:
+                continue
+            logger.info("Evicting idle model %s to stay within MODEL_MEMORY_BUDGET", runtime.name)
+            self.evictions += 1
+            evicted.append(self._retire(runtime))
+        if evicted:
+            await asyncio.gather(*evicted, return_exceptions=True)
+        if self.memory_in_use + needed > self.memory_budget:
+            logger.warning("Loading %s exceeds MODEL_MEMORY_BUDGET; no idle model is left to unload", keep)
+
+    def _retire(self, runtime: ModelRuntime, timeout: Optional[float] = None) -> asyncio.Task:
+        """Stop routing to a runtime and free it once its leases are returned."""
+        if self.runtimes.get(runtime.name) is runtime:
+            del self.runtimes[runtime.name]
+        runtime.retired = True
+        task = asyncio.get_running_loop().create_task(asyncio.to_thread(runtime.unload, timeout))
+        self._retiring[runtime] = task
+
+        def done(_):
+            self._retiring.pop(runtime, None)
+            logger.info("Model %s unloaded (%s)", runtime.name, runtime.path)
+            tracer.event("model_unloaded", model=runtime.name, path=runtime.path)
+
+        task.add_done_callback(done)
+        return task
+
+    def unload(self, name: str):
+        """
+        Take a model out of service; it is freed once its in-flight requests finish.
+        
+        Raises:
+            KeyError: The model is not loaded
+            ValueError: The model is the default, which /health depends on
+        """
+        runtime = self.runtimes.get(name)
+        if runtime is None:
+            raise KeyError(f"Model {name} is not loaded")
+        if name == self.default:
+            raise ValueError(f"Model {name} is the default model and cannot be unloaded; load a new version instead")
+        self._retire(runtime)
+
+    def start_in_background(self):
+        """
+        Run start() without blocking the lifespan, so the server accepts
+        connections (and answers /health with "loading") during the load.
+        Requests that arrive meanwhile wait for their model's load.
+        """
+
+        async def run():
+            try:
+                await self.start()
+            except Exception as e:
+                logger.error("Model startup failed: %s", e)
+
+        self._startup = asyncio.get_running_loop().create_task(run())
+
+    async def start(self):
+        """Load the registered models that fit the memory budget, default first."""
+        for name, path in list(self.paths.items()):
+            size = os.path.getsize(path) if os.path.exists(path) else 0
+            if name != self.default and self.memory_budget > 0 and self.memory_in_use + size > self.memory_budget:
+                logger.info("Model %s does not fit MODEL_MEMORY_BUDGET; it loads on first use", name)
+                continue
+            await self.load(name)
+
+    async def stop(self, timeout: float = 10.0):
+        if self._startup is not None:
+            self._startup.cancel()
+        # A load cannot be interrupted; let it finish so its runtime is freed below
+        if self._loading:
+            await asyncio.wait([task for _, task in self._loading.values()])
+        for runtime in list(self.runtimes.values()):
+            self._retire(runtime, timeout)
+        if self._retiring:
+            await asyncio.wait(list(self._retiring.values()), timeout=timeout * 2)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "default": self.default,
+            "registered": dict(self.paths),
+            "memory_budget_bytes": self.memory_budget,
+            "memory_in_use_bytes": self.memory_in_use,
+            "loads": self.loads,
+            "swaps": self.swaps,
+            "evictions": self.evictions,
+            "loading": list(self._loading),
+            "retiring": [runtime.name for runtime in self._retiring],
+            "errors": self.errors,
+            "ready_after_seconds": round(self.ready_after, 4) if self.ready_after is not None else None,
+            "loaded": [runtime.stats() for runtime in self.runtimes.values()],
+        }
+
+registry = ModelRegistry(parse_model_specs(MODELS), MODEL_MEMORY_BUDGET)
+
+# ============================================================================
+# ADMISSION CONTROL
+# ============================================================================
+
+def client_id(http_request: Optional[Request]) -> str:
+    """
+    Who a request is accounted to: its API key (Authorization: Bearer or
+    x-api-key), hashed so keys never show up in stats, else its address.
+    """
+    if http_request is None:
+        return "anonymous"
+    key = http_request.headers.get("x-api-key", "")
+    authorization = http_request.headers.get("authorization", "")
+    if not key and authorization.lower().startswith("bearer "):
+        key = authorization[7:].strip()
+    if key:
+        return api_key_client(key)
+    host = http_request.client.host if http_request.client is not None else "unknown"
+    return f"ip:{host}"
+
+def api_key_client(key: str) -> str:
+    return "key:" + hashlib.sha256(key.encode("utf-8")).hexdigest()[:12]
+
+def parse_client_weights(spec: str) -> Dict[str, float]:
+    """
+    Parse "name=weight;name=weight". A name is an API key, an "ip:<address>"
+    client or "batch" (/v1/batches jobs).
+    """
+    weights: Dict[str, float] = {}
+    for entry in spec.split(";"):
+        if not entry.strip():
+            continue
+        name, _, weight = entry.rpartition("=")
+        name = name.strip()
+        if not name:
+            raise ValueError(f"CLIENT_WEIGHTS entry {entry!r} is not name=weight")
+        if name != "batch" and not name.startswith("ip:"):
+            name = api_key_client(name)
+        weights[name] = float(weight)
+    return weights
+
+def request_cost(prompt: Union[str, List[int]], max_tokens: int) -> int:
+    """Tokens a request may occupy: its prompt plus everything it may generate."""
+    # Text prompts only get a rough token estimate
+    return (len(prompt) // 4 if isinstance(prompt, str) else len(prompt)) + max_tokens
+
+class TokenBucket:
+    """Refills at rate tokens per second up to capacity."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def take(self, amount: float) -> float:
+        """Take amount tokens; returns 0, or the seconds to wait when there are too few."""
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.level >= amount:
+            self.level -= amount
+            return 0.0
+        return (amount - self.level) / self.rate
+
+class RateLimiter:
+    """
+    Per-client token buckets charged with each request's cost at the door.
+    
+    A request costing more than the burst is charged the full burst, so it
+    is admitted whenever the client's bucket is full.
+    """
+
+    def __init__(self, tokens_per_second: float, burst: int, max_clients: int = 10000):
+        self.tokens_per_second = tokens_per_second
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.rejected = 0
+
+    def charge(self, client: str, cost: int):
+        """
+        Raises:
+            RateLimited: The client's bucket holds fewer tokens than the request costs
+        """
+        if self.tokens_per_second <= 0:
+            return
+        with self._lock:
+            bucket = self._buckets.get(client)
+            if bucket is None:
+                bucket = self._buckets[client] = TokenBucket(self.tokens_per_second, self.burst)
+                while len(self._buckets) > self.max_clients:
+                    self._buckets.popitem(last=False)
+            self._buckets.move_to_end(client)
+            wait = bucket.take(min(cost, self.burst))
+            if wait:
+                self.rejected += 1
+        if wait:
+            raise RateLimited(
+                f"Token rate limit of {self.tokens_per_second:g}/s exceeded for this client "
+                f"(request costs {cost} tokens)", wait
+            )
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "tokens_per_second": self.tokens_per_second,
+                "burst": self.burst,
+                "clients": len(self._buckets),
+                "rejected": self.rejected,
+            }
+
+rate_limiter = RateLimiter(CLIENT_TOKENS_PER_SECOND, CLIENT_TOKEN_BURST)
+
+# ============================================================================
+# INFERENCE SCHEDULER
+# ============================================================================
+
+class SchedulerOverloaded(Exception):
+    """Raised when a job cannot be accepted now: the queue or the in-flight token budget is full."""
+
+    def __init__(self, message: str, retry_after: float = 1.0, reason: str = "queue_full"):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.reason = reason
+
+class RateLimited(SchedulerOverloaded):
+    """Raised when a client has used up its token rate."""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message, retry_after, "rate_limit")
+
+class SchedulerUnavailable(Exception):
+    """Raised when the scheduler is stopped or a job waited too long in the queue."""
+
+class InferenceJob:
+    """A blocking call waiting to run on the inference worker thread."""
+
+    __slots__ = ("fn", "args", "kwargs", "loop", "future", "client", "cost", "cancel", "enqueued_at", "started_at")
+
+    def __init__(self, fn, args, kwargs, loop: asyncio.AbstractEventLoop, client: str = "anonymous", cost: int = 0):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.loop = loop
+        self.future = loop.create_future()
+        self.client = client
+        self.cost = cost
+        # The call's own cancel argument, also watched by the scheduler
+        self.cancel: Optional[Cancellation] = kwargs.get("cancel")
+        self.enqueued_at = time.perf_counter()
+        self.started_at: Optional[float] = None
+
+    @property
+    def queue_wait(self) -> float:
+        """Seconds spent in the queue before the worker picked the job up."""
+        if self.started_at is None:
+            return time.perf_counter() - self.enqueued_at
+        return self.started_at - self.enqueued_at
+
+def _resolve_future(future: asyncio.Future, result: Any = None, error: Optional[BaseException] = None):
+    """Complete a future from the event loop thread, ignoring abandoned callers."""
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+class InferenceScheduler:
+    """
+    Runs blocking model calls on a dedicated worker thread.
+
+    The worker thread is the only thread that touches the Llama instance, so
+    the event loop stays free to serve /health and accept new connections
+    while a completion is generated. Jobs wait in a bounded queue; once it
+    is full new jobs are rejected immediately rather than piling up.
+    
+    With the batch engine enabled, one worker per sequence slot hands jobs
+    to the engine so that many generations are in flight at once. Each
+    registered model adds its own share of workers; a model's serial path
+    is guarded by its runtime lock.
+    
+    Admission: every job carries its cost (prompt tokens plus max_tokens)
+    and is refused while the queued and running jobs already hold
+    token_budget tokens, so work is shed before it is started rather than
+    timed out halfway. Queued jobs are kept per client and handed to the
+    workers by smooth weighted round-robin, so one client's backlog delays
+    the others by at most its weighted share.
+    
+    Cancellation: a job whose cancel argument is cancelled (disconnect or
+    deadline) fails its future with RequestCancelled at once. A queued job
+    is then skipped; a running one stops at its next token.
+    """
+
+    def __init__(self, max_queue_depth: int, queue_timeout: float, num_workers: int = 1,
+                 token_budget: int = 0, weights: Optional[Dict[str, float]] = None):
+        self.max_queue_depth = max_queue_depth
+        self.queue_timeout = queue_timeout
+        self.num_workers = max(1, num_workers)
+        self.token_budget = token_budget
+        self.weights = weights or {}
+        self._pending: "OrderedDict[str, deque]" = OrderedDict()
+        # Smooth weighted round-robin credit of each client with queued jobs
+        self._credit: Dict[str, float] = {}
+        self._depth = 0
+        self._tokens_in_flight = 0
+        self._cond = threading.Condition()
+        # (finish time, cost) of recent jobs, to turn the budget into a Retry-After
+        self._finished: "deque[Tuple[float, int]]" = deque()
+        self._threads: List[threading.Thread] = []
+        self._running = False
+        self._busy = 0
+        self._stats_lock = threading.Lock()
+        self._completed = 0
+        self._rejected = 0
+        self._over_budget = 0
+        self._expired = 0
+        self._cancelled = 0
+        self._queue_wait_total = 0.0
+        self._queue_wait_max = 0.0
+
+    def start(self):
+        """Start the worker threads."""
+        if self._running:
+            return
+        self._running = True
+        for i in range(self.num_workers):
+            thread = threading.Thread(target=self._run, name=f"inference-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: Optional[float] = None):
+        """Stop accepting jobs and wait for the workers to finish their current ones."""
+        if not self._running:
+            return
+        with self._cond:
+            self._running = False
+            abandoned = [job for jobs in self._pending.values() for job in jobs]
+            self._pending.clear()
+            self._credit.clear()
+            self._depth = 0
+            self._tokens_in_flight -= sum(job.cost for job in abandoned)
+            self._cond.notify_all()
+        for job in abandoned:
+            job.loop.call_soon_threadsafe(
+                _resolve_future, job.future, None, SchedulerUnavailable("Server is shutting down")
+            )
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    @property
+    def queue_depth(self) -> int:
+        return self._depth
+
+    @property
+    def tokens_in_flight(self) -> int:
+        return self._tokens_in_flight
+
+    def weight(self, client: str) -> float:
+        return self.weights.get(client, 1.0)
+
+    def enqueue(self, fn, *args, client: str = "anonymous", cost: int = 0, **kwargs) -> InferenceJob:
+        """
+        Queue a blocking call without waiting for it.
+
+        Must be called from the event loop thread. The job's future resolves
+        with the call's result once the worker has run it.
+
+        Raises:
+            SchedulerOverloaded: The queue or the in-flight token budget is full
+            SchedulerUnavailable: The scheduler is stopped
+        """
+        if not self._running:
+            raise SchedulerUnavailable("Inference worker is not running")
+
+        job = InferenceJob(fn, args, kwargs, asyncio.get_running_loop(), client, cost)
+        with self._cond:
+            if self._depth >= self.max_queue_depth:
+                self._rejected += 1
+                raise SchedulerOverloaded(f"Inference queue is full ({self.max_queue_depth} pending requests)")
+            # A single job larger than the whole budget still runs once nothing else is in flight
+            if self.token_budget > 0 and self._tokens_in_flight and self._tokens_in_flight + cost > self.token_budget:
+                self._over_budget += 1
+                raise SchedulerOverloaded(
+                    f"In-flight token budget is full ({self._tokens_in_flight} of {self.token_budget} tokens)",
+                    self._retry_after(self._tokens_in_flight + cost - self.token_budget),
+                    "token_budget",
+                )
+            self._pending.setdefault(client, deque()).append(job)
+            self._depth += 1
+            self._tokens_in_flight += cost
+            self._cond.notify()
+        if job.cancel is not None:
+            cancel = job.cancel
+            cancel.add_callback(lambda: job.loop.call_soon_threadsafe(
+                _resolve_future, job.future, None, RequestCancelled(cancel.reason)
+            ))
+        return job
+
+    def _retry_after(self, excess: int) -> float:
+        """Seconds until excess tokens are likely to finish, from the last 30s of throughput."""
+        now = time.perf_counter()
+        while self._finished and now - self._finished[0][0] > 30.0:
+            self._finished.popleft()
+        if not self._finished:
+            return 1.0
+        window = max(1.0, now - self._finished[0][0])
+        throughput = sum(cost for _, cost in self._finished) / window
+        return min(60.0, excess / throughput) if throughput > 0 else 1.0
+
+    async def submit(self, fn, *args, **kwargs):
+        """
+        Queue a blocking call and wait for its result.
+
+        Returns:
+            Tuple of (result, queue_wait_seconds)
+
+        Raises:
+            SchedulerOverloaded: The queue or the in-flight token budget is full
+            SchedulerUnavailable: The scheduler is stopped or the job expired in the queue
+        """
+        job = self.enqueue(fn, *args, **kwargs)
+        try:
+            result = await job.future
+        except asyncio.CancelledError:
+            # Caller went away; the worker skips jobs whose future is already done
+            job.future.cancel()
+            if job.cancel is not None:
+                # and a running job stops at its next token
+                job.cancel.cancel("abandoned")
+            raise
+        return result, job.queue_wait
+
+    def _next_job(self) -> Optional[InferenceJob]:
+        """Block until a job is queued, then take the next one in weighted round-robin order."""
+        with self._cond:
+            while self._running and not self._depth:
+                self._cond.wait()
+            if not self._running:
+                return None
+            total, chosen = 0.0, None
+            for client in self._pending:
+                weight = self.weight(client)
+                self._credit[client] = self._credit.get(client, 0.0) + weight
+                total += weight
+                if chosen is None or self._credit[client] > self._credit[chosen]:
+                    chosen = client
+            self._credit[chosen] -= total
+            jobs = self._pending[chosen]
+            job = jobs.popleft()
+            if not jobs:
+                # An idle client does not bank credit for later
+                del self._pending[chosen]
+                del self._credit[chosen]
+            self._depth -= 1
+            return job
+
+    def _finish(self, job: InferenceJob):
+        with self._cond:
+            self._tokens_in_flight -= job.cost
+            self._finished.append((time.perf_counter(), job.cost))
+
+    def _run(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                break
+            outcome = self._execute(job)
+            # Free the job's budget before its caller hears back, so it can resubmit at once
+            self._finish(job)
+            if outcome is not None:
+                job.loop.call_soon_threadsafe(_resolve_future, job.future, *outcome)
+
+    def _execute(self, job: InferenceJob) -> Optional[Tuple[Any, Optional[BaseException]]]:
+        """Run a job; returns its (result, error), or None if its caller already went away."""
+        if job.cancel is not None and job.cancel.cancelled:
+            # Nothing of it was computed; its future fails through the cancellation's callback
+            with self._stats_lock:
+                self._cancelled += 1
+            record_cancellation(job.cancel.reason, job.cost)
+            return None
+        if job.future.done():
+            return None
+
+        job.started_at = time.perf_counter()
+        queue_wait = job.queue_wait
+        with self._stats_lock:
+            self._queue_wait_total += queue_wait
+            self._queue_wait_max = max(self._queue_wait_max, queue_wait)
+
+        if self.queue_timeout > 0 and queue_wait > self.queue_timeout:
+            with self._stats_lock:
+                self._expired += 1
+            return None, SchedulerUnavailable(f"Request waited {queue_wait:.1f}s in the inference queue")
+
+        with self._stats_lock:
+            self._busy += 1
+        try:
+            return job.fn(*job.args, **job.kwargs), None
+        except BaseException as e:
+            return None, e
+        finally:
+            with self._stats_lock:
+                self._busy -= 1
+                self._completed += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Snapshot of queue state, admission and queue-wait timings."""
+        with self._cond:
+            queued = {client: len(jobs) for client, jobs in self._pending.items()}
+        with self._stats_lock:
+            started = self._completed + self._expired
+            avg_wait = self._queue_wait_total / started if started else 0.0
+            return {
+                "running": self._running,
+                "workers": self.num_workers,
+                "busy": self._busy,
+                "queue_depth": self.queue_depth,
+                "max_queue_depth": self.max_queue_depth,
+                "queued_by_client": queued,
+                "token_budget": self.token_budget,
+                "tokens_in_flight": self._tokens_in_flight,
+                "completed": self._completed,
+                "rejected": self._rejected,
+                "rejected_over_budget": self._over_budget,
+                "expired": self._expired,
+                "cancelled_in_queue": self._cancelled,
+                "queue_wait_avg_ms": round(avg_wait * 1000, 2),
+                "queue_wait_max_ms": round(self._queue_wait_max * 1000, 2),
+            }
+
+scheduler = InferenceScheduler(
+    INFERENCE_QUEUE_DEPTH,
+    INFERENCE_QUEUE_TIMEOUT,
+    num_workers=BATCH_SEQ_SLOTS * max(1, WORKER_PROCESSES) * len(registry.paths),
+    token_budget=ADMISSION_TOKEN_BUDGET,
+    weights=parse_client_weights(CLIENT_WEIGHTS),
+)
+
+def scheduler_http_error(error: Exception) -> HTTPException:
+    """Map scheduler backpressure errors to HTTP responses."""
+    if isinstance(error, SchedulerOverloaded):
+        metric_admission_rejected.inc(error.reason)
+        retry_after = str(max(1, math.ceil(error.retry_after)))
+        return HTTPException(status_code=429, detail=str(error), headers={"Retry-After": retry_after})
+    return HTTPException(status_code=503, detail=str(error), headers={"Retry-After": "5"})
+
+# ============================================================================
+# METRICS
+# ============================================================================
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+PROMPT_BUILD_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Metric:
+    """A named family of labelled series in the Prometheus text format."""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, help_text, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            for labels, value in self._values.items():
+                lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value:g}")
+        return lines
+
+    def drain(self) -> Dict[Tuple[str, ...], float]:
+        """Take the counts recorded so far and start again from zero."""
+        with self._lock:
+            values, self._values = self._values, {}
+        return values
+
+class Gauge(Counter):
+    """Settable value, or one read from collect() at scrape time."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = (), collect=None):
+        super().__init__(name, help_text, labelnames)
+        self.collect = collect
+
+    def set(self, value: float, *labels: str):
+        with self._lock:
+            self._values[labels] = value
+
+    def dec(self, *labels: str, amount: float = 1.0):
+        self.inc(*labels, amount=-amount)
+
+    def render(self) -> List[str]:
+        if self.collect is not None:
+            self.set(self.collect())
+        return super().render()
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...], labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = buckets
+        # Per label set: [count per bucket (last one is +Inf), sum, count]
+        self._series: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, *labels: str, count: int = 1):
+        """Record value; count > 1 records that many observations of the same value."""
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += count
+            series[1] += value * count
+            series[2] += count
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            for labels, (counts, total, count) in self._series.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += bucket_count
+                    le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                    series_labels = _format_labels(self.labelnames, labels, f'le="{le}"')
+                    lines.append(f"{self.name}_bucket{series_labels} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total:g}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def drain(self) -> Dict[str, List[Tuple[Tuple[str, ...], float]]]:
+        """
+        Counter increments since the last drain, by metric name.
+        
+        Inference workers send these to the API process, which merges them
+        into its own counters. Timings and token counts need no such relay:
+        they travel back in the generation result and are recorded there.
+        """
+        drained = {}
+        for metric in self._metrics:
+            if type(metric) is Counter:
+                values = metric.drain()
+                if values:
+                    drained[metric.name] = list(values.items())
+        return drained
+
+    def merge(self, drained: Dict[str, List[Tuple[Tuple[str, ...], float]]]):
+        """Add counter increments drained from another process."""
+        for metric in self._metrics:
+            for labels, amount in drained.get(metric.name, ()):
+                metric.inc(*labels, amount=amount)
+
+metrics = MetricsRegistry()
+ENDPOINT_LABEL = ("endpoint",)
+
+metric_requests = metrics.register(Counter(
+    "llm_requests_total", "Generation requests received.", ENDPOINT_LABEL))
+metric_in_flight = metrics.register(Gauge(
+    "llm_requests_in_flight", "Generation requests currently being served.", ENDPOINT_LABEL))
+metric_queued = metrics.register(Gauge(
+    "llm_requests_queued", "Jobs waiting in the shared inference queue.", collect=lambda: scheduler.queue_depth))
+metric_tokens_in_flight = metrics.register(Gauge(
+    "llm_admission_tokens_in_flight", "Cost in tokens of queued and running jobs.", collect=lambda: scheduler.tokens_in_flight))
+metric_admission_rejected = metrics.register(Counter(
+    "llm_admission_rejected_total", "Requests turned away with a 429, by reason.", ("reason",)))
+metric_prompt_build = metrics.register(Histogram(
+    "llm_prompt_build_seconds", "Time to render messages into a prompt.", PROMPT_BUILD_BUCKETS, ENDPOINT_LABEL))
+metric_queue_wait = metrics.register(Histogram(
+    "llm_queue_wait_seconds", "Time a generation waited in the inference queue.", LATENCY_BUCKETS, ENDPOINT_LABEL))
+metric_prefill = metrics.register(Histogram(
+    "llm_prefill_seconds", "Prompt evaluation time up to the first sampled token.", LATENCY_BUCKETS, ENDPOINT_LABEL))
+metric_decode = metrics.register(Histogram(
+    "llm_decode_seconds", "Token generation time after the first sampled token.", LATENCY_BUCKETS, ENDPOINT_LABEL))
+metric_ttft = metrics.register(Histogram(
+    "llm_time_to_first_token_seconds", "Queue wait plus prefill.", LATENCY_BUCKETS, ENDPOINT_LABEL))
+metric_token_latency = metrics.register(Histogram(
+    "llm_token_latency_seconds", "Decode time per completion token.", TOKEN_LATENCY_BUCKETS, ENDPOINT_LABEL))
+metric_prompt_tokens = metrics.register(Counter(
+    "llm_prompt_tokens_total", "Prompt tokens processed.", ENDPOINT_LABEL))
+metric_completion_tokens = metrics.register(Counter(
+    "llm_completion_tokens_total", "Completion tokens generated.", ENDPOINT_LABEL))
+metric_prefill_tps = metrics.register(Gauge(
+    "llm_prefill_tokens_per_second", "Prompt throughput of the most recent generation.", ENDPOINT_LABEL))
+metric_decode_tps = metrics.register(Gauge(
+    "llm_decode_tokens_per_second", "Decode throughput of the most recent generation.", ENDPOINT_LABEL))
+
+metric_draft_tokens = metrics.register(Counter(
+    "llm_speculative_draft_tokens_total", "Draft tokens proposed by speculative decoding.", ENDPOINT_LABEL))
+metric_accepted_tokens = metrics.register(Counter(
+    "llm_speculative_accepted_tokens_total", "Draft tokens accepted by the target model.", ENDPOINT_LABEL))
+metric_acceptance = metrics.register(Histogram(
+    "llm_speculative_acceptance_ratio", "Share of a generation's draft tokens that were accepted.",
+    (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0), ENDPOINT_LABEL))
+
+metric_context_trimmed = metrics.register(Counter(
+    "llm_context_trimmed_messages_total", "Messages dropped to fit prompts in the context window.", ("policy",)))
+metric_context_shifts = metrics.register(Counter(
+    "llm_context_shifts_total", "KV cache shifts that let a generation run past the context window.", ENDPOINT_LABEL))
+
+metric_model_startup = metrics.register(Gauge(
+    "llm_model_startup_seconds", "Seconds spent in each phase of the latest load of a model.", ("model", "phase")))
+
+metric_cancelled = metrics.register(Counter(
+    "llm_requests_cancelled_total", "Generations stopped early, by reason (disconnect, deadline, abandoned).",
+    ("reason",)))
+metric_tokens_saved = metrics.register(Counter(
+    "llm_cancelled_tokens_saved_total",
+    "Tokens not computed thanks to early cancellation: the unused completion budget of a cancelled "
+    "generation, or prompt plus budget of a job cancelled while queued.", ("reason",)))
+
+def record_cancellation(reason: str, tokens_saved: int):
+    """Record one generation stopped early and the tokens its cancellation saved."""
+    metric_cancelled.inc(reason)
+    metric_tokens_saved.inc(reason, amount=max(0, tokens_saved))
+
+def record_generation(endpoint: str, result: Dict[str, Any], queue_wait: float):
+    """Record the timings and token counts of one finished generation."""
+    prompt_tokens = result["prompt_tokens"]
+    completion_tokens = result["completion_tokens"]
+    metric_queue_wait.observe(queue_wait, endpoint)
+    metric_prompt_tokens.inc(endpoint, amount=prompt_tokens)
+    metric_completion_tokens.inc(endpoint, amount=completion_tokens)
+    
+    prefill = result.get("prefill_seconds")
+    decode = result.get("decode_seconds")
+    if prefill is not None:
+        metric_prefill.observe(prefill, endpoint)
+        metric_ttft.observe(queue_wait + prefill, endpoint)
+        if prefill > 0:
+            metric_prefill_tps.set(prompt_tokens / prefill, endpoint)
+    if decode is not None and completion_tokens:
+        metric_decode.observe(decode, endpoint)
+        metric_token_latency.observe(decode / completion_tokens, endpoint, count=completion_tokens)
+        if decode > 0:
+            metric_decode_tps.set(completion_tokens / decode, endpoint)
+    
+    draft_tokens = result.get("draft_tokens")
+    if draft_tokens:
+        accepted = result["accepted_draft_tokens"]
+        metric_draft_tokens.inc(endpoint, amount=draft_tokens)
+        metric_accepted_tokens.inc(endpoint, amount=accepted)
+        metric_acceptance.observe(accepted / draft_tokens, endpoint)
+    
+    if result.get("context_shifts"):
+        metric_context_shifts.inc(endpoint, amount=result["context_shifts"])
+
+async def track_stream(endpoint: str, events, trace: Optional["RequestTrace"] = None,
+                       cancel: Optional[Cancellation] = None):
+    """
+    Count a streaming response as in flight while its events are being sent, then end its trace.
+    
+    A stream that ends before its last event lost its client, which cancels
+    its generation.
+    """
+    metric_in_flight.inc(endpoint)
+    started = time.perf_counter()
+    completed = False
+    try:
+        async for event in events:
+            yield event
+        completed = True
+    finally:
+        metric_in_flight.dec(endpoint)
+        if cancel is not None:
+            if not completed:
+                cancel.cancel("disconnect")
+            cancel.close()
+        if trace is not None:
+            trace.span("stream", started)
+            if not completed:
+                trace.set(disconnected=True)
+            trace.finish()
+
+# ============================================================================
+# REQUEST TRACING
+# ============================================================================
+
+def parse_traceparent(value: Optional[str]) -> Tuple[Optional[str], Optional[str]]:
+    """Trace id and parent span id of a W3C traceparent header, or (None, None)."""
+    parts = (value or "").strip().lower().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None, None
+    try:
+        if int(parts[1], 16) == 0 or int(parts[2], 16) == 0:
+            return None, None
+    except ValueError:
+        return None, None
+    return parts[1], parts[2]
+
+class RequestTrace:
+    """
+    Spans of one request.
+    
+    Spans are (name, start, end) perf_counter() tuples appended on the
+    request path; nothing is formatted until the tracer's writer thread
+    picks up a kept trace. Without a tracer every call returns at once.
+    """
+
+    __slots__ = ("tracer", "request_id", "trace_id", "parent_span_id", "endpoint", "started", "wall_started",
+                 "sampled", "spans", "attrs", "status", "error", "finished")
+
+    def __init__(self, tracer: Optional["Tracer"], request_id: str, trace_id: str, parent_span_id: Optional[str],
+                 endpoint: str, started: float, sampled: bool):
+        self.tracer = tracer
+        self.request_id = request_id
+        self.trace_id = trace_id
+        self.parent_span_id = parent_span_id
+        self.endpoint = endpoint
+        self.started = started
+        self.wall_started = time.time() - (time.perf_counter() - started)
+        self.sampled = sampled
+        self.spans: List[Tuple[str, float, float]] = []
+        self.attrs: Dict[str, Any] = {}
+        self.status = 200
+        self.error: Optional[Dict[str, str]] = None
+        self.finished: Optional[float] = None
+
+    def span(self, name: str, started: float, finished: Optional[float] = None):
+        """Record a span that started at a perf_counter() time and ends at finished (default now)."""
+        if self.tracer is not None:
+            self.spans.append((name, started, time.perf_counter() if finished is None else finished))
+
+    def set(self, **attrs):
+        if self.tracer is not None:
+            self.attrs.update(attrs)
+
+    def generation(self, result: Dict[str, Any], queue_wait: float):
+        """Queue, prefill and decode spans of a generation that finished just now."""
+        if self.tracer is None:
+            return
+        finished = time.perf_counter()
+        decode_started = finished - result.get("decode_seconds", 0.0)
+        prefill_started = decode_started - result.get("prefill_seconds", 0.0)
+        self.spans.append(("queue", prefill_started - queue_wait, prefill_started))
+        self.spans.append(("prefill", prefill_started, decode_started))
+        self.spans.append(("decode", decode_started, finished))
+        self.attrs["prompt_tokens"] = result["prompt_tokens"]
+        self.attrs["completion_tokens"] = result["completion_tokens"]
+        self.attrs["finish_reason"] = result.get("finish_reason")
+
+    def set_error(self, error: BaseException):
+        """Keep the exception a request failed with, with its traceback."""
+        if self.tracer is not None:
+            self.error = {
+                "type": type(error).__name__,
+                "message": str(error),
+                "stack": "".join(traceback.format_exception(type(error), error, error.__traceback__)),
+            }
+
+    def finish(self, status: Optional[int] = None, error: Optional[BaseException] = None):
+        """End the request and hand the trace to the tracer. Later calls are ignored."""
+        if self.tracer is None or self.finished is not None:
+            return
+        self.finished = time.perf_counter()
+        if status is not None:
+            self.status = status
+        if error is not None:
+            self.set_error(error)
+        self.tracer.submit(self)
+
+    def record(self) -> Dict[str, Any]:
+        """The trace as one log line, with span times in ms from the request's arrival."""
+        started = self.started
+        record = {
+            "type": "request",
+            "time": round(self.wall_started, 6),
+            "request_id": self.request_id,
+            "trace_id": self.trace_id,
+            "endpoint": self.endpoint,
+            "status": self.status,
+            "duration_ms": round((self.finished - started) * 1000, 3),
+            "spans": [
+                {"name": name, "start_ms": round((begin - started) * 1000, 3), "duration_ms": round((end - begin) * 1000, 3)}
+                for name, begin, end in self.spans
+            ],
+            **self.attrs
+        }
+        if self.error is not None:
+            record["error"] = self.error
+        return record
+
+def otlp_attributes(attrs: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """OTLP JSON key/value list for flat attributes."""
+    converted = []
+    for key, value in attrs.items():
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            typed = {"boolValue": value}
+        elif isinstance(value, int):
+            typed = {"intValue": str(value)}
+        elif isinstance(value, float):
+            typed = {"doubleValue": value}
+        else:
+            typed = {"stringValue": str(value)}
+        converted.append({"key": key, "value": typed})
+    return converted
+
+def otlp_payload(traces: List[RequestTrace], service_name: str) -> Dict[str, Any]:
+    """An OTLP/HTTP JSON export request: one server span per request with its spans as children."""
+    spans = []
+    for trace in traces:
+        offset = trace.wall_started - trace.started
+        root_id = os.urandom(8).hex()
+        root = {
+            "traceId": trace.trace_id,
+            "spanId": root_id,
+            "name": trace.endpoint,
+            "kind": 2,
+            "startTimeUnixNano": str(int((offset + trace.started) * 1e9)),
+            "endTimeUnixNano": str(int((offset + trace.finished) * 1e9)),
+            "attributes": otlp_attributes({"request.id": trace.request_id, "http.status_code": trace.status, **trace.attrs}),
+        }
+        if trace.parent_span_id is not None:
+            root["parentSpanId"] = trace.parent_span_id
+        if trace.error is not None:
+            root["status"] = {"code": 2, "message": f"{trace.error['type']}: {trace.error['message']}"}
+        spans.append(root)
+        for name, begin, end in trace.spans:
+            spans.append({
+                "traceId": trace.trace_id,
+                "spanId": os.urandom(8).hex(),
+                "parentSpanId": root_id,
+                "name": name,
+                "kind": 1,
+                "startTimeUnixNano": str(int((offset + begin) * 1e9)),
+                "endTimeUnixNano": str(int((offset + end) * 1e9)),
+            })
+    return {"resourceSpans": [{
+        "resource": {"attributes": otlp_attributes({"service.name": service_name})},
+        "scopeSpans": [{"scope": {"name": "smollm2-api"}, "spans": spans}],
+    }]}
+
+class TimedRoute(APIRoute):
+    """Route that stamps the scope with the request's arrival, before the body is parsed."""
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def route_handler(request: Request):
+            request.scope["received_at"] = time.perf_counter()
+            return await handler(request)
+
+        return route_handler
+
+class Tracer:
+    """
+    Keeps or drops finished request traces and writes the kept ones off the request path.
+    
+    Head sampling decides when a request starts (TRACE_SAMPLE_RATE); tail
+    sampling keeps failed and slow requests whatever the head decision.
+    Kept traces go through a bounded queue to a writer thread, which formats
+    them as JSON lines in batches at most every 50 ms and batches OTLP
+    exports, so a request only pays for a few perf_counter() calls and a
+    put_nowait. A full queue drops traces instead of blocking.
+    """
+
+    def __init__(self, path: str, sample_rate: float, slow_seconds: float, buffer: int,
+                 otlp_endpoint: str = "", service_name: str = "smollm2-api"):
+        self.path = path
+        self.otlp_endpoint = otlp_endpoint
+        self.enabled = bool(path or otlp_endpoint)
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self.service_name = service_name
+        self._queue: "queue.Queue[Optional[Any]]" = queue.Queue(maxsize=max(1, buffer))
+        self._thread: Optional[threading.Thread] = None
+        self.kept = 0
+        self.sampled_out = 0
+        self.dropped = 0
+        self.written = 0
+        self.exported = 0
+        self.export_errors = 0
+
+    def begin(self, endpoint: str, id_prefix: str, http_request: Optional[Request] = None) -> RequestTrace:
+        """
+        Start the trace of a request; its request_id doubles as the response id.
+        
+        The validate span runs from the arrival of the request (recorded by
+        TimedRoute before the body is parsed) to now.
+        """
+        now = time.perf_counter()
+        trace_id = uuid.uuid4().hex
+        request_id = f"{id_prefix}{trace_id[:12]}"
+        if not self.enabled:
+            return RequestTrace(None, request_id, trace_id, None, endpoint, now, False)
+        parent_span_id = None
+        received = now
+        if http_request is not None:
+            remote_trace_id, parent_span_id = parse_traceparent(http_request.headers.get("traceparent"))
+            trace_id = remote_trace_id or trace_id
+            received = http_request.scope.get("received_at", now)
+        trace = RequestTrace(self, request_id, trace_id, parent_span_id, endpoint, received,
+                             random.random() < self.sample_rate)
+        trace.span("validate", received, now)
+        return trace
+
+    def submit(self, trace: RequestTrace):
+        keep = (trace.sampled or trace.status >= 400 or trace.error is not None
+                or trace.finished - trace.started >= self.slow_seconds)
+        if not keep:
+            self.sampled_out += 1
+            return
+        self._put(trace)
+
+    def event(self, kind: str, **fields):
+        """Write an unsampled structured log line (model lifecycle and the like)."""
+        if self.enabled:
+            self._put({"type": kind, "time": round(time.time(), 6), **fields})
+
+    def _put(self, item: Any):
+        try:
+            self._queue.put_nowait(item)
+            self.kept += 1
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        if not self.enabled or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="trace-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        """Flush what is queued and stop the writer thread."""
+        if self._thread is None:
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        out = None
+        if self.path:
+            out = sys.stdout if self.path == "-" else open(self.path, "a", encoding="utf-8")
+        exports: List[RequestTrace] = []
+        last_export = time.monotonic()
+        running = True
+        try:
+            while running:
+                try:
+                    items = [self._queue.get(timeout=1.0)]
+                    # Let a burst accumulate so it costs one wake-up and one write
+                    if items[0] is not None:
+                        time.sleep(0.05)
+                except queue.Empty:
+                    items = []
+                while len(items) < 512:
+                    try:
+                        items.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                lines = []
+                for item in items:
+                    if item is None:
+                        running = False
+                    elif isinstance(item, RequestTrace):
+                        lines.append(json_text(item.record()))
+                        if self.otlp_endpoint:
+                            exports.append(item)
+                    else:
+                        lines.append(json_text(item))
+                if out is not None and lines:
+                    out.write("\n".join(lines) + "\n")
+                    out.flush()
+                    self.written += len(lines)
+                if exports and (len(exports) >= 512 or time.monotonic() - last_export >= 1.0 or not running):
+                    self._export(exports)
+                    exports = []
+                    last_export = time.monotonic()
+        finally:
+            if out is not None and out is not sys.stdout:
+                out.close()
+
+    def _export(self, traces: List[RequestTrace]):
+        request = urllib.request.Request(
+            self.otlp_endpoint, data=json_bytes(otlp_payload(traces, self.service_name)),
+            headers={"Content-Type": "application/json"}, method="POST",
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=5.0) as response:
+                response.read()
+            self.exported += len(traces)
+        except Exception as e:
+            self.export_errors += 1
+            if self.export_errors == 1:
+                logger.warning("OTLP export to %s failed: %s", self.otlp_endpoint, e)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "log": self.path or None,
+            "otlp_endpoint": self.otlp_endpoint or None,
+            "sample_rate": self.sample_rate,
+            "slow_ms": self.slow_seconds * 1000,
+            "kept": self.kept,
+            "sampled_out": self.sampled_out,
+            "dropped": self.dropped,
+            "queued": self._queue.qsize(),
+            "written": self.written,
+            "exported": self.exported,
+            "export_errors": self.export_errors,
+        }
+
+tracer = Tracer(TRACE_LOG, TRACE_SAMPLE_RATE, TRACE_SLOW_MS / 1000, TRACE_BUFFER, TRACE_OTLP_ENDPOINT,
+                OTEL_SERVICE_NAME)
+
+# ============================================================================
+# STREAMING
+# ============================================================================
+
+_STREAM_END = object()
+
+class TokenStream:
+    """
+    Bounded hand-off of generated text from the inference worker to an SSE response.
+    
+    The worker blocks in put() while the buffer is full, so a slow reader
+    slows generation down instead of growing memory. A reader that stays
+    stalled for longer than STREAM_WRITE_TIMEOUT gets its generation cancelled.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, max_buffer: int = STREAM_BUFFER_SIZE):
+        self.loop = loop
+        self.cancelled = threading.Event()
+        self.prompt_tokens: Optional[int] = None
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_buffer)
+
+    def put(self, text: str, index: Optional[int] = None) -> bool:
+        """
+        Push a piece of text from the worker thread. Returns False once cancelled.
+        
+        Text of a generation with several choices is queued as (index, text).
+        """
+        if self.cancelled.is_set():
+            return False
+        item = text if index is None else (index, text)
+        pending = asyncio.run_coroutine_threadsafe(self._queue.put(item), self.loop)
+        try:
+            pending.result(timeout=STREAM_WRITE_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            pending.cancel()
+            self.cancelled.set()
+        except RuntimeError:
+            # Event loop already closed
+            self.cancelled.set()
+        return not self.cancelled.is_set()
+
+    def finish(self):
+        """Mark the end of the stream. Called on the event loop thread."""
+        self.loop.create_task(self._queue.put(_STREAM_END))
+
+    def cancel(self):
+        """Stop generation at the next token. Called on the event loop thread."""
+        self.cancelled.set()
+        # Free a worker that may be blocked on a full buffer
+        while not self._queue.empty():
+            self._queue.get_nowait()
+
+    async def __aiter__(self):
+        while True:
+            item = await self._queue.get()
+            if item is _STREAM_END:
+                return
+            yield item
+
+def start_stream(
+    runtime: ModelRuntime,
+    prompt: Union[str, List[int]],
+    max_tokens: int,
+    temperature: float,
+    top_p: float,
+    stop_tokens: Optional[List[str]],
+    endpoint: str,
+    client: str = "anonymous",
+    n: int = 1,
+    grammar: Optional[CompiledGrammar] = None,
+    cancel: Optional[Cancellation] = None
+):
+    """
+    Queue a streaming generation.
+    
+    Raises scheduler errors before any response bytes are sent, so a full
+    queue still yields a proper 429.
+    
+    Returns:
+        Tuple of (TokenStream, InferenceJob)
+    """
+    token_stream = TokenStream(asyncio.get_running_loop())
+    # Keeps the model loaded until the job is finished or abandoned
+    runtime.acquire()
+    try:
+        job = scheduler.enqueue(
+            generate_response_stream,
+            runtime,
+            client=client,
+            cost=request_cost(prompt, max_tokens * n),
+            prompt=prompt,
+            token_stream=token_stream,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            top_p=top_p,
+            stop_tokens=stop_tokens,
+            n=n,
+            grammar=grammar,
+            cancel=cancel
+        )
+    except BaseException:
+        runtime.release()
+        raise
+
+    def on_done(future: asyncio.Future):
+        runtime.release()
+        token_stream.finish()
+        if not future.cancelled() and future.exception() is None:
+            record_generation(endpoint, future.result(), job.queue_wait)
+
+    job.future.add_done_callback(on_done)
+    return token_stream, job
+
+def sse_event(data: Any, event: Optional[str] = None) -> str:
+    """Format one server-sent event."""
+    payload = data if isinstance(data, str) else json_text(data)
+    if event:
+        return f"event: {event}\ndata: {payload}\n\n"
+    return f"data: {payload}\n\n"
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+async def openai_stream_events(token_stream: TokenStream, job: InferenceJob, completion_id: str, model_name: str,
+                               n: int = 1, trace: Optional[RequestTrace] = None):
+    """
+    Yield OpenAI chat.completion.chunk frames for a streaming generation.
+    
+    Chunks of several choices are interleaved in generation order. A stream
+    of plain text with n > 1 is a single greedy choice sent once per index.
+    """
+    created = int(time.time())
+
+    def chunk(delta: Dict[str, Any], finish_reason: Optional[str] = None, stop_reason: Optional[str] = None,
+              index: int = 0) -> Dict[str, Any]:
+        return {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model_name,
+            "system_fingerprint": "smolllm2_135m_gguf",
+            "choices": [
+                {
+                    "index": index,
+                    "delta": delta,
+                    "finish_reason": finish_reason,
+                    "stop_reason": stop_reason,
+                    "logprobs": None
+                }
+            ]
+        }
+
+    try:
+        for index in range(n):
+            yield sse_event(chunk({"role": "assistant", "content": ""}, index=index))
+        async for item in token_stream:
+            if isinstance(item, tuple):
+                index, text = item
+                yield sse_event(chunk({"content": text}, index=index))
+            else:
+                for index in range(n):
+                    yield sse_event(chunk({"content": item}, index=index))
+
+        try:
+            result = await job.future
+        except Exception as e:
+            if trace is not None:
+                trace.set_error(e)
+            error_type = "timeout" if isinstance(e, RequestCancelled) else "server_error"
+            yield sse_event({"error": {"message": str(e), "type": error_type}})
+        else:
+            if trace is not None:
+                trace.generation(result, job.queue_wait)
+            for index, choice in enumerate(result_choices(result, n)):
+                yield sse_event(chunk({}, choice["finish_reason"] or "stop", choice.get("stop_sequence"), index))
+        yield sse_event("[DONE]")
+    finally:
+        token_stream.cancel()
+        job.future.cancel()
+
+ANTHROPIC_STOP_REASONS = {"stop": "end_turn", "length": "max_tokens"}
+
+def anthropic_stop_reason(result: Dict[str, Any]) -> Tuple[str, Optional[str]]:
+    """Anthropic stop_reason and stop_sequence for a generation result."""
+    if result.get("stop_sequence") is not None:
+        return "stop_sequence", result["stop_sequence"]
+    return ANTHROPIC_STOP_REASONS.get(result["finish_reason"], "end_turn"), None
+
+async def anthropic_stream_events(token_stream: TokenStream, job: InferenceJob, message_id: str, model_name: str,
+                                  trace: Optional[RequestTrace] = None):
+    """Yield Anthropic message_start/content_block_delta/message_stop events for a streaming generation."""
+    started = False
+
+    def message_start() -> str:
+        return sse_event({
+            "type": "message_start",
+            "message": {
+                "id": message_id,
+                "type": "message",
+                "role": "assistant",
+                "model": model_name,
+                "content": [],
+                "stop_reason": None,
+                "stop_sequence": None,
+                "usage": {"input_tokens": token_stream.prompt_tokens or 0, "output_tokens": 0}
+            }
+        }, "message_start")
+
+    try:
+        # message_start is sent with the first token, once the prompt has been counted
+        async for text in token_stream:
+            if not started:
+                started = True
+                yield message_start()
+                yield sse_event({"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}}, "content_block_start")
+            yield sse_event({"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": text}}, "content_block_delta")
+
+        try:
+            result = await job.future
+        except Exception as e:
+            if trace is not None:
+                trace.set_error(e)
+            error_type = "timeout_error" if isinstance(e, RequestCancelled) else "api_error"
+            yield sse_event({"type": "error", "error": {"type": error_type, "message": str(e)}}, "error")
+            return
+        if trace is not None:
+            trace.generation(result, job.queue_wait)
+
+        if not started:
+            yield message_start()
+            yield sse_event({"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}}, "content_block_start")
+        yield sse_event({"type": "content_block_stop", "index": 0}, "content_block_stop")
+        stop_reason, stop_sequence = anthropic_stop_reason(result)
+        yield sse_event({
+            "type": "message_delta",
+            "delta": {
+                "stop_reason": stop_reason,
+                "stop_sequence": stop_sequence
+            },
+            "usage": {"output_tokens": result["completion_tokens"]}
+        }, "message_delta")
+        yield sse_event({"type": "message_stop"}, "message_stop")
+    finally:
+        token_stream.cancel()
+        job.future.cancel()
+
+# ============================================================================
+# RESPONSE CACHE
+# ============================================================================
+
+class ResponseCacheBackend(abc.ABC):
+    """Storage interface for cached generation results keyed by request hash."""
+
+    @abc.abstractmethod
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        ...
+
+    @abc.abstractmethod
+    def set(self, key: str, value: Dict[str, Any]):
+        ...
+
+    @abc.abstractmethod
+    def stats(self) -> Dict[str, Any]:
+        ...
+
+class MemoryResponseCache(ResponseCacheBackend):
+    """In-process LRU bounded by entry count and TTL."""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Dict[str, Any]):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries = len(self._entries)
+        return {"backend": "memory", "entries": entries, "max_entries": self.max_entries}
+
+class FileResponseCache(ResponseCacheBackend):
+    """
+    JSON files in a directory, shared across restarts and worker processes.
+    
+    Expiry uses file mtime, and the oldest files are removed once the entry
+    count exceeds the limit. The lock covers the entry count and eviction;
+    reads and the writes of individual files run outside it.
+    """
+
+    def __init__(self, directory: str, max_entries: int, ttl: float):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+        self._count = sum(1 for name in os.listdir(directory) if name.endswith(".json"))
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        path = self._path(key)
+        try:
+            if os.path.getmtime(path) + self.ttl < time.time():
+                os.remove(path)
+                with self._lock:
+                    self._count = max(0, self._count - 1)
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                value = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return value
+
+    def set(self, key: str, value: Dict[str, Any]):
+        path = self._path(key)
+        existed = os.path.exists(path)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(value, f)
+            os.replace(tmp_path, path)
+        except OSError:
+            return
+        with self._lock:
+            if not existed:
+                self._count += 1
+            if self._count > self.max_entries:
+                self._evict()
+
+    def _evict(self):
+        """Remove the oldest files beyond max_entries. Called with the lock held."""
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                path = os.path.join(self.directory, name)
+                try:
+                    files.append((os.path.getmtime(path), path))
+                except OSError:
+                    pass
+        files.sort()
+        for _, path in files[:max(0, len(files) - self.max_entries)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self._count = min(len(files), self.max_entries)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries = self._count
+        return {"backend": "file", "entries": entries, "max_entries": self.max_entries, "directory": self.directory}
+
+def request_key(model: str, prompt: Union[str, List[int]], max_tokens: int, temperature: float, top_p: float,
+                stop_tokens: Optional[List[str]], grammar: Optional[CompiledGrammar] = None) -> Optional[str]:
+    """Canonical hash of a generation request, or None when sampling is not deterministic."""
+    if temperature > 0.0:
+        return None
+    fields = {
+        "model": model,
+        "prompt": prompt,
+        "max_tokens": max_tokens,
+        "top_p": top_p,
+        "stop": stop_tokens if stop_tokens is not None else DEFAULT_STOP_TOKENS,
+    }
+    if grammar is not None:
+        fields["grammar"] = grammar.key
+    canonical = json.dumps(fields, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """Exact-match cache of generation results for deterministic requests."""
+
+    def __init__(self, backend: ResponseCacheBackend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key: str, value: Dict[str, Any]):
+        self.backend.set(key, value)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            **self.backend.stats(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+def create_response_cache() -> Optional[ResponseCache]:
+    if RESPONSE_CACHE == "memory":
+        return ResponseCache(MemoryResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL))
+    if RESPONSE_CACHE == "file":
+        return ResponseCache(FileResponseCache(RESPONSE_CACHE_DIR, RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL))
+    return None
+
+response_cache = create_response_cache()
+
+# ============================================================================
+# REQUEST COALESCING
+# ============================================================================
+
+class _Flight:
+    """One in-flight non-streaming generation and the requests waiting on it."""
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+class SharedStream:
+    """
+    Fan-out of one streaming generation to every request attached to it.
+    
+    A pump task drains the underlying TokenStream into a history list, so a
+    request that joins late replays the tokens it missed before following
+    live ones. Generation is cancelled once the last subscriber leaves.
+    """
+
+    def __init__(self, token_stream: TokenStream, job: InferenceJob):
+        self.token_stream = token_stream
+        self.job = job
+        self.pieces: List[str] = []
+        self.done = False
+        self.subscribers = 0
+        self._changed = asyncio.Event()
+        self._pump = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        async for text in self.token_stream:
+            self.pieces.append(text)
+            self._notify()
+        self.done = True
+        self._notify()
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def subscribe(self) -> "StreamSubscriber":
+        self.subscribers += 1
+        return StreamSubscriber(self)
+
+    def unsubscribe(self):
+        self.subscribers -= 1
+        if self.subscribers == 0 and not self.job.future.done():
+            self.token_stream.cancel()
+            self.job.future.cancel()
+
+class StreamSubscriber:
+    """
+    One request's view of a SharedStream.
+    
+    Stands in for both the TokenStream and the InferenceJob that the SSE
+    event generators consume: it iterates text, exposes prompt_tokens and
+    carries its own future with the shared generation result.
+    """
+
+    def __init__(self, shared: SharedStream):
+        self.shared = shared
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self._closed = False
+        shared.job.future.add_done_callback(self._resolve)
 
-# Global model instance
-model = None
+    @property
+    def prompt_tokens(self) -> Optional[int]:
+        return self.shared.token_stream.prompt_tokens
 
-# ============================================================================
-# Pydantic Models for Request/Response Validation
-# ============================================================================
+    @property
+    def queue_wait(self) -> float:
+        return self.shared.job.queue_wait
 
-class Message(BaseModel):
-    role: str = Field(..., description="Role: system, user, or assistant")
-    content: str = Field(..., description="Message content")
+    def _resolve(self, source: asyncio.Future):
+        if self.future.done():
+            return
+        if source.cancelled():
+            self.future.cancel()
+        elif source.exception() is not None:
+            self.future.set_exception(source.exception())
+        else:
+            self.future.set_result(source.result())
 
-class ChatCompletionRequest(BaseModel):
-    messages: List[Message]
-    model: Optional[str] = None
-    max_tokens: Optional[int] = Field(default=MAX_TOKENS_DEFAULT, ge=1, le=2048)
-    temperature: Optional[float] = Field(default=TEMPERATURE_DEFAULT, ge=0.0, le=2.0)
-    top_p: Optional[float] = Field(default=0.9, ge=0.0, le=1.0)
-    stream: Optional[bool] = False
-    stop: Optional[List[str]] = None
+    def cancel(self):
+        if not self._closed:
+            self._closed = True
+            self.shared.unsubscribe()
 
-class AnthropicMessage(BaseModel):
-    role: str = Field(..., description="Role: user or assistant")
-    content: str = Field(..., description="Message content")
+    async def __aiter__(self):
+        index = 0
+        while True:
+            changed = self.shared._changed
+            while index < len(self.shared.pieces):
+                yield self.shared.pieces[index]
+                index += 1
+            if self.shared.done:
+                return
+            await changed.wait()
 
-class AnthropicCompletionRequest(BaseModel):
-    model: Optional[str] = None
-    messages: List[AnthropicMessage]
-    max_tokens: Optional[int] = Field(default=MAX_TOKENS_DEFAULT, ge=1, le=2048)
-    temperature: Optional[float] = Field(default=TEMPERATURE_DEFAULT, ge=0.0, le=2.0)
-    top_p: Optional[float] = Field(default=0.9, ge=0.0, le=1.0)
-    stream: Optional[bool] = False
-    stop_sequences: Optional[List[str]] = None
+class RequestCoalescer:
+    """
+    Single-flight deduplication of identical in-flight generations.
+    
+    Requests are keyed by request_key(), so only deterministic sampling is
+    coalesced. Non-streaming requests await one shared task; streaming
+    requests subscribe to one SharedStream.
+    """
 
-# ============================================================================
-# MODEL MAPPING
-# ============================================================================
+    def __init__(self):
+        self._flights: Dict[str, _Flight] = {}
+        self._streams: Dict[str, SharedStream] = {}
+        self.generations = 0
+        self.coalesced = 0
+        self.stream_generations = 0
+        self.streams_coalesced = 0
 
-# Map internal model names to display names for different APIs
-OPENAI_MODEL_MAP = {
-    "smollm2-135m-instruct-gguf": "smollm2-135m-instruct",
-    "smolllm2-135m-instruct-gguf": "smollm2-135m-instruct",
-    "default": "smollm2-135m-instruct"
-}
+    async def run(self, key: str, fn, cancel: Optional[Cancellation] = None):
+        """
+        Await fn() once per key, however many callers ask concurrently.
+        
+        A caller whose cancel is cancelled leaves with RequestCancelled; the
+        generation itself is cancelled only once every caller has left.
+        
+        Returns:
+            Tuple of (result, coalesced) where coalesced is True for callers
+            that attached to another request's generation
+        """
+        flight = self._flights.get(key)
+        coalesced = flight is not None
+        if flight is None:
+            flight = _Flight(asyncio.ensure_future(fn()))
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda _: self._forget(self._flights, key, flight))
+            self.generations += 1
+        else:
+            self.coalesced += 1
 
-ANTHROPIC_MODEL_MAP = {
-    "smollm2-135m-instruct-gguf": "smolllm2-135m-instruct",
-    "smolllm2-135m-instruct-gguf": "smolllm2-135m-instruct",
-    "default": "smolllm2-135m-instruct"
-}
+        flight.waiters += 1
+        try:
+            if cancel is None:
+                return await asyncio.shield(flight.task), coalesced
+            return await cancel.wait(asyncio.shield(flight.task)), coalesced
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                # Every caller went away
+                flight.task.cancel()
 
-# ============================================================================
-# PROMPT TEMPLATES
-# ============================================================================
+    def stream(self, key: str, start) -> StreamSubscriber:
+        """Subscribe to the in-flight stream for key, calling start() to open one if needed."""
+        shared = self._streams.get(key)
+        if shared is None:
+            token_stream, job = start()
+            shared = SharedStream(token_stream, job)
+            self._streams[key] = shared
+            job.future.add_done_callback(lambda _: self._forget(self._streams, key, shared))
+            self.stream_generations += 1
+        else:
+            self.streams_coalesced += 1
+        return shared.subscribe()
 
-def build_chatml_prompt(messages: List[Message], add_assistant_prompt: bool = True) -> str:
+    @staticmethod
+    def _forget(table: Dict[str, Any], key: str, entry: Any):
+        if table.get(key) is entry:
+            del table[key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": bool(REQUEST_COALESCING),
+            "in_flight": len(self._flights),
+            "in_flight_streams": len(self._streams),
+            "generations": self.generations,
+            "coalesced": self.coalesced,
+            "stream_generations": self.stream_generations,
+            "streams_coalesced": self.streams_coalesced,
+        }
+
+coalescer = RequestCoalescer()
+
+def open_stream(
+    runtime: ModelRuntime,
+    prompt: Union[str, List[int]],
+    max_tokens: int,
+    temperature: float,
+    top_p: float,
+    stop_tokens: Optional[List[str]],
+    endpoint: str,
+    client: str = "anonymous",
+    n: int = 1,
+    grammar: Optional[CompiledGrammar] = None,
+    cancel: Optional[Cancellation] = None
+):
     """
-    Build a ChatML-formatted prompt from messages.
-    This format is optimal for SmolLM2 instruction tuning.
+    Start a streaming generation, or attach to an identical one already running.
     
-    Args:
-        messages: List of message objects with role and content
-        add_assistant_prompt: Whether to add the assistant generation prompt
+    A stream with a deadline always runs on its own, since a shared
+    generation must outlive any one subscriber's deadline.
     
     Returns:
-        Formatted prompt string
+        Tuple of (token stream, job) for the SSE event generators
     """
-    prompt_parts = []
-    
-    for msg in messages:
-        role = msg.role.lower()
-        content = msg.content
-        
-        # Handle different roles
-        if role == "system":
-            # System messages set the context
-            prompt_parts.append(f"<|im_start|>system\n{content}<|im_end|>")
-        elif role == "user":
-            prompt_parts.append(f"<|im_start|>user\n{content}<|im_end|>")
-        elif role == "assistant":
-            # Assistant messages include previous responses for context
-            prompt_parts.append(f"<|im_start|>assistant\n{content}<|im_end|>")
-        elif role == "function" or role == "tool":
-            # Handle function/tool calls
-            prompt_parts.append(f"<|im_start|>assistant\n{content}<|im_end|>")
-        else:
-            # Default to user for unknown roles
-            prompt_parts.append(f"<|im_start|>user\n{content}<|im_end|>")
-    
-    # Add the assistant generation prompt
-    if add_assistant_prompt:
-        prompt_parts.append("<|im_start|>assistant")
-    
-    return "\n".join(prompt_parts) + "\n"
+    key = (request_key(runtime.fingerprint, prompt, max_tokens, temperature, top_p, stop_tokens, grammar)
+           if REQUEST_COALESCING else None)
+    if key is None or n > 1 or (cancel is not None and cancel.deadline is not None):
+        return start_stream(runtime, prompt, max_tokens, temperature, top_p, stop_tokens, endpoint, client, n, grammar,
+                            cancel)
+    subscriber = coalescer.stream(
+        key, lambda: start_stream(runtime, prompt, max_tokens, temperature, top_p, stop_tokens, endpoint, client,
+                                  grammar=grammar)
+    )
+    return subscriber, subscriber
 
-def build_anthropic_prompt(messages: List[AnthropicMessage]) -> str:
+async def generate_completion(
+    runtime: ModelRuntime,
+    prompt: Union[str, List[int]],
+    max_tokens: int,
+    temperature: float,
+    top_p: float,
+    stop_tokens: Optional[List[str]],
+    endpoint: str,
+    client: str = "anonymous",
+    n: int = 1,
+    best_of: Optional[int] = None,
+    trace: Optional[RequestTrace] = None,
+    grammar: Optional[CompiledGrammar] = None,
+    cancel: Optional[Cancellation] = None
+):
     """
-    Build Anthropic-formatted prompt from messages.
+    Produce a non-streaming generation result.
     
-    Args:
-        messages: List of Anthropic message objects
+    Served from the response cache when possible, otherwise attached to an
+    identical in-flight generation, otherwise run on the inference worker.
+    Cache keys only cover single-choice results, so requests for several
+    choices always run.
     
     Returns:
-        Formatted prompt string
+        Tuple of (result, response_headers)
+    
+    Raises:
+        RequestCancelled: cancel was cancelled before the result was ready
     """
-    prompt_parts = []
+    sequences = max(n, best_of or n)
+    key = (request_key(runtime.fingerprint, prompt, max_tokens, temperature, top_p, stop_tokens, grammar)
+           if sequences == 1 else None)
     
-    for msg in messages:
-        role = msg.role.lower()
-        content = msg.content
-        
-        if role == "user":
-            prompt_parts.append(f"\n\nHuman: {content}")
-        elif role == "assistant":
-            prompt_parts.append(f"\n\nAssistant: {content}")
-        elif role == "system":
-            # Prepend system message
-            prompt_parts.insert(0, f"{content}")
+    if key is not None and response_cache is not None:
+        result = response_cache.get(key)
+        if result is not None:
+            if trace is not None:
+                trace.set(cache="hit")
+            return result, {"X-Cache": "hit", "X-Queue-Wait-Ms": "0.00"}
     
-    # Add final assistant prompt
-    prompt_parts.append("\n\nAssistant:")
+    coalesce = key is not None and REQUEST_COALESCING
     
-    return "".join(prompt_parts)
+    async def submit():
+        # The flight outlives callers that disconnect, so it holds its own lease, and a shared
+        # flight its own cancellation: it stops only once every caller has gone
+        job_cancel = Cancellation() if coalesce else cancel
+        runtime.acquire()
+        try:
+            result, queue_wait = await scheduler.submit(
+                generate_response,
+                runtime,
+                client=client,
+                cost=request_cost(prompt, max_tokens * sequences),
+                prompt=prompt,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                top_p=top_p,
+                stop_tokens=stop_tokens,
+                n=n,
+                best_of=best_of,
+                grammar=grammar,
+                cancel=job_cancel
+            )
+        finally:
+            runtime.release()
+        record_generation(endpoint, result, queue_wait)
+        if key is not None and response_cache is not None:
+            response_cache.set(key, result)
+        return result, queue_wait
+    
+    if coalesce:
+        (result, queue_wait), coalesced = await coalescer.run(key, submit, cancel)
+    else:
+        (result, queue_wait), coalesced = await submit(), False
+    if trace is not None:
+        trace.generation(result, queue_wait)
+        if coalesced:
+            trace.set(coalesced=True)
+    
+    headers = {"X-Queue-Wait-Ms": f"{queue_wait * 1000:.2f}"}
+    if key is not None and response_cache is not None:
+        headers["X-Cache"] = "miss"
+    if coalesced:
+        headers["X-Coalesced"] = "true"
+    return result, headers
 
 # ============================================================================
-# MODEL LOADING
+# BATCH JOBS
 # ============================================================================
 
-def load_model():
-    """Load the GGUF quantized model with optimized settings."""
-    global model
-    print(f"Loading model from: {MODEL_PATH}")
-    
-    model = Llama(
-        model_path=MODEL_PATH,
-        n_ctx=CONTEXT_SIZE,
-        n_threads=4,
-        n_gpu_layers=0,  # CPU inference
-        verbose=False,
-        # Optimization settings
-        use_mmap=True,
-        use_mlock=False,
-        # Context settings
-        rope_freq_base=0.0,
-        rope_freq_scale=0.0,
-    )
-    
-    print(f"Model loaded successfully! Context size: {CONTEXT_SIZE}")
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_TERMINAL_STATUSES = ("completed", "failed", "cancelled")
 
-# ============================================================================
-# INFERENCE
-# ============================================================================
+class BatchJob:
+    """
+    One bulk job: its JSONL input, the JSONL output appended as requests
+    finish, and a batch.json with status and progress.
+    """
 
-def generate_response(
-    prompt: str,
-    max_tokens: int = 512,
-    temperature: float = 0.7,
-    top_p: float = 0.9,
-    stop_tokens: Optional[List[str]] = None
-) -> Dict[str, Any]:
+    def __init__(self, directory: str, meta: Dict[str, Any]):
+        self.directory = directory
+        self.meta = meta
+        self.task: Optional[asyncio.Task] = None
+        self.cancel_requested = meta["status"] == "cancelling"
+        self._changed = asyncio.Event()
+        self._saved_at = 0.0
+
+    @property
+    def id(self) -> str:
+        return self.meta["id"]
+
+    @property
+    def input_path(self) -> str:
+        return os.path.join(self.directory, "input.jsonl")
+
+    @property
+    def output_path(self) -> str:
+        return os.path.join(self.directory, "output.jsonl")
+
+    @property
+    def finished(self) -> bool:
+        return self.meta["status"] in BATCH_TERMINAL_STATUSES
+
+    def set_status(self, status: str):
+        self.meta["status"] = status
+        if status != "validating":
+            self.meta[f"{status}_at"] = int(time.time())
+        self.save()
+        self.notify()
+
+    def save(self, throttle: float = 0.0):
+        """Write batch.json atomically, at most once per throttle seconds."""
+        now = time.monotonic()
+        if throttle and now - self._saved_at < throttle:
+            return
+        self._saved_at = now
+        path = os.path.join(self.directory, "batch.json")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.meta, f)
+        os.replace(tmp_path, path)
+
+    def notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def scan_output(self) -> set:
+        """
+        Custom ids already answered in output.jsonl, dropping a partial last
+        line left by a crash, and reset request_counts to match.
+        """
+        done = set()
+        counts = self.meta["request_counts"]
+        counts["completed"] = counts["failed"] = 0
+        if not os.path.exists(self.output_path):
+            return done
+        valid_bytes = 0
+        with open(self.output_path, "rb") as f:
+            for raw in f:
+                if not raw.endswith(b"\n"):
+                    break
+                try:
+                    line = json.loads(raw)
+                except ValueError:
+                    break
+                valid_bytes += len(raw)
+                done.add(line["custom_id"])
+                counts["failed" if line.get("error") else "completed"] += 1
+        if valid_bytes < os.path.getsize(self.output_path):
+            with open(self.output_path, "r+b") as f:
+                f.truncate(valid_bytes)
+        return done
+
+class BatchManager:
     """
-    Generate a response using the SmolLM2 model.
-    
-    Args:
-        prompt: Formatted prompt
-        max_tokens: Maximum tokens to generate
-        temperature: Sampling temperature (0.0-2.0)
-        top_p: Top-p sampling parameter
-        stop_tokens: List of stop tokens
+    Runs /v1/batches jobs through the same path as /v1/chat/completions.
     
-    Returns:
-        Dictionary with generated text and metadata
+    Each request goes through render_chat_prompt and generate_completion, so
+    batch output matches the online API (including the response cache and
+    request coalescing for duplicate deterministic prompts). Requests are
+    ordered so that prompts sharing a conversation prefix run back to back
+    (longest first within a group), which keeps the prefix cache and batch
+    engine slots warm, and BATCH_CONCURRENCY of them are kept in flight to
+    fill every inference worker. Progress survives restarts: answered
+    custom_ids are read back from output.jsonl and skipped on resume.
     """
-    if model is None:
-        raise RuntimeError("Model not loaded")
-    
-    # Default stop tokens
-    if stop_tokens is None:
-        stop_tokens = [
-            "<|im_end|>",
-            "<|im_start|>",
-            "\nHuman:",
-            "\nAssistant:",
-            "\nSystem:",
-            "User:",
-            "Assistant:",
-            "System:"
-        ]
-    
-    # Generate
-    output = model(
-        prompt=prompt,
-        max_tokens=max_tokens,
-        temperature=temperature,
-        top_p=top_p,
-        stop=stop_tokens,
-        echo=False,
-        stream=False,
-    )
-    
-    # Extract generated text
-    generated_text = output["choices"][0]["text"]
-    
-    # Count tokens (approximate)
-    prompt_tokens = len(model.tokenize(prompt.encode(), add_bos=False))
-    completion_tokens = len(model.tokenize(generated_text.encode(), add_bos=False))
-    
-    return {
-        "text": generated_text.strip(),
-        "prompt_tokens": prompt_tokens,
-        "completion_tokens": completion_tokens,
-        "total_tokens": prompt_tokens + completion_tokens
-    }
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.jobs: Dict[str, BatchJob] = {}
+
+    @property
+    def concurrency(self) -> int:
+        return BATCH_CONCURRENCY or scheduler.num_workers
+
+    async def create(self, chunks) -> BatchJob:
+        """
+        Store an uploaded JSONL body and validate it line by line.
+        
+        Raises:
+            ValueError: A line is not a valid batch request
+        """
+        batch_id = f"batch_{uuid.uuid4().hex[:24]}"
+        directory = os.path.join(self.directory, batch_id)
+        os.makedirs(directory, exist_ok=True)
+        job = BatchJob(directory, {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": BATCH_ENDPOINT,
+            "status": "validating",
+            "created_at": int(time.time()),
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+        })
+        with open(job.input_path, "wb") as f:
+            async for chunk in chunks:
+                f.write(chunk)
+        try:
+            job.meta["request_counts"]["total"] = await asyncio.to_thread(self._validate, job.input_path)
+        except ValueError:
+            for name in os.listdir(directory):
+                os.remove(os.path.join(directory, name))
+            os.rmdir(directory)
+            raise
+        job.set_status("in_progress")
+        self.jobs[batch_id] = job
+        self.start(job)
+        return job
+
+    @staticmethod
+    def _validate(path: str) -> int:
+        seen = set()
+        with open(path, "rb") as f:
+            for number, raw in enumerate(f, 1):
+                if not raw.strip():
+                    continue
+                try:
+                    item = json.loads(raw)
+                except ValueError as e:
+                    raise ValueError(f"line {number}: invalid JSON ({e})")
+                if not isinstance(item, dict) or not isinstance(item.get("custom_id"), str):
+                    raise ValueError(f"line {number}: custom_id is required")
+                if not isinstance(item.get("body"), dict):
+                    raise ValueError(f"line {number}: body must be an object")
+                if item.get("url", BATCH_ENDPOINT) != BATCH_ENDPOINT:
+                    raise ValueError(f"line {number}: only {BATCH_ENDPOINT} is supported")
+                if item["custom_id"] in seen:
+                    raise ValueError(f"line {number}: duplicate custom_id {item['custom_id']!r}")
+                seen.add(item["custom_id"])
+                if len(seen) > BATCH_MAX_REQUESTS:
+                    raise ValueError(f"batch exceeds {BATCH_MAX_REQUESTS} requests")
+        if not seen:
+            raise ValueError("batch contains no requests")
+        return len(seen)
+
+    def resume(self):
+        """Load persisted jobs and restart the ones a shutdown interrupted."""
+        if not os.path.isdir(self.directory):
+            return
+        for name in sorted(os.listdir(self.directory)):
+            directory = os.path.join(self.directory, name)
+            try:
+                with open(os.path.join(directory, "batch.json"), "r", encoding="utf-8") as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                continue
+            job = BatchJob(directory, meta)
+            self.jobs[job.id] = job
+            if not job.finished and meta["status"] != "validating":
+                logger.info("Resuming batch %s", job.id)
+                self.start(job)
+
+    def start(self, job: BatchJob):
+        job.task = asyncio.get_running_loop().create_task(self._run(job))
+
+    def cancel(self, job: BatchJob):
+        if job.finished:
+            return
+        job.cancel_requested = True
+        job.set_status("cancelling")
+
+    async def stop(self):
+        """Interrupt running jobs; they stay in progress and resume on the next start."""
+        tasks = [job.task for job in self.jobs.values() if job.task is not None and not job.task.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    @staticmethod
+    def _plan(job: BatchJob, done: set) -> List[int]:
+        """Byte offsets of the unanswered input lines, in execution order."""
+        order = []
+        with open(job.input_path, "rb") as f:
+            offset = 0
+            for raw in f:
+                line_offset, offset = offset, offset + len(raw)
+                if not raw.strip():
+                    continue
+                item = json.loads(raw)
+                if item["custom_id"] in done:
+                    continue
+                messages = item["body"].get("messages") or []
+                history = json.dumps(messages[:-1], sort_keys=True)
+                size = sum(len(str(message.get("content", ""))) for message in messages if isinstance(message, dict))
+                group = hashlib.blake2b(history.encode("utf-8"), digest_size=8).digest()
+                order.append((registry.resolve(item["body"].get("model")), group, -size, line_offset))
+        order.sort()
+        return [line_offset for *_, line_offset in order]
+
+    async def _run(self, job: BatchJob):
+        done = await asyncio.to_thread(job.scan_output)
+        offsets = await asyncio.to_thread(self._plan, job, done)
+        
+        semaphore = asyncio.Semaphore(self.concurrency)
+        pending = set()
+        counts = job.meta["request_counts"]
+        
+        with open(job.input_path, "rb") as source, open(job.output_path, "a", encoding="utf-8") as output:
+            async def process(item: Dict[str, Any]):
+                try:
+                    line = await self._execute(item)
+                finally:
+                    semaphore.release()
+                output.write(json.dumps(line) + "\n")
+                output.flush()
+                counts["failed" if line["error"] else "completed"] += 1
+                job.save(throttle=1.0)
+                job.notify()
+            
+            try:
+                for line_offset in offsets:
+                    await semaphore.acquire()
+                    if job.cancel_requested:
+                        semaphore.release()
+                        break
+                    source.seek(line_offset)
+                    task = asyncio.ensure_future(process(json.loads(source.readline())))
+                    pending.add(task)
+                    task.add_done_callback(pending.discard)
+                await asyncio.gather(*pending)
+            except asyncio.CancelledError:
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+                job.save()
+                raise
+            except Exception as e:
+                logger.exception("Batch %s failed: %s", job.id, e)
+                job.meta["errors"] = {"object": "list", "data": [{"code": "internal_error", "message": str(e)}]}
+                job.set_status("failed")
+                return
+        
+        job.set_status("cancelled" if job.cancel_requested else "completed")
+
+    @staticmethod
+    async def _execute(item: Dict[str, Any]) -> Dict[str, Any]:
+        """Run one batch line through the chat completions path and wrap the outcome."""
+        custom_id = item["custom_id"]
+        trace = tracer.begin("batch", "batch_req_")
+        trace.set(custom_id=custom_id, client="batch")
+
+        def failure(status_code: int, code: str, message: str) -> Dict[str, Any]:
+            trace.set(error_code=code)
+            trace.finish(status_code)
+            return {
+                "id": trace.request_id,
+                "custom_id": custom_id,
+                "response": {"status_code": status_code, "request_id": uuid.uuid4().hex, "body": None},
+                "error": {"code": code, "message": message},
+            }
+
+        try:
+            request = ChatCompletionRequest(**item["body"])
+        except ValidationError as e:
+            return failure(400, "invalid_request", str(e))
+        if not request.messages:
+            return failure(400, "invalid_request", "messages field is required")
+        
+        max_tokens = request.max_tokens or MAX_TOKENS_DEFAULT
+        temperature = request.temperature if request.temperature is not None else TEMPERATURE_DEFAULT
+        top_p = request.top_p or 0.9
+        try:
+            runtime = await registry.get(request.model)
+        except Exception as e:
+            return failure(500, "server_error", str(e))
+        
+        with runtime_lease(runtime):
+            try:
+                prompt = render_chat_prompt(runtime, request.messages, max_tokens)
+            except ContextLengthExceeded as e:
+                return failure(400, "context_length_exceeded", str(e))
+            try:
+                grammar = await runtime.grammars.get_async(request.response_format)
+            except GrammarError as e:
+                return failure(400, "invalid_request", str(e))
+            n, best_of = sampling_choices(request, temperature)
+            delay = 0.25
+            for attempt in range(BATCH_MAX_RETRIES + 1):
+                try:
+                    result, _ = await generate_completion(runtime, prompt, max_tokens, temperature, top_p, request.stop,
+                                                          "batch", "batch", n, best_of, trace, grammar)
+                    break
+                except (SchedulerOverloaded, SchedulerUnavailable) as e:
+                    # Online traffic has the queue (or the job expired in it): back off and retry
+                    if attempt == BATCH_MAX_RETRIES:
+                        return failure(503, "server_overloaded", str(e))
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 5.0)
+                except Exception as e:
+                    return failure(500, "server_error", str(e))
+        
+        model_name = registry.model_name(runtime, OPENAI_MODEL_MAP)
+        trace.set(model=model_name, max_tokens=max_tokens, n=request.n or 1)
+        trace.finish(200)
+        return {
+            "id": trace.request_id,
+            "custom_id": custom_id,
+            "response": {
+                "status_code": 200,
+                "request_id": uuid.uuid4().hex,
+                "body": openai_chat_response(result, model_name, request.n or 1),
+            },
+            "error": None,
+        }
+
+    async def follow_output(self, job: BatchJob):
+        """Yield output.jsonl as it grows, until the job reaches a terminal state."""
+        position = 0
+        while True:
+            changed = job._changed
+            finished = job.finished or job.task is None or job.task.done()
+            try:
+                with open(job.output_path, "rb") as f:
+                    f.seek(position)
+                    data = f.read()
+            except FileNotFoundError:
+                data = b""
+            complete = data[:data.rfind(b"\n") + 1]
+            if complete:
+                position += len(complete)
+                yield complete
+            if finished:
+                return
+            await changed.wait()
+
+batch_manager = BatchManager(BATCH_DIR)
 
 # ============================================================================
 # FASTAPI APP
@@ -243,13 +5640,20 @@ def generate_response(
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Application lifespan handler for model loading."""
-    load_model()
+    tracer.start()
+    scheduler.start()
+    registry.start_in_background()
+    batch_manager.resume()
     yield
     # Cleanup
-    pass
+    await batch_manager.stop()
+    scheduler.stop()
+    await registry.stop()
+    tracer.stop()
 
 # Create FastAPI application
 app = FastAPI(
+    default_response_class=FastJSONResponse,
     title="SmolLM2-135M-Instruct API",
     description="""
     OpenAI and Anthropic compatible API for SmolLM2-135M-Instruct model.
@@ -257,8 +5661,11 @@ app = FastAPI(
     ## Features
     - **OpenAI Compatible**: /v1/chat/completions endpoint
     - **Anthropic Compatible**: /v1/messages endpoint
+    - **Embeddings**: /v1/embeddings with many inputs per call and base64 output
     - **Multi-turn Dialogue**: Full conversation history support
-    - **Streaming**: Non-streaming responses (streaming optional)
+    - **Streaming**: Server-sent events when `stream: true` is set
+    - **Batches**: JSONL bulk jobs via /v1/batches with progress polling and resume
+    - **Multiple Models**: GGUFs routed by the `model` field, hot-swapped without downtime
     
     ## Model
     - Base Model: HuggingFaceTB/SmolLM2-135M-Instruct
@@ -268,6 +5675,7 @@ app = FastAPI(
     ## Endpoints
     - POST /v1/chat/completions - OpenAI format
     - POST /v1/messages - Anthropic format
+    - POST /v1/embeddings - OpenAI embeddings
     - GET /health - Health check
     - GET / - API info
     """,
@@ -276,6 +5684,8 @@ app = FastAPI(
     docs_url="/docs",
     redoc_url="/redoc"
 )
+# Request traces start at the arrival TimedRoute records
+app.router.route_class = TimedRoute
 
 # Add CORS middleware
 app.add_middleware(
@@ -290,8 +5700,54 @@ app.add_middleware(
 # OPENAI COMPATIBLE ENDPOINT: /v1/chat/completions
 # ============================================================================
 
+def sampling_choices(request: ChatCompletionRequest, temperature: float) -> Tuple[int, Optional[int]]:
+    """
+    The n and best_of to generate with.
+    
+    Greedy sampling makes every choice identical, so a single sequence is
+    generated and the response repeats it n times.
+    """
+    if temperature <= 0.0:
+        return 1, None
+    return request.n or 1, request.best_of
+
+def result_choices(result: Dict[str, Any], n: int) -> List[Dict[str, Any]]:
+    """The n choices of a generation result, repeating a single greedy choice as needed."""
+    choices = result.get("choices") or [result]
+    return [choices[index] if index < len(choices) else choices[0] for index in range(n)]
+
+def openai_chat_response(result: Dict[str, Any], model_name: str, n: int = 1,
+                         completion_id: Optional[str] = None) -> Dict[str, Any]:
+    """Build a chat.completion body from a generation result."""
+    return {
+        "id": completion_id or f"chatcmpl-{uuid.uuid4().hex[:12]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model_name,
+        "system_fingerprint": "smolllm2_135m_gguf",
+        "choices": [
+            {
+                "index": index,
+                "message": {
+                    "role": "assistant",
+                    "content": choice["text"]
+                },
+                "finish_reason": choice["finish_reason"] or "stop",
+                # The stop sequence that ended the completion, if any
+                "stop_reason": choice.get("stop_sequence"),
+                "logprobs": None
+            }
+            for index, choice in enumerate(result_choices(result, n))
+        ],
+        "usage": {
+            "prompt_tokens": result["prompt_tokens"],
+            "completion_tokens": result["completion_tokens"],
+            "total_tokens": result["total_tokens"]
+        }
+    }
+
 @app.post("/v1/chat/completions", tags=["OpenAI Compatible"])
-async def openai_chat_completions(request: ChatCompletionRequest):
+async def openai_chat_completions(request: ChatCompletionRequest, http_request: Request):
     """
     OpenAI-compatible chat completions endpoint.
     
@@ -312,6 +5768,8 @@ async def openai_chat_completions(request: ChatCompletionRequest):
       }'
     ```
     """
+    # The trace's request id is also the completion id
+    trace = tracer.begin("openai", "chatcmpl-", http_request)
     try:
         # Validate messages
         if not request.messages:
@@ -322,49 +5780,78 @@ async def openai_chat_completions(request: ChatCompletionRequest):
         temperature = request.temperature if request.temperature is not None else TEMPERATURE_DEFAULT
         top_p = request.top_p or 0.9
         
-        # Build prompt using ChatML format
-        prompt = build_chatml_prompt(request.messages)
-        
-        # Generate response
-        result = generate_response(
-            prompt=prompt,
-            max_tokens=max_tokens,
-            temperature=temperature,
-            top_p=top_p,
-            stop_tokens=request.stop
-        )
+        # The deadline counts from arrival, so it also covers a model load
+        cancel = request_deadline(http_request, request.timeout)
         
-        # Get mapped model name
-        model_name = OPENAI_MODEL_MAP.get("default", "smollm2-135m-instruct")
+        # Route by the model field; the lease keeps the model loaded until the job is queued
+        runtime = await registry.get(request.model)
+        with runtime_lease(runtime):
+            # Render the prompt with the model's chat template, straight to token ids
+            prompt_started = time.perf_counter()
+            prompt = render_chat_prompt(runtime, request.messages, max_tokens)
+            prompt_finished = time.perf_counter()
+            metric_prompt_build.observe(prompt_finished - prompt_started, "openai")
+            trace.span("template", prompt_started, prompt_finished)
+            metric_requests.inc("openai")
+            
+            # Choices are sampled from one evaluation of the prompt
+            n, best_of = sampling_choices(request, temperature)
+            # response_format: compiled once per schema, then served from the model's grammar cache
+            grammar = await runtime.grammars.get_async(request.response_format)
+            
+            # Charge the client's token bucket before anything is queued
+            client = client_id(http_request)
+            rate_limiter.charge(client, request_cost(prompt, max_tokens * max(n, best_of or n)))
+            
+            # Get mapped model name
+            model_name = registry.model_name(runtime, OPENAI_MODEL_MAP)
+            trace.set(model=model_name, client=client, max_tokens=max_tokens, n=request.n or 1, stream=bool(request.stream))
+            
+            if request.stream:
+                token_stream, job = open_stream(runtime, prompt, max_tokens, temperature, top_p, request.stop, "openai", client,
+                                                n, grammar, cancel)
+                cancel.watch()
+                return StreamingResponse(
+                    track_stream("openai", openai_stream_events(token_stream, job, trace.request_id,
+                                                                model_name, request.n or 1, trace), trace, cancel),
+                    media_type="text/event-stream",
+                    headers={**SSE_HEADERS, "X-Request-Id": trace.request_id}
+                )
+            
+            # Generate response on the inference worker (or serve it from the response cache)
+            metric_in_flight.inc("openai")
+            cancel.watch(http_request)
+            try:
+                result, headers = await generate_completion(runtime, prompt, max_tokens, temperature, top_p, request.stop,
+                                                            "openai", client, n, best_of, trace, grammar, cancel)
+            finally:
+                cancel.close()
+                metric_in_flight.dec("openai")
         
         # Return OpenAI-compatible response
-        return JSONResponse(content={
-            "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
-            "object": "chat.completion",
-            "created": int(time.time()),
-            "model": model_name,
-            "system_fingerprint": "smolllm2_135m_gguf",
-            "choices": [
-                {
-                    "index": 0,
-                    "message": {
-                        "role": "assistant",
-                        "content": result["text"]
-                    },
-                    "finish_reason": "stop",
-                    "logprobs": None
-                }
-            ],
-            "usage": {
-                "prompt_tokens": result["prompt_tokens"],
-                "completion_tokens": result["completion_tokens"],
-                "total_tokens": result["total_tokens"]
-            }
-        })
+        serialize_started = time.perf_counter()
+        headers["X-Request-Id"] = trace.request_id
+        response = FastJSONResponse(content=openai_chat_response(result, model_name, request.n or 1, trace.request_id),
+                                    headers=headers)
+        trace.span("serialize", serialize_started)
+        trace.finish(200)
+        return response
     
-    except HTTPException:
+    except HTTPException as e:
+        trace.finish(e.status_code, e)
         raise
+    except (ContextLengthExceeded, GrammarError) as e:
+        trace.finish(400, e)
+        raise HTTPException(status_code=400, detail=str(e))
+    except RequestCancelled as e:
+        trace.finish(e.status_code, e)
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except (SchedulerOverloaded, SchedulerUnavailable) as e:
+        error = scheduler_http_error(e)
+        trace.finish(error.status_code, e)
+        raise error
     except Exception as e:
+        trace.finish(500, e)
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
 # ============================================================================
@@ -372,7 +5859,7 @@ async def openai_chat_completions(request: ChatCompletionRequest):
 # ============================================================================
 
 @app.post("/v1/messages", tags=["Anthropic Compatible"])
-async def anthropic_messages(request: AnthropicCompletionRequest):
+async def anthropic_messages(request: AnthropicCompletionRequest, http_request: Request):
     """
     Anthropic-compatible messages endpoint.
     
@@ -392,6 +5879,8 @@ async def anthropic_messages(request: AnthropicCompletionRequest):
       }'
     ```
     """
+    # The trace's request id is also the message id
+    trace = tracer.begin("anthropic", "msg_", http_request)
     try:
         # Validate messages
         if not request.messages:
@@ -402,24 +5891,55 @@ async def anthropic_messages(request: AnthropicCompletionRequest):
         temperature = request.temperature if request.temperature is not None else TEMPERATURE_DEFAULT
         top_p = request.top_p or 0.9
         
-        # Build prompt using Anthropic format
-        prompt = build_anthropic_prompt(request.messages)
-        
-        # Generate response
-        result = generate_response(
-            prompt=prompt,
-            max_tokens=max_tokens,
-            temperature=temperature,
-            top_p=top_p,
-            stop_tokens=request.stop_sequences
-        )
+        # The deadline counts from arrival, so it also covers a model load
+        cancel = request_deadline(http_request, request.timeout)
         
-        # Get mapped model name
-        model_name = ANTHROPIC_MODEL_MAP.get("default", "smolllm2-135m-instruct")
+        # Route by the model field; the lease keeps the model loaded until the job is queued
+        runtime = await registry.get(request.model)
+        with runtime_lease(runtime):
+            # Render the prompt in Human/Assistant format, straight to token ids
+            prompt_started = time.perf_counter()
+            prompt = render_anthropic_prompt(runtime, request.messages, max_tokens)
+            prompt_finished = time.perf_counter()
+            metric_prompt_build.observe(prompt_finished - prompt_started, "anthropic")
+            trace.span("template", prompt_started, prompt_finished)
+            metric_requests.inc("anthropic")
+            
+            # Charge the client's token bucket before anything is queued
+            client = client_id(http_request)
+            rate_limiter.charge(client, request_cost(prompt, max_tokens))
+            
+            # Get mapped model name
+            model_name = registry.model_name(runtime, ANTHROPIC_MODEL_MAP)
+            trace.set(model=model_name, client=client, max_tokens=max_tokens, stream=bool(request.stream))
+            
+            if request.stream:
+                token_stream, job = open_stream(runtime, prompt, max_tokens, temperature, top_p, request.stop_sequences, "anthropic", client,
+                                                cancel=cancel)
+                cancel.watch()
+                return StreamingResponse(
+                    track_stream("anthropic", anthropic_stream_events(token_stream, job, trace.request_id, model_name, trace), trace,
+                                 cancel),
+                    media_type="text/event-stream",
+                    headers={**SSE_HEADERS, "X-Request-Id": trace.request_id}
+                )
+            
+            # Generate response on the inference worker (or serve it from the response cache)
+            metric_in_flight.inc("anthropic")
+            cancel.watch(http_request)
+            try:
+                result, headers = await generate_completion(runtime, prompt, max_tokens, temperature, top_p, request.stop_sequences,
+                                                            "anthropic", client, trace=trace, cancel=cancel)
+            finally:
+                cancel.close()
+                metric_in_flight.dec("anthropic")
         
         # Return Anthropic-compatible response
-        return JSONResponse(content={
-            "id": f"msg_{uuid.uuid4().hex[:12]}",
+        serialize_started = time.perf_counter()
+        headers["X-Request-Id"] = trace.request_id
+        stop_reason, stop_sequence = anthropic_stop_reason(result)
+        response = FastJSONResponse(content={
+            "id": trace.request_id,
             "type": "message",
             "role": "assistant",
             "model": model_name,
@@ -429,41 +5949,295 @@ async def anthropic_messages(request: AnthropicCompletionRequest):
                     "text": result["text"]
                 }
             ],
-            "stop_reason": "end_turn",
+            "stop_reason": stop_reason,
+            "stop_sequence": stop_sequence,
             "usage": {
                 "input_tokens": result["prompt_tokens"],
                 "output_tokens": result["completion_tokens"]
             }
-        })
+        }, headers=headers)
+        trace.span("serialize", serialize_started)
+        trace.finish(200)
+        return response
+    
+    except HTTPException as e:
+        trace.finish(e.status_code, e)
+        raise
+    except ContextLengthExceeded as e:
+        trace.finish(400, e)
+        raise HTTPException(status_code=400, detail=str(e))
+    except RequestCancelled as e:
+        trace.finish(e.status_code, e)
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except (SchedulerOverloaded, SchedulerUnavailable) as e:
+        error = scheduler_http_error(e)
+        trace.finish(error.status_code, e)
+        raise error
+    except Exception as e:
+        trace.finish(500, e)
+        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+
+# ============================================================================
+# OPENAI COMPATIBLE ENDPOINT: /v1/embeddings
+# ============================================================================
+
+def embedding_inputs(value: Union[str, List[str], List[int], List[List[int]]]) -> List[Union[str, List[int]]]:
+    """The request's input as a list of texts and token arrays."""
+    if isinstance(value, str):
+        return [value]
+    if value and isinstance(value[0], int):
+        return [value]
+    return list(value)
+
+def check_token_ids(inputs: List[Union[str, List[int]]], n_vocab: int):
+    """Reject token arrays with ids outside the vocabulary before they reach llama_decode."""
+    for i, item in enumerate(inputs):
+        if isinstance(item, str):
+            continue
+        invalid = next((token for token in item if not 0 <= token < n_vocab), None)
+        if invalid is not None:
+            raise HTTPException(
+                status_code=400,
+                detail=f"input[{i}] has token id {invalid}; ids must be in [0, {n_vocab})",
+            )
+
+def embedding_data(vectors: np.ndarray, encoding_format: str) -> List[Dict[str, Any]]:
+    """Embedding objects for each row, as float arrays or base64 of little-endian float32."""
+    if encoding_format == "base64":
+        return [
+            {"object": "embedding", "index": i, "embedding": base64.b64encode(row.astype("<f4", copy=False).tobytes()).decode("ascii")}
+            for i, row in enumerate(vectors)
+        ]
+    # Rows go to the encoder as arrays; orjson writes float32 without converting to lists
+    return [{"object": "embedding", "index": i, "embedding": row} for i, row in enumerate(vectors)]
+
+@app.post("/v1/embeddings", tags=["OpenAI Compatible"])
+async def openai_embeddings(request: EmbeddingRequest, http_request: Request):
+    """
+    OpenAI-compatible embeddings endpoint.
+    
+    Embeds up to EMBEDDING_MAX_INPUTS texts or token arrays per call with the
+    loaded GGUF: mean-pooled over tokens and normalized to unit length.
+    
+    Example Usage:
+    ```bash
+    curl -X POST http://localhost:8000/v1/embeddings \\
+      -H "Content-Type: application/json" \\
+      -d '{
+        "input": ["What is AI?", "Machine learning is a subfield of AI."],
+        "encoding_format": "base64"
+      }'
+    ```
+    """
+    trace = tracer.begin("embeddings", "emb-", http_request)
+    try:
+        inputs = embedding_inputs(request.input)
+        if not inputs:
+            raise HTTPException(status_code=400, detail="input must not be empty")
+        if len(inputs) > EMBEDDING_MAX_INPUTS:
+            raise HTTPException(status_code=400, detail=f"At most {EMBEDDING_MAX_INPUTS} inputs per request")
+        
+        cancel = request_deadline(http_request, request.timeout)
+        runtime = await registry.get(request.model)
+        check_token_ids(inputs, runtime.chat_renderer.llm.n_vocab())
+        with runtime_lease(runtime):
+            cost = sum(request_cost(item, 0) for item in inputs)
+            client = client_id(http_request)
+            rate_limiter.charge(client, cost)
+            metric_requests.inc("embeddings")
+            model_name = registry.model_name(runtime, OPENAI_MODEL_MAP)
+            trace.set(model=model_name, client=client, inputs=len(inputs))
+            
+            metric_in_flight.inc("embeddings")
+            cancel.watch(http_request)
+            submitted = time.perf_counter()
+            try:
+                (vectors, prompt_tokens), queue_wait = await scheduler.submit(
+                    embed_inputs, runtime, inputs, client=client, cost=cost, cancel=cancel
+                )
+            finally:
+                cancel.close()
+                metric_in_flight.dec("embeddings")
+        trace.span("queue", submitted, submitted + queue_wait)
+        trace.span("embed", submitted + queue_wait)
+        trace.set(prompt_tokens=prompt_tokens)
+        metric_queue_wait.observe(queue_wait, "embeddings")
+        metric_prompt_tokens.inc("embeddings", amount=prompt_tokens)
+        
+        serialize_started = time.perf_counter()
+        response = FastJSONResponse(content={
+            "object": "list",
+            "data": embedding_data(vectors, request.encoding_format),
+            "model": model_name,
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "total_tokens": prompt_tokens
+            }
+        }, headers={"X-Queue-Wait-Ms": f"{queue_wait * 1000:.2f}", "X-Request-Id": trace.request_id})
+        trace.span("serialize", serialize_started)
+        trace.finish(200)
+        return response
     
-    except HTTPException:
+    except HTTPException as e:
+        trace.finish(e.status_code, e)
         raise
+    except ContextLengthExceeded as e:
+        trace.finish(400, e)
+        raise HTTPException(status_code=400, detail=str(e))
+    except RequestCancelled as e:
+        trace.finish(e.status_code, e)
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except (SchedulerOverloaded, SchedulerUnavailable) as e:
+        error = scheduler_http_error(e)
+        trace.finish(error.status_code, e)
+        raise error
     except Exception as e:
+        trace.finish(500, e)
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
+# ============================================================================
+# BATCH ENDPOINTS: /v1/batches
+# ============================================================================
+
+def get_batch(batch_id: str) -> BatchJob:
+    job = batch_manager.jobs.get(batch_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Batch {batch_id} not found")
+    return job
+
+@app.post("/v1/batches", tags=["Batches"])
+async def create_batch(request: Request):
+    """
+    Create a bulk job from a JSONL request body.
+    
+    Each line is `{"custom_id": "...", "method": "POST", "url": "/v1/chat/completions", "body": {...}}`
+    with a chat completions request as the body.
+    
+    Example Usage:
+    ```bash
+    curl -X POST http://localhost:8000/v1/batches \\
+      -H "Content-Type: application/jsonl" \\
+      --data-binary @requests.jsonl
+    ```
+    """
+    try:
+        job = await batch_manager.create(request.stream())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return FastJSONResponse(content=job.meta)
+
+@app.get("/v1/batches", tags=["Batches"])
+async def list_batches():
+    """List bulk jobs, newest first."""
+    jobs = sorted(batch_manager.jobs.values(), key=lambda job: job.meta["created_at"], reverse=True)
+    return FastJSONResponse(content={"object": "list", "data": [job.meta for job in jobs]})
+
+@app.get("/v1/batches/{batch_id}", tags=["Batches"])
+async def retrieve_batch(batch_id: str):
+    """Status and request_counts of a bulk job."""
+    return FastJSONResponse(content=get_batch(batch_id).meta)
+
+@app.get("/v1/batches/{batch_id}/output", tags=["Batches"])
+async def batch_output(batch_id: str):
+    """Results as JSONL, streamed as they are produced until the job finishes."""
+    job = get_batch(batch_id)
+    return StreamingResponse(batch_manager.follow_output(job), media_type="application/x-ndjson")
+
+@app.post("/v1/batches/{batch_id}/cancel", tags=["Batches"])
+async def cancel_batch(batch_id: str):
+    """Stop dispatching new requests; in-flight ones finish and are written out."""
+    job = get_batch(batch_id)
+    batch_manager.cancel(job)
+    return FastJSONResponse(content=job.meta)
+
 # ============================================================================
 # ADDITIONAL COMPATIBILITY ENDPOINTS
 # ============================================================================
 
 @app.get("/v1/models", tags=["Compatibility"])
 async def list_models():
-    """List available models (OpenAI format)."""
-    return JSONResponse(content={
+    """List the loaded models (OpenAI format)."""
+    return FastJSONResponse(content={
         "object": "list",
         "data": [
             {
-                "id": "smollm2-135m-instruct",
+                "id": runtime.name,
                 "object": "model",
-                "created": 0,
-                "owned_by": "HuggingFaceTB"
+                "created": int(runtime.loaded_at or 0),
+                "owned_by": "HuggingFaceTB",
+                "path": runtime.path,
+                "size_bytes": runtime.size_bytes,
+                "in_flight": runtime.in_flight,
+                "default": runtime.name == registry.default,
             }
+            for runtime in registry.runtimes.values()
         ]
     })
 
+def require_admin(http_request: Request):
+    """Reject model management calls unless they carry ADMIN_TOKEN."""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Model management is disabled; set ADMIN_TOKEN to enable it")
+    token = http_request.headers.get("x-admin-token", "")
+    authorization = http_request.headers.get("authorization", "")
+    if not token and authorization.lower().startswith("bearer "):
+        token = authorization[7:].strip()
+    if not hmac.compare_digest(token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8")):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
+@app.post("/v1/models/{model_id}/load", tags=["Models"])
+async def load_model_endpoint(model_id: str, http_request: Request, request: Optional[ModelLoadRequest] = None):
+    """
+    Load a model, or hot-swap a new version of a loaded one, in the background.
+    
+    Requests keep going to the current version until the new one is ready;
+    in-flight requests then finish on the old version before it is freed.
+    Poll /v1/models or /health for progress.
+    
+    Example Usage:
+    ```bash
+    curl -X POST http://localhost:8000/v1/models/smollm2-135m-instruct/load \\
+      -H "Authorization: Bearer $ADMIN_TOKEN" \\
+      -H "Content-Type: application/json" \\
+      -d '{"path": "SmolLM2-135M-Instruct-Q8_0.gguf"}'
+    ```
+    """
+    require_admin(http_request)
+    path = None
+    if request is not None and request.path:
+        try:
+            path = resolve_model_file(request.path)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    elif model_id not in registry.paths:
+        raise HTTPException(status_code=404, detail=f"Model {model_id} is not registered; pass a path to add it")
+    registry.load_in_background(model_id, path)
+    return FastJSONResponse(status_code=202, content={
+        "id": model_id,
+        "object": "model",
+        "status": "loading",
+        "path": path or registry.paths[model_id],
+    })
+
+@app.delete("/v1/models/{model_id}", tags=["Models"])
+async def unload_model(model_id: str, http_request: Request):
+    """
+    Unload a model once its in-flight requests finish. Registered models reload
+    on their next request; the default model cannot be unloaded (409).
+    """
+    require_admin(http_request)
+    try:
+        registry.unload(model_id)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e.args[0]))
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return FastJSONResponse(content={"id": model_id, "object": "model", "deleted": True})
+
 @app.get("/v1/model/{model_id}", tags=["Compatibility"])
 async def get_model(model_id: str):
     """Get model information (OpenAI format)."""
-    return JSONResponse(content={
+    return FastJSONResponse(content={
         "id": model_id,
         "object": "model",
         "created": 0,
@@ -479,29 +6253,56 @@ async def get_model(model_id: str):
 
 @app.get("/health", tags=["Health"])
 async def health_check():
-    """Health check endpoint for load balancers and monitoring."""
-    model_loaded = model is not None
+    """
+    Health check endpoint for load balancers and monitoring.
+    
+    Returns 503 with status "loading" (or "error") until the default model
+    has loaded and warmed up, then 200 with status "ready".
+    """
+    model_loaded = registry.ready
+    model_path = registry.paths[registry.default]
     model_size = 0
     
-    if os.path.exists(MODEL_PATH):
-        model_size = round(os.path.getsize(MODEL_PATH) / (1024 * 1024), 2)
+    if os.path.exists(model_path):
+        model_size = round(os.path.getsize(model_path) / (1024 * 1024), 2)
     
-    return {
-        "status": "healthy" if model_loaded else "loading",
-        "model_path": MODEL_PATH,
+    if model_loaded:
+        status = "ready"
+    elif registry.default in registry.errors:
+        status = "error"
+    else:
+        status = "loading"
+    
+    # 503 until ready, so load balancers only route to replicas that can serve
+    return FastJSONResponse(status_code=200 if model_loaded else 503, content={
+        "status": status,
+        "model_path": model_path,
         "model_size_mb": model_size,
         "model_loaded": model_loaded,
         "context_size": CONTEXT_SIZE,
+        "models": registry.stats(),
+        "scheduler": scheduler.stats(),
+        "rate_limit": rate_limiter.stats(),
+        "response_cache": response_cache.stats() if response_cache is not None else None,
+        "coalescing": coalescer.stats(),
+        "tracing": tracer.stats(),
+        "uptime_seconds": round(time.perf_counter() - PROCESS_STARTED, 2),
         "api_version": "v1"
-    }
+    })
+
+@app.get("/metrics", tags=["Health"])
+async def metrics_endpoint():
+    """Prometheus metrics in the text exposition format."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 @app.get("/", tags=["Root"])
 async def root():
     """Root endpoint with API information."""
+    model_path = registry.paths[registry.default]
     model_size = 0
     
-    if os.path.exists(MODEL_PATH):
-        model_size = round(os.path.getsize(MODEL_PATH) / (1024 * 1024), 2)
+    if os.path.exists(model_path):
+        model_size = round(os.path.getsize(model_path) / (1024 * 1024), 2)
     
     return {
         "name": "SmolLM2-135M-Instruct API",
@@ -516,8 +6317,11 @@ async def root():
         "endpoints": {
             "openai_chat": "/v1/chat/completions",
             "anthropic_messages": "/v1/messages",
+            "embeddings": "/v1/embeddings",
             "models": "/v1/models",
-            "health": "/health"
+            "batches": "/v1/batches",
+            "health": "/health",
+            "metrics": "/metrics"
         },
         "docs": {
             "openapi": "/docs",
@@ -531,5 +6335,6 @@ async def root():
 
 if __name__ == "__main__":
     import uvicorn
+    configure_logging()
     port = int(os.environ.get("PORT", 8000))
     uvicorn.run(app, host="0.0.0.0", port=port)
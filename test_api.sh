@@ -44,9 +44,19 @@ FAILED=0
 # Test 1: Health Check
 # =============================================================================
 echo -e "${BLUE}[TEST 1]${NC} Health Check..."
-HEALTH=$(curl -s "$URL/health" 2>/dev/null)
+# /health answers 503 until the model has loaded and warmed up (000: not listening yet)
+for ATTEMPT in $(seq 1 60); do
+    HEALTH=$(curl -s -w '\n%{http_code}' "$URL/health" 2>/dev/null)
+    HEALTH_CODE=$(echo "$HEALTH" | tail -n 1)
+    HEALTH=$(echo "$HEALTH" | sed '$d')
+    if [ "$HEALTH_CODE" != "503" ] && [ "$HEALTH_CODE" != "000" ]; then
+        break
+    fi
+    echo "  Model loading, waiting... ($ATTEMPT/60)"
+    sleep 5
+done
 
-if echo "$HEALTH" | grep -q "healthy"; then
+if [ "$HEALTH_CODE" = "200" ] && echo "$HEALTH" | grep -Eq '"status":"(ready|healthy)"'; then
     echo -e "  ${GREEN}✓${NC} Health check passed"
     MODEL_PATH=$(echo "$HEALTH" | grep -o '"model_path":"[^"]*"' | cut -d'"' -f4)
     MODEL_SIZE=$(echo "$HEALTH" | grep -o '"model_size_mb":[^,]*' | cut -d':' -f2)
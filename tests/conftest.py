@@ -0,0 +1,94 @@
+"""
+Shared setup for the test suite.
+
+main reads its configuration from the environment when it is imported, so
+the environment is prepared here first: caches and batch files go to a
+temporary directory, and MODEL_PATH points at a tiny random GGUF written
+with benchmark.make_tiny_model (or at TEST_MODEL_PATH). Tests that run the
+model are skipped when neither is available.
+"""
+
+import asyncio
+import contextlib
+import importlib.util
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+sys.path.insert(0, ROOT)
+
+WORK_DIR = tempfile.mkdtemp(prefix="llm-api-tests-")
+MODEL_PATH = os.environ.get("TEST_MODEL_PATH") or os.path.join(WORK_DIR, "tiny.gguf")
+if not os.path.exists(MODEL_PATH) and importlib.util.find_spec("gguf") is not None:
+    import benchmark
+
+    with contextlib.redirect_stdout(sys.stderr):
+        benchmark.make_tiny_model(MODEL_PATH)
+HAVE_MODEL = os.path.exists(MODEL_PATH)
+
+os.environ.update({
+    "MODEL_PATH": MODEL_PATH,
+    "MODEL_DIR": os.path.dirname(MODEL_PATH),
+    "MODEL_PREFETCH": "off",
+    "CONTEXT_SIZE": "1024",
+    "BATCH_DIR": os.path.join(WORK_DIR, "batches"),
+    "RESPONSE_CACHE_DIR": os.path.join(WORK_DIR, "response_cache"),
+    "KV_SNAPSHOT_DIR": os.path.join(WORK_DIR, "kv_snapshots"),
+})
+
+import main  # noqa: E402
+
+needs_model = pytest.mark.skipif(not HAVE_MODEL, reason="needs the gguf package or TEST_MODEL_PATH for a test model")
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+@pytest.fixture(scope="session")
+def runtime():
+    """The test model loaded on the serial path (no batch engine or worker processes)."""
+    if not HAVE_MODEL:
+        pytest.skip("needs the gguf package or TEST_MODEL_PATH for a test model")
+    loaded = main.ModelRuntime("tiny", MODEL_PATH)
+    loaded.load()
+    yield loaded
+    loaded.unload()
+
+@contextlib.asynccontextmanager
+async def serve(monkeypatch, ready: bool = True, **settings):
+    """
+    Run the app's lifespan with module settings overridden and yield an
+    httpx client talking to it in process. The model registry, scheduler and
+    caches are rebuilt so that every test starts from a fresh server. With
+    ready=False the client is yielded at once, while the models still load.
+    """
+    import httpx
+
+    if not HAVE_MODEL:
+        pytest.skip("needs the gguf package or TEST_MODEL_PATH for a test model")
+    for name, value in settings.items():
+        monkeypatch.setattr(main, name, value)
+    registry = main.ModelRegistry(main.parse_model_specs(main.MODELS), main.MODEL_MEMORY_BUDGET)
+    monkeypatch.setattr(main, "registry", registry)
+    monkeypatch.setattr(main, "scheduler", main.InferenceScheduler(
+        main.INFERENCE_QUEUE_DEPTH,
+        main.INFERENCE_QUEUE_TIMEOUT,
+        num_workers=main.BATCH_SEQ_SLOTS * max(1, main.WORKER_PROCESSES) * len(registry.paths),
+        token_budget=main.ADMISSION_TOKEN_BUDGET,
+        weights=main.parse_client_weights(main.CLIENT_WEIGHTS),
+    ))
+    monkeypatch.setattr(main, "rate_limiter", main.RateLimiter(main.CLIENT_TOKENS_PER_SECOND, main.CLIENT_TOKEN_BURST))
+    monkeypatch.setattr(main, "response_cache", main.create_response_cache())
+    monkeypatch.setattr(main, "coalescer", main.RequestCoalescer())
+    monkeypatch.setattr(main, "batch_manager", main.BatchManager(main.BATCH_DIR))
+    async with main.lifespan(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=60) as client:
+            while ready and (await client.get("/health")).status_code != 200:
+                assert not registry.errors, registry.errors
+                await asyncio.sleep(0.02)
+            yield client
@@ -0,0 +1,159 @@
+import asyncio
+import threading
+
+import pytest
+from starlette.requests import Request
+
+import main
+from conftest import serve
+
+def http_request(headers=(), host="10.0.0.1"):
+    return Request({"type": "http", "headers": [(k.encode(), v.encode()) for k, v in headers], "client": (host, 1234)})
+
+def test_clients_are_api_keys_else_addresses():
+    key = main.api_key_client("sk-secret")
+    assert key.startswith("key:") and "sk-secret" not in key
+    assert main.client_id(http_request([("x-api-key", "sk-secret")])) == key
+    assert main.client_id(http_request([("authorization", "Bearer sk-secret")])) == key
+    assert main.client_id(http_request()) == "ip:10.0.0.1"
+    assert main.client_id(None) == "anonymous"
+
+def test_parse_client_weights():
+    weights = main.parse_client_weights("sk-a=2; ip:10.0.0.1=0.5;batch=0.25;")
+    assert weights == {main.api_key_client("sk-a"): 2.0, "ip:10.0.0.1": 0.5, "batch": 0.25}
+    with pytest.raises(ValueError, match="is not name=weight"):
+        main.parse_client_weights("=2")
+
+def test_request_cost_is_prompt_plus_max_tokens():
+    assert main.request_cost([1, 2, 3], 10) == 13
+    assert main.request_cost("x" * 40, 10) == 20
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: now[0])
+    return now
+
+def test_token_buckets_refill_at_their_rate(clock):
+    bucket = main.TokenBucket(rate=10, capacity=100)
+    assert bucket.take(80) == 0
+    assert bucket.take(40) == pytest.approx(2.0)
+    clock[0] += 2
+    assert bucket.take(40) == 0
+    clock[0] += 100
+    # Refills stop at the capacity
+    assert bucket.take(101) == pytest.approx(0.1)
+
+def test_rate_limiter_charges_each_client_separately(clock):
+    limiter = main.RateLimiter(tokens_per_second=10, burst=100, max_clients=2)
+    limiter.charge("a", 60)
+    with pytest.raises(main.RateLimited) as rejected:
+        limiter.charge("a", 60)
+    assert rejected.value.retry_after == pytest.approx(2.0)
+    assert rejected.value.reason == "rate_limit"
+    limiter.charge("b", 60)
+    # A request larger than the burst is charged the burst
+    limiter.charge("c", 5000)
+    assert limiter.stats() == {"tokens_per_second": 10, "burst": 100, "clients": 2, "rejected": 1}
+    # The least recently seen client was forgotten and starts with a full bucket
+    limiter.charge("a", 100)
+
+def test_a_zero_rate_never_limits():
+    limiter = main.RateLimiter(tokens_per_second=0, burst=1)
+    for _ in range(3):
+        limiter.charge("a", 10_000)
+    assert limiter.stats()["clients"] == 0
+
+@pytest.fixture
+def blocked():
+    """Release event for a job that keeps the only worker busy while the others queue."""
+    release = threading.Event()
+    yield release
+    release.set()
+
+async def run_in_order(scheduler, blocked, clients):
+    order = []
+    running = scheduler.enqueue(blocked.wait, client="first")
+    while scheduler.queue_depth:
+        await asyncio.sleep(0.001)
+    jobs = [scheduler.enqueue(order.append, client, client=client) for client in clients]
+    blocked.set()
+    await running.future
+    for job in jobs:
+        await job.future
+    return order
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("weights, expected", [
+    ({}, ["a", "b"] * 4 + ["a"] * 2),
+    ({"a": 2.0}, ["a", "b", "a", "a", "b", "a", "a", "b", "a", "b"]),
+])
+async def test_queued_clients_take_turns_by_weight(blocked, weights, expected):
+    scheduler = main.InferenceScheduler(max_queue_depth=20, queue_timeout=0, weights=weights)
+    scheduler.start()
+    try:
+        # a queues its whole backlog before b shows up
+        order = await run_in_order(scheduler, blocked, ["a"] * 6 + ["b"] * 4)
+    finally:
+        scheduler.stop(timeout=5)
+    assert order == expected
+
+@pytest.mark.anyio
+async def test_the_token_budget_sheds_work_at_the_door(blocked):
+    scheduler = main.InferenceScheduler(max_queue_depth=20, queue_timeout=0, token_budget=100)
+    scheduler.start()
+    try:
+        running = scheduler.enqueue(blocked.wait, cost=60)
+        with pytest.raises(main.SchedulerOverloaded) as rejected:
+            scheduler.enqueue(lambda: "too much", cost=50)
+        fits = scheduler.enqueue(lambda: "fits", cost=40)
+        assert scheduler.tokens_in_flight == 100
+        blocked.set()
+        await running.future
+        assert await fits.future == "fits"
+        # A job larger than the whole budget still runs once nothing else is in flight
+        alone = scheduler.enqueue(lambda: "alone", cost=500)
+        assert await alone.future == "alone"
+        await asyncio.sleep(0.01)
+        stats = scheduler.stats()
+    finally:
+        scheduler.stop(timeout=5)
+    assert rejected.value.reason == "token_budget"
+    assert rejected.value.retry_after > 0
+    assert stats["rejected_over_budget"] == 1
+    assert stats["tokens_in_flight"] == 0
+
+CHAT = {"messages": [{"role": "user", "content": "hello"}], "max_tokens": 4, "temperature": 0}
+
+@pytest.mark.anyio
+async def test_rate_limited_clients_get_429_with_retry_after(monkeypatch):
+    async with serve(monkeypatch, CLIENT_TOKENS_PER_SECOND=0.5, CLIENT_TOKEN_BURST=100,
+                     RESPONSE_CACHE="none") as client:
+        statuses = []
+        while 429 not in statuses:
+            assert len(statuses) < 10
+            response = await client.post("/v1/chat/completions", json=CHAT, headers={"x-api-key": "a"})
+            statuses.append(response.status_code)
+        other = await client.post("/v1/chat/completions", json=CHAT, headers={"x-api-key": "b"})
+        metrics = (await client.get("/metrics")).text
+    assert statuses[:-1] == [200] * (len(statuses) - 1) and len(statuses) > 1
+    assert int(response.headers["Retry-After"]) >= 1
+    assert "rate limit" in response.json()["detail"]
+    assert other.status_code == 200
+    assert 'reason="rate_limit"' in metrics
+
+@pytest.mark.anyio
+async def test_requests_over_the_token_budget_get_429(monkeypatch):
+    # Ignore the test model's end-of-generation token so the first request keeps the budget busy
+    monkeypatch.setattr(main, "end_of_generation_tokens", lambda model: set())
+    long = {**CHAT, "max_tokens": 700, "stop": []}
+    async with serve(monkeypatch, ADMISSION_TOKEN_BUDGET=500, RESPONSE_CACHE="none", REQUEST_COALESCING=0) as client:
+        generation = asyncio.ensure_future(client.post("/v1/chat/completions", json=long))
+        while not main.scheduler.tokens_in_flight and not generation.done():
+            await asyncio.sleep(0.001)
+        rejected = await client.post("/v1/chat/completions", json=CHAT)
+        first = await generation
+    assert first.status_code == 200
+    assert rejected.status_code == 429
+    assert "token budget" in rejected.json()["detail"]
+    assert "Retry-After" in rejected.headers
@@ -0,0 +1,80 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+import main
+from conftest import needs_model
+
+PROMPTS = ["the quick brown fox", "hello world", "the lazy dog jumps over"]
+
+@pytest.fixture(scope="module")
+def engine(runtime):
+    batch = main.BatchEngine(runtime.model, n_slots=2, n_batch=64, n_ctx_per_slot=256)
+    batch.start()
+    yield batch
+    batch.stop(timeout=10)
+
+def serial(runtime, prompt, max_tokens=12):
+    return main.generate_response(runtime, prompt, max_tokens=max_tokens, temperature=0, top_p=1.0, stop_tokens=[])
+
+def test_sample_token_is_greedy_at_temperature_zero():
+    logits = np.array([0.1, 3.0, 2.9, -1.0], dtype=np.float32)
+    assert main.sample_token(logits, 0.0, 1.0, np.random.default_rng(0)) == 1
+
+def test_sample_token_top_p_keeps_the_nucleus():
+    logits = np.array([10.0, 0.0, 0.0, 0.0], dtype=np.float32)
+    rng = np.random.default_rng(0)
+    assert {main.sample_token(logits, 1.0, 0.5, rng) for _ in range(50)} == {0}
+    spread = np.zeros(4, dtype=np.float32)
+    assert len({main.sample_token(spread, 1.0, 1.0, rng) for _ in range(200)}) == 4
+
+@needs_model
+def test_greedy_output_matches_the_serial_path(runtime, engine):
+    for prompt in PROMPTS:
+        expected = serial(runtime, prompt)
+        result = engine.generate(prompt, 12, 0.0, 1.0, [])
+        assert result["text"] == expected["text"]
+        assert result["completion_tokens"] == expected["completion_tokens"]
+        assert result["prompt_tokens"] == expected["prompt_tokens"]
+
+@needs_model
+def test_concurrent_requests_share_decode_steps(runtime, engine):
+    expected = {prompt: serial(runtime, prompt, 16)["text"] for prompt in PROMPTS}
+    before = engine.stats()
+    # More requests than slots: the extra ones wait in the pending queue
+    with ThreadPoolExecutor(len(PROMPTS) * 2) as pool:
+        results = list(pool.map(lambda p: (p, engine.generate(p, 16, 0.0, 1.0, [])), PROMPTS * 2))
+    for prompt, result in results:
+        assert result["text"] == expected[prompt]
+    after = engine.stats()
+    generated = after["generated_tokens"] - before["generated_tokens"]
+    assert generated == sum(result["completion_tokens"] for _, result in results)
+    # Sequences decode together, so there are fewer steps than generated tokens
+    assert after["steps"] - before["steps"] < generated
+    assert after["active"] == 0 and after["pending"] == 0
+
+@needs_model
+def test_streamed_text_adds_up_to_the_result(engine):
+    pieces = []
+    result = engine.generate("hello world", 12, 0.0, 1.0, [], on_text=pieces.append)
+    assert "".join(pieces).strip() == result["text"]
+
+@needs_model
+def test_on_text_returning_false_cancels(engine):
+    pieces = []
+
+    def on_text(text):
+        pieces.append(text)
+        return False
+
+    result = engine.generate("the quick brown fox", 200, 0.0, 1.0, [], on_text=on_text)
+    # The sequence leaves its slot without a finish reason, well short of max_tokens
+    assert result["finish_reason"] is None
+    assert result["completion_tokens"] < 200
+    assert len(pieces) <= result["completion_tokens"]
+
+@needs_model
+def test_prompt_longer_than_a_slot_is_rejected(engine):
+    with pytest.raises(ValueError, match="exceed context window"):
+        engine.generate(list(range(5, 300)), 4, 0.0, 1.0, [])
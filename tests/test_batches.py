@@ -0,0 +1,151 @@
+import json
+
+import pytest
+
+import main
+from conftest import needs_model, serve
+
+pytestmark = pytest.mark.anyio
+
+def line(custom_id, content, history=(), max_tokens=8):
+    messages = [{"role": "user", "content": text} for text in history] + [{"role": "user", "content": content}]
+    return {"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions",
+            "body": {"messages": messages, "max_tokens": max_tokens, "temperature": 0}}
+
+def jsonl(items):
+    return "".join(json.dumps(item) + "\n" for item in items)
+
+@pytest.mark.parametrize("body, error", [
+    ("not json\n", "line 1: invalid JSON"),
+    (jsonl([{"body": {}}]), "line 1: custom_id is required"),
+    (jsonl([{"custom_id": "a", "body": []}]), "line 1: body must be an object"),
+    (jsonl([{"custom_id": "a", "url": "/v1/embeddings", "body": {}}]), "only /v1/chat/completions"),
+    (jsonl([line("a", "hi"), line("a", "hi")]), "line 2: duplicate custom_id 'a'"),
+    ("\n\n", "batch contains no requests"),
+])
+def test_invalid_input_is_rejected(tmp_path, body, error):
+    path = tmp_path / "input.jsonl"
+    path.write_text(body)
+    with pytest.raises(ValueError, match=error):
+        main.BatchManager._validate(str(path))
+
+def test_scan_output_drops_a_partial_last_line(tmp_path):
+    job = main.BatchJob(str(tmp_path), {"id": "batch_x", "status": "in_progress",
+                                        "request_counts": {"total": 3, "completed": 0, "failed": 0}})
+    complete = jsonl([{"custom_id": "a", "error": None}, {"custom_id": "b", "error": {"code": "x"}}])
+    with open(job.output_path, "w") as f:
+        f.write(complete + '{"custom_id": "c", "err')
+    assert job.scan_output() == {"a", "b"}
+    assert job.meta["request_counts"] == {"total": 3, "completed": 1, "failed": 1}
+    with open(job.output_path) as f:
+        assert f.read() == complete
+
+def test_plan_groups_shared_history_and_skips_answered_lines(tmp_path):
+    job = main.BatchJob(str(tmp_path), {"id": "batch_x", "status": "in_progress"})
+    items = [
+        line("a1", "short", history=["system a"]),
+        line("b1", "short", history=["system b"]),
+        line("a2", "a much longer question", history=["system a"]),
+        line("b2", "a much longer question", history=["system b"]),
+        line("a3", "done already", history=["system a"]),
+    ]
+    with open(job.input_path, "w") as f:
+        f.write(jsonl(items))
+    starts, offset = {}, 0
+    for item in items:
+        starts[offset] = item["custom_id"]
+        offset += len(json.dumps(item)) + 1
+
+    plan = main.BatchManager._plan(job, done={"a3"})
+    order = [starts[offset] for offset in plan]
+    assert sorted(order) == ["a1", "a2", "b1", "b2"]
+    # Lines sharing a history run back to back, longest first
+    groups = [order[:2], order[2:]]
+    assert sorted(groups) == [["a2", "a1"], ["b2", "b1"]]
+    # The same input always plans the same way (also across processes)
+    assert main.BatchManager._plan(job, done={"a3"}) == plan
+
+async def wait_for(client, batch_id):
+    response = await client.get(f"/v1/batches/{batch_id}/output")
+    assert response.status_code == 200
+    return [json.loads(raw) for raw in response.text.splitlines()]
+
+@needs_model
+async def test_batch_output_matches_the_online_api(monkeypatch, tmp_path):
+    items = [line(f"r{i}", "hello " * (i + 1)) for i in range(4)]
+    items.append({"custom_id": "bad", "body": {"messages": "nope"}})
+    async with serve(monkeypatch, BATCH_DIR=str(tmp_path), RESPONSE_CACHE="none") as client:
+        assert (await client.post("/v1/batches", content="not json\n")).status_code == 400
+        created = (await client.post("/v1/batches", content=jsonl(items))).json()
+        assert created["status"] == "in_progress"
+        assert created["request_counts"]["total"] == 5
+        output = await wait_for(client, created["id"])
+        meta = (await client.get(f"/v1/batches/{created['id']}")).json()
+        online = (await client.post("/v1/chat/completions", json=items[2]["body"])).json()
+        listed = (await client.get("/v1/batches")).json()["data"]
+        missing = await client.get("/v1/batches/batch_missing")
+    assert meta["status"] == "completed"
+    assert meta["request_counts"] == {"total": 5, "completed": 4, "failed": 1}
+    by_id = {result["custom_id"]: result for result in output}
+    assert sorted(by_id) == ["bad", "r0", "r1", "r2", "r3"]
+    assert by_id["bad"]["error"]["code"] == "invalid_request"
+    assert by_id["bad"]["response"]["status_code"] == 400
+    body = by_id["r2"]["response"]["body"]
+    assert body["choices"][0]["message"] == online["choices"][0]["message"]
+    assert body["usage"] == online["usage"]
+    assert [job["id"] for job in listed] == [created["id"]]
+    assert missing.status_code == 404
+
+@needs_model
+async def test_an_interrupted_batch_resumes_without_repeating_lines(monkeypatch, tmp_path):
+    items = [line(f"r{i}", "hello " * (i + 1)) for i in range(6)]
+    async with serve(monkeypatch, BATCH_DIR=str(tmp_path), RESPONSE_CACHE="none") as client:
+        created = (await client.post("/v1/batches", content=jsonl(items))).json()
+        first_run = await wait_for(client, created["id"])
+
+    # Roll the job back to a crash after three lines, mid-way through writing the fourth
+    directory = tmp_path / created["id"]
+    kept = "".join(json.dumps(result) + "\n" for result in first_run[:3])
+    (directory / "output.jsonl").write_text(kept + json.dumps(first_run[3])[:20])
+    meta = json.loads((directory / "batch.json").read_text())
+    meta["status"] = "in_progress"
+    (directory / "batch.json").write_text(json.dumps(meta))
+
+    async with serve(monkeypatch, BATCH_DIR=str(tmp_path), RESPONSE_CACHE="none") as client:
+        output = await wait_for(client, created["id"])
+        meta = (await client.get(f"/v1/batches/{created['id']}")).json()
+    assert meta["status"] == "completed"
+    assert meta["request_counts"] == {"total": 6, "completed": 6, "failed": 0}
+    assert output[:3] == first_run[:3]
+    assert sorted(result["custom_id"] for result in output) == [f"r{i}" for i in range(6)]
+    texts = {result["custom_id"]: result["response"]["body"]["choices"][0]["message"]["content"]
+             for result in output}
+    assert texts == {result["custom_id"]: result["response"]["body"]["choices"][0]["message"]["content"]
+                     for result in first_run}
+
+@needs_model
+async def test_cancelling_stops_dispatching(monkeypatch, tmp_path):
+    items = [line(f"r{i}", "hello", max_tokens=32) for i in range(40)]
+    async with serve(monkeypatch, BATCH_DIR=str(tmp_path), RESPONSE_CACHE="none", BATCH_CONCURRENCY=1) as client:
+        created = (await client.post("/v1/batches", content=jsonl(items))).json()
+        assert (await client.post(f"/v1/batches/{created['id']}/cancel")).json()["status"] == "cancelling"
+        output = await wait_for(client, created["id"])
+        meta = (await client.get(f"/v1/batches/{created['id']}")).json()
+    assert meta["status"] == "cancelled"
+    assert len(output) < len(items)
+    assert meta["request_counts"]["completed"] == len(output)
+
+@needs_model
+async def test_overloaded_lines_fail_after_the_retry_cap(monkeypatch, tmp_path):
+    attempts = []
+
+    async def overloaded(*args, **kwargs):
+        attempts.append(1)
+        raise main.SchedulerOverloaded("queue is full")
+
+    async with serve(monkeypatch, BATCH_DIR=str(tmp_path), BATCH_MAX_RETRIES=2):
+        monkeypatch.setattr(main, "generate_completion", overloaded)
+        result = await main.BatchManager._execute(line("r0", "hello"))
+    assert len(attempts) == 3
+    assert result["response"]["status_code"] == 503
+    assert result["error"] == {"code": "server_overloaded", "message": "queue is full"}
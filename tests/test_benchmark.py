@@ -0,0 +1,55 @@
+import argparse
+import json
+import random
+
+import pytest
+
+import benchmark
+
+def test_percentiles_in_milliseconds():
+    summary = benchmark.percentiles([i / 1000 for i in range(1, 101)])
+    assert summary == {"mean": 50.5, "p50": 51.0, "p95": 95.0, "p99": 99.0, "max": 100.0}
+    assert benchmark.percentiles([]) == {}
+
+def test_build_payload_per_api():
+    rng = random.Random(0)
+    openai = benchmark.build_payload("openai", 5, 16, 0.7, True, rng, choices=3)
+    assert len(openai["messages"][0]["content"].split()) == 5
+    assert (openai["max_tokens"], openai["stream"], openai["n"]) == (16, True, 3)
+    anthropic = benchmark.build_payload("anthropic", 5, 16, 0.7, False, rng, choices=3)
+    assert "n" not in anthropic and "stream" not in anthropic
+    assert anthropic["model"].startswith("claude")
+
+def test_payloads_are_reproducible_from_the_seed():
+    first = benchmark.build_payload("openai", 8, 16, 0.7, False, random.Random(42))
+    assert benchmark.build_payload("openai", 8, 16, 0.7, False, random.Random(42)) == first
+
+def test_compare_reports_relative_changes(tmp_path, capsys):
+    def result(tps, p50):
+        latency = {"p50": p50, "p95": p50, "p99": p50}
+        return {"tokens_per_second": tps, "latency_ms": latency, "ttft_ms": latency}
+
+    old, new = tmp_path / "old.json", tmp_path / "new.json"
+    old.write_text(json.dumps({"meta": {"commit": "aaa"}, "results": {"openai": result(100.0, 20.0)}}))
+    new.write_text(json.dumps({"meta": {"commit": "bbb"}, "results": {"openai": result(150.0, 10.0)}}))
+    benchmark.compare(str(old), str(new))
+    output = capsys.readouterr().out
+    assert output.startswith("aaa -> bbb")
+    assert "+50.0%" in output and "-50.0%" in output
+
+@pytest.mark.parametrize("api", ["openai", "anthropic"])
+@pytest.mark.parametrize("stream", [False, True])
+def test_load_run_against_the_mock_server(api, stream):
+    pytest.importorskip("uvicorn")
+    process, url = benchmark.start_server("mock", None, {}, timeout=60)
+    try:
+        args = argparse.Namespace(seed=0, prompt_words=[4, 8], max_tokens=[8], temperature=0.7, stream=stream,
+                                  choices=1, requests=6, warmup=1, concurrency=3)
+        summary = benchmark.run_load(url, api, args)
+    finally:
+        benchmark.stop_server(process)
+    assert (summary["requests"], summary["errors"]) == (6, 0)
+    if api == "openai":
+        # The mock's Anthropic responses carry no usage
+        assert summary["completion_tokens"] > 0
+    assert 0 < summary["ttft_ms"]["p50"] <= summary["latency_ms"]["p50"]
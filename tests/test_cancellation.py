@@ -0,0 +1,220 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+import main
+from conftest import MODEL_PATH, needs_model, serve
+from test_metrics import sample
+
+# The test model never samples its end-of-generation token after this prompt, so it runs to max_tokens
+LONG_PROMPT = "x"
+
+def cancelled(reason):
+    return sample("\n".join(main.metric_cancelled.render()), f'llm_requests_cancelled_total{{reason="{reason}"}}')
+
+def tokens_saved(reason):
+    return sample("\n".join(main.metric_tokens_saved.render()),
+                  f'llm_cancelled_tokens_saved_total{{reason="{reason}"}}')
+
+def test_the_first_reason_wins_and_callbacks_run_once():
+    cancel = main.Cancellation()
+    calls = []
+    cancel.add_callback(lambda: calls.append("early"))
+    assert not cancel.cancelled and cancel.remaining() is None
+    cancel.cancel("disconnect")
+    cancel.cancel("deadline")
+    cancel.add_callback(lambda: calls.append("late"))
+    assert cancel.reason == "disconnect"
+    assert calls == ["early", "late"]
+
+def test_a_passed_deadline_cancels_when_polled():
+    cancel = main.Cancellation(time.perf_counter() + 0.01)
+    assert 0 < cancel.remaining() <= 0.01
+    assert not cancel.cancelled
+    time.sleep(0.02)
+    assert cancel.remaining() == 0.0
+    assert cancel.cancelled and cancel.reason == "deadline"
+
+@pytest.mark.parametrize("reason, status", [("deadline", 504), ("disconnect", 499), ("abandoned", 499)])
+def test_cancellations_map_to_status_codes(reason, status):
+    assert main.RequestCancelled(reason).status_code == status
+
+@pytest.mark.anyio
+async def test_the_deadline_timer_fires_without_polling():
+    cancel = main.Cancellation(time.perf_counter() + 0.02)
+    cancel.watch()
+    await asyncio.sleep(0.05)
+    assert cancel.reason == "deadline"
+
+@pytest.mark.anyio
+async def test_a_disconnect_cancels_a_watched_request():
+    messages = asyncio.Queue()
+    cancel = main.Cancellation()
+    cancel.watch(SimpleNamespace(receive=messages.get))
+    await messages.put({"type": "http.request", "body": b""})
+    await asyncio.sleep(0.01)
+    assert cancel.reason is None
+    await messages.put({"type": "http.disconnect"})
+    await asyncio.sleep(0.01)
+    assert cancel.reason == "disconnect"
+    cancel.close()
+
+@pytest.mark.anyio
+async def test_waiting_stops_at_the_cancellation():
+    cancel = main.Cancellation()
+    assert await cancel.wait(asyncio.sleep(0, "done")) == "done"
+    slow = asyncio.ensure_future(asyncio.sleep(10))
+    asyncio.get_running_loop().call_later(0.01, cancel.cancel, "disconnect")
+    with pytest.raises(main.RequestCancelled, match="cancelled \\(disconnect\\)"):
+        await cancel.wait(slow)
+    await asyncio.sleep(0)
+    assert slow.cancelled()
+
+def http_request(headers=()):
+    return Request({"type": "http", "headers": [(k.encode(), v.encode()) for k, v in headers]})
+
+def test_deadlines_come_from_the_field_the_header_or_the_default(monkeypatch):
+    monkeypatch.setattr(main, "REQUEST_TIMEOUT", 0)
+    assert main.request_deadline(http_request(), None).deadline is None
+    assert main.request_deadline(http_request([("x-request-timeout", "100")]), 1.0).remaining() <= 1.0
+    assert 1.0 < main.request_deadline(http_request([("x-request-timeout", "100")]), None).remaining() <= 100
+    monkeypatch.setattr(main, "REQUEST_TIMEOUT", 30.0)
+    assert 1.0 < main.request_deadline(http_request(), None).remaining() <= 30
+    for header, message in (("soon", "must be a number"), ("0", "must be positive"), ("-1", "must be positive")):
+        with pytest.raises(HTTPException, match=message) as error:
+            main.request_deadline(http_request([("x-request-timeout", header)]), None)
+        assert error.value.status_code == 400
+
+def test_only_generations_cut_short_count_as_early_stops():
+    cancel = main.Cancellation()
+    cancel.cancel("deadline")
+    before = (cancelled("deadline"), tokens_saved("deadline"))
+    main.record_early_stop(cancel, {"finish_reason": "length", "completion_tokens": 10}, 10)
+    main.record_early_stop(main.Cancellation(), {"finish_reason": None, "completion_tokens": 3}, 10)
+    main.record_early_stop(None, {"finish_reason": None, "completion_tokens": 3}, 10)
+    assert (cancelled("deadline"), tokens_saved("deadline")) == before
+    main.record_early_stop(cancel, {"finish_reason": None, "completion_tokens": 3}, 10)
+    assert (cancelled("deadline"), tokens_saved("deadline")) == (before[0] + 1, before[1] + 7)
+
+@needs_model
+def test_serial_generation_stops_at_the_next_token(runtime):
+    cancel = main.Cancellation()
+    threading.Timer(0.03, cancel.cancel, ["disconnect"]).start()
+    saved = tokens_saved("disconnect")
+    result = main.generate_response(runtime, LONG_PROMPT, max_tokens=900, temperature=0, top_p=1.0, stop_tokens=[],
+                                    cancel=cancel)
+    assert result["finish_reason"] is None
+    assert 0 < result["completion_tokens"] < 900
+    assert tokens_saved("disconnect") == saved + 900 - result["completion_tokens"]
+
+@needs_model
+def test_batch_slots_are_freed_at_the_deadline(runtime):
+    engine = main.BatchEngine(runtime.model, n_slots=2, n_batch=64, n_ctx_per_slot=1024)
+    engine.start()
+    try:
+        cancel = main.Cancellation(time.perf_counter() + 0.03)
+        result = engine.generate(LONG_PROMPT, 900, 0.0, 1.0, [], cancel=cancel)
+        stats = engine.stats()
+        after = engine.generate("hello", 4, 0.0, 1.0, [])
+    finally:
+        engine.stop(timeout=10)
+    assert result["finish_reason"] is None and cancel.reason == "deadline"
+    assert result["completion_tokens"] < 900
+    assert stats["active"] == 0
+    assert after["completion_tokens"] == 4
+
+@pytest.mark.anyio
+async def test_jobs_cancelled_in_the_queue_never_run():
+    scheduler = main.InferenceScheduler(max_queue_depth=4, queue_timeout=0)
+    scheduler.start()
+    release = threading.Event()
+    try:
+        running = scheduler.enqueue(release.wait)
+        while scheduler.queue_depth:
+            await asyncio.sleep(0.001)
+        cancel = main.Cancellation()
+        ran = []
+        saved = tokens_saved("deadline")
+        queued = scheduler.enqueue(lambda: ran.append(True), cost=50, cancel=cancel)
+        cancel.cancel("deadline")
+        with pytest.raises(main.RequestCancelled):
+            await queued.future
+        release.set()
+        await running.future
+        await asyncio.sleep(0.01)
+        assert ran == []
+        assert scheduler.stats()["cancelled_in_queue"] == 1
+        assert tokens_saved("deadline") == saved + 50
+    finally:
+        release.set()
+        scheduler.stop(timeout=5)
+
+@needs_model
+def test_worker_processes_stop_with_the_relayed_reason():
+    pool = main.WorkerPool(1, [main.available_cpus()], MODEL_PATH)
+    pool.start(timeout=120)
+    try:
+        for reason in ("disconnect", "deadline"):
+            before = cancelled(reason)
+            if reason == "deadline":
+                cancel = main.Cancellation(time.perf_counter() + 0.05)
+            else:
+                cancel = main.Cancellation()
+                threading.Timer(0.05, cancel.cancel, [reason]).start()
+            result = pool.generate(LONG_PROMPT, 900, 0.0, 1.0, [], cancel=cancel)
+            assert result["finish_reason"] is None
+            assert result["completion_tokens"] < 900
+            # Counted in the worker and merged into this process's metrics
+            assert cancelled(reason) == before + 1
+    finally:
+        pool.stop()
+
+async def settle(condition, timeout=10.0):
+    started = time.perf_counter()
+    while not condition() and time.perf_counter() - started < timeout:
+        await asyncio.sleep(0.01)
+    assert condition()
+
+CHAT = {"messages": [{"role": "user", "content": "hello"}], "max_tokens": 2048, "temperature": 0, "stop": []}
+
+@needs_model
+@pytest.mark.anyio
+async def test_timeouts_in_the_api(monkeypatch):
+    # Generate until the deadline whatever the test model samples
+    monkeypatch.setattr(main, "end_of_generation_tokens", lambda model: set())
+    async with serve(monkeypatch, RESPONSE_CACHE="none", REQUEST_COALESCING=0) as client:
+        before = cancelled("deadline")
+        field = await client.post("/v1/chat/completions", json={**CHAT, "timeout": 0.05})
+        header = await client.post("/v1/messages", json={"model": "claude", **CHAT},
+                                   headers={"X-Request-Timeout": "0.05"})
+        invalid = await client.post("/v1/chat/completions", json=CHAT, headers={"X-Request-Timeout": "soon"})
+        embeddings = await client.post("/v1/embeddings", json={"input": ["one"] * 64, "timeout": 1e-6})
+        quick = await client.post("/v1/chat/completions", json={**CHAT, "max_tokens": 4, "timeout": 30})
+        # Each generation is counted once its thread reaches the next token
+        await settle(lambda: cancelled("deadline") >= before + 3)
+        metrics = (await client.get("/metrics")).text
+    assert field.status_code == header.status_code == embeddings.status_code == 504
+    assert field.json()["detail"] == "Request deadline exceeded"
+    assert invalid.status_code == 400
+    assert quick.status_code == 200
+    assert sample(metrics, 'llm_cancelled_tokens_saved_total{reason="deadline"}') > 0
+
+@needs_model
+@pytest.mark.anyio
+async def test_coalesced_generations_stop_once_every_caller_has_gone(monkeypatch):
+    monkeypatch.setattr(main, "end_of_generation_tokens", lambda model: set())
+    async with serve(monkeypatch, RESPONSE_CACHE="none", REQUEST_COALESCING=1) as client:
+        before = (cancelled("deadline"), cancelled("abandoned"))
+        responses = await asyncio.gather(
+            client.post("/v1/chat/completions", json={**CHAT, "timeout": 0.05}),
+            client.post("/v1/chat/completions", json={**CHAT, "timeout": 0.2}),
+        )
+        await settle(lambda: cancelled("abandoned") == before[1] + 1)
+    assert [response.status_code for response in responses] == [504, 504]
+    # The shared generation is stopped as abandoned, not by either caller's deadline
+    assert cancelled("deadline") == before[0]
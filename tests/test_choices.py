@@ -0,0 +1,106 @@
+import pytest
+from pydantic import ValidationError
+
+import main
+from conftest import needs_model, serve
+from test_streaming import sse
+
+PROMPT = "the quick brown fox"
+
+@pytest.fixture
+def no_eog(monkeypatch):
+    """Ignore the test model's end-of-generation token, so every sampled choice runs to max_tokens."""
+    monkeypatch.setattr(main, "end_of_generation_tokens", lambda model: set())
+
+def candidate(text, logprob, tokens):
+    return {"text": text, "finish_reason": "length", "stop_sequence": None, "prompt_tokens": 5,
+            "completion_tokens": tokens, "logprob": logprob, "context_shifts": 0}
+
+def test_best_of_keeps_the_most_likely_choices():
+    candidates = [candidate("a", -8.0, 4), candidate("b", -2.0, 4), candidate("c", -3.0, 2)]
+    result = main.merge_choices(candidates, 2, {"prefill_seconds": 0.1})
+    # Ranked by mean token log-probability: b (-0.5), then c (-1.5)
+    assert [choice["text"] for choice in result["choices"]] == ["b", "c"]
+    assert [choice["index"] for choice in result["choices"]] == [0, 1]
+    assert (result["text"], result["finish_reason"]) == ("b", "length")
+    # Usage counts every sampled sequence, returned or not
+    assert (result["prompt_tokens"], result["completion_tokens"], result["total_tokens"]) == (5, 10, 15)
+    assert result["prefill_seconds"] == 0.1
+
+def test_n_alone_keeps_the_sampling_order():
+    candidates = [candidate("a", -8.0, 4), candidate("b", -2.0, 4)]
+    assert [choice["text"] for choice in main.merge_choices(candidates, 2, {})["choices"]] == ["a", "b"]
+
+def test_greedy_requests_sample_once_and_repeat_the_choice():
+    request = main.ChatCompletionRequest(messages=[{"role": "user", "content": "hi"}], n=3, best_of=4)
+    assert main.sampling_choices(request, 0.0) == (1, None)
+    assert main.sampling_choices(request, 0.7) == (3, 4)
+    result = {"text": "same", "finish_reason": "stop", "stop_sequence": None}
+    assert main.result_choices(result, 3) == [result] * 3
+
+@pytest.mark.parametrize("fields", [{"n": 3, "best_of": 2}, {"n": 1, "best_of": 2, "stream": True}, {"n": 17}])
+def test_invalid_choice_counts_are_rejected(fields):
+    with pytest.raises(ValidationError):
+        main.ChatCompletionRequest(messages=[{"role": "user", "content": "hi"}], **fields)
+
+@needs_model
+def test_the_batch_engine_prefills_once_for_every_choice(runtime, no_eog):
+    engine = main.BatchEngine(runtime.model, n_slots=4, n_batch=64, n_ctx_per_slot=256)
+    engine.start()
+    try:
+        result = engine.generate(PROMPT, 8, 1.0, 1.0, [], n=3)
+        stats = engine.stats()
+    finally:
+        engine.stop(timeout=10)
+    assert len(result["choices"]) == 3
+    assert len({choice["text"] for choice in result["choices"]}) > 1
+    # Only the first sequence prefills; the others copy its cells and evaluate the last prompt token
+    assert stats["prompt_tokens"] - stats["prefix_reused_tokens"] == result["prompt_tokens"] + 2
+    assert result["completion_tokens"] == stats["generated_tokens"]
+
+@needs_model
+def test_the_batch_engine_ranks_best_of(runtime, no_eog):
+    engine = main.BatchEngine(runtime.model, n_slots=4, n_batch=64, n_ctx_per_slot=256)
+    engine.start()
+    try:
+        result = engine.generate(PROMPT, 8, 1.0, 1.0, [], n=1, best_of=3)
+    finally:
+        engine.stop(timeout=10)
+    assert len(result["choices"]) == 1
+    assert result["completion_tokens"] == 3 * 8
+
+@needs_model
+def test_serial_choices_tokenize_the_prompt_once(runtime, no_eog):
+    calls = runtime.model.tokenizer_calls
+    messages = []
+    result = main.generate_response_stream(runtime, PROMPT, main.PipeStream(messages.append, 1), max_tokens=8,
+                                           temperature=1.0, top_p=1.0, stop_tokens=[], n=3)
+    assert runtime.model.tokenizer_calls == calls + 1
+    assert [choice["index"] for choice in result["choices"]] == [0, 1, 2]
+    for choice in result["choices"]:
+        streamed = "".join(payload[0] for kind, _, payload in messages if kind == "text" and payload[1] == choice["index"])
+        assert streamed.strip() == choice["text"]
+    assert result["completion_tokens"] == 24
+
+CHAT = {"messages": [{"role": "user", "content": "hello"}], "max_tokens": 6, "stop": []}
+
+@needs_model
+@pytest.mark.anyio
+@pytest.mark.parametrize("slots", [1, 4])
+async def test_choices_in_the_api(monkeypatch, no_eog, slots):
+    async with serve(monkeypatch, BATCH_SEQ_SLOTS=slots, RESPONSE_CACHE="none") as client:
+        sampled = (await client.post("/v1/chat/completions", json={**CHAT, "temperature": 1.0, "n": 3})).json()
+        best = (await client.post("/v1/chat/completions",
+                                  json={**CHAT, "temperature": 1.0, "n": 2, "best_of": 4})).json()
+        greedy = (await client.post("/v1/chat/completions", json={**CHAT, "temperature": 0, "n": 2})).json()
+        events = await sse(client, "/v1/chat/completions", {**CHAT, "temperature": 1.0, "n": 2, "stream": True})
+    assert [choice["index"] for choice in sampled["choices"]] == [0, 1, 2]
+    assert sampled["usage"]["completion_tokens"] == 18
+    assert len(best["choices"]) == 2
+    assert best["usage"]["completion_tokens"] == 24
+    first, second = (choice["message"]["content"] for choice in greedy["choices"])
+    assert first == second
+    assert greedy["usage"]["completion_tokens"] == 6
+    chunks = [data["choices"][0] for _, data in events[:-1]]
+    assert {chunk["index"] for chunk in chunks} == {0, 1}
+    assert [chunk["index"] for chunk in chunks if chunk["finish_reason"]] == [0, 1]
@@ -0,0 +1,129 @@
+import asyncio
+
+import pytest
+
+import main
+from conftest import needs_model, serve
+
+pytestmark = pytest.mark.anyio
+
+class Generation:
+    """Stand-in for a generation the test finishes by hand."""
+
+    def __init__(self):
+        self.calls = 0
+        self.release = asyncio.Event()
+        self.cancelled = False
+
+    async def __call__(self):
+        self.calls += 1
+        try:
+            await self.release.wait()
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        return f"result {self.calls}"
+
+async def test_identical_requests_share_one_generation():
+    coalescer, generation = main.RequestCoalescer(), Generation()
+    callers = [asyncio.ensure_future(coalescer.run("key", generation)) for _ in range(3)]
+    await asyncio.sleep(0)
+    generation.release.set()
+    results = await asyncio.gather(*callers)
+    assert generation.calls == 1
+    assert results == [("result 1", False), ("result 1", True), ("result 1", True)]
+    stats = coalescer.stats()
+    assert (stats["generations"], stats["coalesced"], stats["in_flight"]) == (1, 2, 0)
+
+async def test_finished_flights_are_not_reused():
+    coalescer, generation = main.RequestCoalescer(), Generation()
+    generation.release.set()
+    assert await coalescer.run("key", generation) == ("result 1", False)
+    assert await coalescer.run("key", generation) == ("result 2", False)
+    assert await coalescer.run("other", generation) == ("result 3", False)
+
+async def test_errors_reach_every_caller():
+    coalescer = main.RequestCoalescer()
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("boom")
+
+    results = await asyncio.gather(coalescer.run("key", fail), coalescer.run("key", fail), return_exceptions=True)
+    assert [str(result) for result in results] == ["boom", "boom"]
+
+async def test_a_caller_that_leaves_does_not_stop_the_others():
+    coalescer, generation = main.RequestCoalescer(), Generation()
+    leaving = main.Cancellation()
+    first = asyncio.ensure_future(coalescer.run("key", generation, leaving))
+    second = asyncio.ensure_future(coalescer.run("key", generation, main.Cancellation()))
+    await asyncio.sleep(0)
+    leaving.cancel("disconnect")
+    with pytest.raises(main.RequestCancelled):
+        await first
+    generation.release.set()
+    assert await second == ("result 1", True)
+    assert not generation.cancelled
+
+async def test_the_generation_stops_once_every_caller_has_left():
+    coalescer, generation = main.RequestCoalescer(), Generation()
+    cancels = [main.Cancellation(), main.Cancellation()]
+    callers = [asyncio.ensure_future(coalescer.run("key", generation, cancel)) for cancel in cancels]
+    await asyncio.sleep(0)
+    for cancel in cancels:
+        cancel.cancel("disconnect")
+    for caller in callers:
+        with pytest.raises(main.RequestCancelled):
+            await caller
+    await asyncio.sleep(0.01)
+    assert generation.cancelled
+    assert coalescer.stats()["in_flight"] == 0
+
+def start_shared(loop):
+    token_stream = main.TokenStream(loop)
+    job = main.InferenceJob(None, (), {}, loop)
+    return token_stream, job
+
+async def collect(subscriber):
+    return [text async for text in subscriber]
+
+async def test_late_stream_subscribers_replay_missed_text():
+    loop = asyncio.get_running_loop()
+    coalescer = main.RequestCoalescer()
+    token_stream, job = start_shared(loop)
+    first = coalescer.stream("key", lambda: (token_stream, job))
+    reader = asyncio.ensure_future(collect(first))
+    for text in ("a", "b"):
+        await asyncio.to_thread(token_stream.put, text)
+    await asyncio.sleep(0.01)
+    late = coalescer.stream("key", lambda: pytest.fail("a second generation was started"))
+    late_reader = asyncio.ensure_future(collect(late))
+    await asyncio.to_thread(token_stream.put, "c")
+    token_stream.finish()
+    job.future.set_result({"text": "abc"})
+    assert await reader == await late_reader == ["a", "b", "c"]
+    assert await late.future == {"text": "abc"}
+    stats = coalescer.stats()
+    assert (stats["stream_generations"], stats["streams_coalesced"], stats["in_flight_streams"]) == (1, 1, 0)
+
+async def test_a_shared_stream_is_cancelled_when_its_last_subscriber_leaves():
+    loop = asyncio.get_running_loop()
+    coalescer = main.RequestCoalescer()
+    token_stream, job = start_shared(loop)
+    subscribers = [coalescer.stream("key", lambda: (token_stream, job)) for _ in range(2)]
+    subscribers[0].cancel()
+    assert not token_stream.cancelled.is_set()
+    subscribers[1].cancel()
+    assert token_stream.cancelled.is_set()
+    assert job.future.cancelled()
+
+@needs_model
+async def test_concurrent_http_requests_are_coalesced(monkeypatch):
+    body = {"messages": [{"role": "user", "content": "hello"}], "max_tokens": 32, "temperature": 0}
+    async with serve(monkeypatch, RESPONSE_CACHE="none", REQUEST_COALESCING=1) as client:
+        responses = await asyncio.gather(*(client.post("/v1/chat/completions", json=body) for _ in range(3)))
+        stats = (await client.get("/health")).json()["coalescing"]
+    texts = {response.json()["choices"][0]["message"]["content"] for response in responses}
+    assert len(texts) == 1
+    assert stats["generations"] + stats["coalesced"] == 3
+    assert sum(response.headers.get("X-Coalesced") == "true" for response in responses) == stats["coalesced"]
@@ -0,0 +1,129 @@
+import pytest
+
+import main
+from conftest import MODEL_PATH, needs_model, serve
+
+LONG = "the quick brown fox jumps over the lazy dog " * 4
+
+def conversation(turns=6):
+    messages = [main.Message(role="system", content="You are terse.")]
+    for i in range(turns):
+        messages.append(main.Message(role="user", content=f"question {i}: {LONG}"))
+        messages.append(main.Message(role="assistant", content=f"answer {i}: {LONG}"))
+    messages.append(main.Message(role="user", content="and finally?"))
+    return messages
+
+def test_prompt_budget_reserves_room_for_the_reply():
+    # CONTEXT_SIZE is 1024 and CONTEXT_RESERVE_TOKENS 256 in the tests
+    assert main.prompt_budget(100) == 924
+    assert main.prompt_budget(10_000) == 768
+    assert main.prompt_budget(0) == 1023
+
+def test_summaries_keep_the_newest_turns_that_fit():
+    messages = [main.Message(role="user", content="first  question"),
+                main.Message(role="assistant", content="x" * 200),
+                main.Message(role="user", content="last question")]
+    assert main.summarize_turns(messages) == (
+        "Earlier in this conversation:\nuser: first question\nassistant: " + "x" * 120 + "...\nuser: last question"
+    )
+    assert main.summarize_turns(messages, limit=30) == "Earlier in this conversation:\nuser: last question"
+
+@needs_model
+def test_prompts_that_fit_are_left_alone(runtime):
+    messages = conversation(1)
+    assert main.fit_messages(runtime.chat_renderer, messages, 1000) == runtime.chat_renderer.render(messages)
+
+@needs_model
+def test_truncation_drops_the_oldest_turns(monkeypatch, runtime):
+    monkeypatch.setattr(main, "CONTEXT_POLICY", "truncate")
+    renderer = runtime.chat_renderer
+    messages = conversation()
+    budget = len(renderer.render(messages)) // 2
+    tokens = main.fit_messages(renderer, messages, budget)
+    assert len(tokens) <= budget
+    # The longest tail of whole exchanges that fits, behind the system prompt
+    kept = next(messages[:1] + messages[start:] for start in range(1, len(messages), 2)
+                if len(renderer.render(messages[:1] + messages[start:])) <= budget)
+    assert tokens == renderer.render(kept)
+    assert kept[1].role == "user"
+    assert len(kept) < len(messages)
+
+@needs_model
+def test_summarize_replaces_dropped_turns_with_a_note(monkeypatch, runtime):
+    monkeypatch.setattr(main, "CONTEXT_POLICY", "summarize")
+    renderer = runtime.chat_renderer
+    messages = conversation()
+    budget = len(renderer.render(messages)) // 2
+    tokens = main.fit_messages(renderer, messages, budget)
+    text = runtime.model.detokenize(tokens).decode("utf-8")
+    assert len(tokens) <= budget
+    assert text.index("You are terse.") < text.index("Earlier in this conversation:") < text.index("and finally?")
+    # The note keeps the newest of the dropped turns; the oldest are gone entirely
+    assert "assistant: answer" in text[text.index("Earlier in this conversation:"):text.index("and finally?")]
+    assert "question 0" not in text
+
+@needs_model
+def test_error_policy_rejects_long_prompts(monkeypatch, runtime):
+    monkeypatch.setattr(main, "CONTEXT_POLICY", "error")
+    messages = conversation()
+    with pytest.raises(main.ContextLengthExceeded, match="fit in the context window"):
+        main.fit_messages(runtime.chat_renderer, messages, 100)
+
+@needs_model
+@pytest.mark.parametrize("policy", ["truncate", "summarize"])
+def test_the_last_message_alone_may_not_fit(monkeypatch, runtime, policy):
+    monkeypatch.setattr(main, "CONTEXT_POLICY", policy)
+    messages = [main.Message(role="system", content="You are terse."), main.Message(role="user", content=LONG * 4)]
+    with pytest.raises(main.ContextLengthExceeded, match="after dropping earlier turns"):
+        main.fit_messages(runtime.chat_renderer, messages, 50)
+
+@needs_model
+@pytest.mark.anyio
+async def test_overlong_chats_are_a_400_or_trimmed(monkeypatch):
+    messages = [{"role": message.role, "content": message.content * 3} for message in conversation(8)]
+    chat = {"messages": messages, "max_tokens": 4, "temperature": 0}
+    async with serve(monkeypatch, CONTEXT_POLICY="error") as client:
+        rejected = await client.post("/v1/chat/completions", json=chat)
+    async with serve(monkeypatch, CONTEXT_POLICY="truncate") as client:
+        trimmed = await client.post("/v1/chat/completions", json=chat)
+    assert rejected.status_code == 400
+    assert "context window" in rejected.json()["detail"]
+    assert trimmed.status_code == 200
+    assert trimmed.json()["usage"]["prompt_tokens"] <= main.prompt_budget(4)
+
+@needs_model
+@pytest.mark.parametrize("shift", [1, 0])
+def test_serial_generation_shifts_past_a_full_context(monkeypatch, shift):
+    # llama.cpp rounds smaller windows up to 256
+    monkeypatch.setattr(main, "CONTEXT_SIZE", 256)
+    monkeypatch.setattr(main, "CONTEXT_SHIFT", shift)
+    monkeypatch.setattr(main, "CONTEXT_SHIFT_KEEP", 4)
+    # The test model samples its end-of-generation token now and then; ignore it to reach the window's end
+    monkeypatch.setattr(main, "end_of_generation_tokens", lambda model: set())
+    runtime = main.ModelRuntime("small-context", MODEL_PATH)
+    runtime.load()
+    try:
+        result = main.generate_response(runtime, "the quick brown fox", max_tokens=400, temperature=0, top_p=1.0,
+                                        stop_tokens=[])
+    finally:
+        runtime.unload()
+    assert result["finish_reason"] == "length"
+    if shift:
+        assert result["completion_tokens"] == 400
+        assert result["context_shifts"] > 0
+    else:
+        assert result["completion_tokens"] < 256
+        assert result["context_shifts"] == 0
+
+@needs_model
+def test_batch_slots_shift_past_a_full_context(monkeypatch, runtime):
+    monkeypatch.setattr(main, "CONTEXT_SHIFT_KEEP", 4)
+    monkeypatch.setattr(main, "end_of_generation_tokens", lambda model: set())
+    engine = main.BatchEngine(runtime.model, n_slots=2, n_batch=64, n_ctx_per_slot=64)
+    engine.start()
+    try:
+        result = engine.generate("the quick brown fox", 150, 0.0, 1.0, [])
+    finally:
+        engine.stop(timeout=10)
+    assert (result["finish_reason"], result["completion_tokens"]) == ("length", 150)
+    assert result["context_shifts"] > 0
@@ -0,0 +1,97 @@
+import base64
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import main
+from conftest import needs_model, serve
+
+TEXTS = ["the quick brown fox", "jumps over the lazy dog", "hello world", "the quick brown fox"]
+
+def test_inputs_are_normalized_to_a_list():
+    assert main.embedding_inputs("one") == ["one"]
+    assert main.embedding_inputs(["one", "two"]) == ["one", "two"]
+    assert main.embedding_inputs([1, 2, 3]) == [[1, 2, 3]]
+    assert main.embedding_inputs([[1, 2], [3]]) == [[1, 2], [3]]
+    assert main.embedding_inputs([]) == []
+
+def test_base64_is_little_endian_float32():
+    vectors = np.array([[0.5, -0.25, 1.0], [0.0, 2.0, -3.5]], dtype=np.float32)
+    data = main.embedding_data(vectors, "base64")
+    assert [item["index"] for item in data] == [0, 1]
+    decoded = [np.frombuffer(base64.b64decode(item["embedding"]), dtype="<f4") for item in data]
+    np.testing.assert_array_equal(np.stack(decoded), vectors)
+    floats = main.embedding_data(vectors, "float")
+    np.testing.assert_array_equal(floats[1]["embedding"], vectors[1])
+
+def test_inputs_are_packed_into_groups_in_order():
+    engine = SimpleNamespace(n_batch=10, max_seqs=2)
+    inputs = [[0] * 4, [0] * 4, [0] * 4, [0] * 9, [0] * 1, [0] * 1]
+    assert main.EmbeddingEngine.groups(engine, inputs) == [[0, 1], [2], [3, 4], [5]]
+
+@pytest.fixture
+def engine(runtime, monkeypatch):
+    # Small passes, so a handful of inputs already needs several of them
+    monkeypatch.setattr(main, "EMBEDDING_BATCH_SIZE", 32)
+    monkeypatch.setattr(main, "EMBEDDING_MAX_SEQS", 2)
+    created = main.EmbeddingEngine(runtime, 32, 2)
+    yield created
+    created.close()
+
+@needs_model
+def test_embeddings_are_unit_length_and_independent_of_batching(runtime, engine):
+    sequences = main.tokenize_embedding_inputs(runtime, TEXTS)
+    vectors = engine.embed(sequences)
+    assert vectors.shape == (len(TEXTS), engine.n_embd)
+    assert vectors.dtype == np.float32
+    np.testing.assert_allclose(np.linalg.norm(vectors, axis=1), 1.0, rtol=1e-5)
+    # Each input is pooled over its own tokens only, whatever it was batched with
+    for sequence, vector in zip(sequences, vectors):
+        np.testing.assert_allclose(engine.embed([sequence])[0], vector, atol=1e-4)
+    np.testing.assert_allclose(vectors[0], vectors[3], atol=1e-5)
+    assert not np.allclose(vectors[0], vectors[1], atol=1e-3)
+    stats = engine.stats()
+    assert stats["inputs"] == len(TEXTS) * 2
+    assert stats["tokens"] == 2 * sum(len(sequence) for sequence in sequences)
+    assert stats["passes"] > len(TEXTS)
+
+@needs_model
+def test_inputs_must_fit_one_pass(runtime, engine):
+    with pytest.raises(main.ContextLengthExceeded, match="input\\[1\\] is empty"):
+        main.tokenize_embedding_inputs(runtime, ["fine", []])
+    with pytest.raises(main.ContextLengthExceeded, match="at most 32 can be embedded"):
+        main.tokenize_embedding_inputs(runtime, ["word " * 40])
+
+@needs_model
+@pytest.mark.anyio
+async def test_the_embeddings_endpoint(monkeypatch, runtime):
+    tokens = runtime.model.tokenize(b"hello world", add_bos=True, special=False)
+    async with serve(monkeypatch, EMBEDDING_MAX_INPUTS=4) as client:
+        floats = await client.post("/v1/embeddings", json={"input": TEXTS})
+        packed = await client.post("/v1/embeddings", json={"input": TEXTS, "encoding_format": "base64"})
+        token_input = await client.post("/v1/embeddings", json={"input": tokens})
+        empty = await client.post("/v1/embeddings", json={"input": []})
+        too_many = await client.post("/v1/embeddings", json={"input": TEXTS + ["one more"]})
+        out_of_vocab = await client.post("/v1/embeddings", json={"input": [tokens, [999999]]})
+        negative = await client.post("/v1/embeddings", json={"input": [[-5, 3]]})
+        bad_format = await client.post("/v1/embeddings", json={"input": "x", "encoding_format": "int8"})
+    assert floats.status_code == packed.status_code == token_input.status_code == 200
+    body = floats.json()
+    assert body["object"] == "list"
+    assert [item["index"] for item in body["data"]] == [0, 1, 2, 3]
+    vectors = np.array([item["embedding"] for item in body["data"]], dtype=np.float32)
+    decoded = np.stack([np.frombuffer(base64.b64decode(item["embedding"]), dtype="<f4")
+                        for item in packed.json()["data"]])
+    np.testing.assert_allclose(decoded, vectors, atol=1e-6)
+    assert len(packed.content) < len(floats.content)
+    assert body["usage"]["prompt_tokens"] == body["usage"]["total_tokens"] > len(TEXTS)
+    # A token array is the same input as its text
+    np.testing.assert_allclose(token_input.json()["data"][0]["embedding"], vectors[2], atol=1e-4)
+    assert token_input.json()["usage"]["prompt_tokens"] == len(tokens)
+    assert empty.status_code == too_many.status_code == 400
+    # Token ids outside the vocabulary are the client's error, named by input
+    assert out_of_vocab.status_code == negative.status_code == 400
+    assert out_of_vocab.json()["detail"].startswith("input[1] has token id 999999")
+    assert negative.json()["detail"].startswith("input[0] has token id -5")
+    assert bad_format.status_code == 422
@@ -0,0 +1,112 @@
+import json
+
+import pytest
+
+import main
+from conftest import needs_model, serve
+
+SCHEMA = {
+    "type": "object",
+    "properties": {"color": {"enum": ["red", "green"]}, "ok": {"type": "boolean"}},
+    "required": ["color", "ok"],
+}
+
+def json_schema(schema):
+    return main.ResponseFormat(type="json_schema", json_schema={"name": "answer", "schema": schema})
+
+def test_schemas_become_gbnf():
+    gbnf = main.json_schema_grammar(json.dumps(SCHEMA))
+    assert 'root ::= "{" space color-kv "," space ok-kv "}" space' in gbnf
+    assert 'color ::= "\\"red\\"" | "\\"green\\""' in gbnf
+    # Strings may not contain raw control characters
+    strings = main.json_schema_grammar(json.dumps({"type": "string"}))
+    assert '[^"\\\\\\x7F\\x00-\\x1F]' in strings
+
+def test_json_schema_formats_need_a_schema():
+    with pytest.raises(ValueError, match="needs a json_schema.schema object"):
+        main.ResponseFormat(type="json_schema", json_schema={"name": "answer"})
+
+@needs_model
+def test_grammars_are_cached_by_schema(runtime):
+    cache = main.GrammarCache(runtime.model, capacity=2)
+    assert cache.get(None) is None
+    assert cache.get(main.ResponseFormat(type="text")) is None
+    first = cache.get(json_schema(SCHEMA))
+    assert cache.get(json_schema(json.loads(json.dumps(SCHEMA)))) is first
+    # Property order decides field order, so a reordered schema is another grammar
+    reordered = {**SCHEMA, "properties": dict(reversed(list(SCHEMA["properties"].items())))}
+    assert cache.get(json_schema(reordered)) is not first
+    # The key a worker process receives finds the same compiled grammar
+    assert cache.compile(first.key, first.gbnf) is first
+    cache.get(main.ResponseFormat(type="json_object"))
+    stats = cache.stats()
+    assert (stats["size"], stats["hits"], stats["misses"], stats["evictions"]) == (2, 2, 3, 1)
+    # The least recently used grammar, the reordered one, was evicted; first is still cached
+    assert cache.get(json_schema(SCHEMA)) is first
+
+@needs_model
+@pytest.mark.anyio
+async def test_async_lookups_compile_misses_off_the_loop(runtime):
+    cache = main.GrammarCache(runtime.model, capacity=4)
+    built = await cache.get_async(json_schema(SCHEMA))
+    assert await cache.get_async(json_schema(SCHEMA)) is built
+    assert (cache.stats()["hits"], cache.stats()["misses"]) == (1, 1)
+
+@needs_model
+@pytest.mark.parametrize("schema", [{"type": "nope"}, {"$ref": "#/defs/missing"}])
+def test_unsupported_schemas_are_a_grammar_error(runtime, schema):
+    cache = main.GrammarCache(runtime.model, capacity=2)
+    with pytest.raises(main.GrammarError, match="Unsupported response_format schema"):
+        cache.get(json_schema(schema))
+    assert cache.stats()["size"] == 0
+
+def check_answer(text):
+    answer = json.loads(text)
+    assert set(answer) == {"color", "ok"}
+    assert answer["color"] in ("red", "green")
+    assert isinstance(answer["ok"], bool)
+
+@needs_model
+@pytest.mark.parametrize("temperature", [0.0, 1.0])
+def test_serial_output_follows_the_schema(runtime, temperature):
+    grammar = runtime.grammars.get(json_schema(SCHEMA))
+    result = main.generate_response(runtime, "the quick brown fox", max_tokens=60, temperature=temperature, top_p=1.0,
+                                    stop_tokens=[], grammar=grammar)
+    check_answer(result["text"])
+    # The grammar ends the sequence once the object is complete
+    assert result["finish_reason"] == "stop"
+
+@needs_model
+def test_batched_choices_follow_the_schema(runtime):
+    grammar = runtime.grammars.get(json_schema(SCHEMA))
+    engine = main.BatchEngine(runtime.model, n_slots=4, n_batch=64, n_ctx_per_slot=256)
+    engine.start()
+    try:
+        greedy = engine.generate("the quick brown fox", 60, 0.0, 1.0, [], grammar=grammar)
+        sampled = engine.generate("the quick brown fox", 60, 1.0, 1.0, [], n=3, grammar=grammar)
+    finally:
+        engine.stop(timeout=10)
+    check_answer(greedy["text"])
+    for choice in sampled["choices"]:
+        check_answer(choice["text"])
+
+@needs_model
+@pytest.mark.anyio
+async def test_response_format_in_the_api(monkeypatch):
+    chat = {"messages": [{"role": "user", "content": "answer in JSON"}], "max_tokens": 60, "temperature": 0.8,
+            "stop": []}
+    response_format = {"type": "json_schema", "json_schema": {"name": "answer", "schema": SCHEMA}}
+    async with serve(monkeypatch, RESPONSE_CACHE="none") as client:
+        answers = [await client.post("/v1/chat/completions", json={**chat, "response_format": response_format})
+                   for _ in range(2)]
+        unsupported = await client.post("/v1/chat/completions", json={
+            **chat, "response_format": {"type": "json_schema", "json_schema": {"schema": {"type": "nope"}}}})
+        missing = await client.post("/v1/chat/completions", json={**chat, "response_format": {"type": "json_schema"}})
+        grammars = main.registry.runtimes[main.OPENAI_MODEL_MAP["default"]].grammars.stats()
+    for answer in answers:
+        assert answer.status_code == 200
+        check_answer(answer.json()["choices"][0]["message"]["content"])
+    assert unsupported.status_code == 400
+    assert "Unsupported response_format schema" in unsupported.json()["detail"]
+    assert missing.status_code == 422
+    assert (grammars["misses"], grammars["hits"]) == (1, 1)
@@ -0,0 +1,63 @@
+import json
+import time
+
+import numpy as np
+import pytest
+from fastapi import FastAPI, Request
+
+import benchmark
+import main
+
+def test_numpy_values_encode_as_plain_json():
+    data = {"score": np.float64(0.5), "vector": np.array([0.25, -1.0], dtype=np.float32), "text": "naïve ☕"}
+    encoded = main.json_bytes(data)
+    assert json.loads(encoded) == {"score": 0.5, "vector": [0.25, -1.0], "text": "naïve ☕"}
+    # Non-ASCII text is written as UTF-8, not escaped
+    assert "naïve ☕".encode("utf-8") in encoded
+    assert main.json_text(data) == encoded.decode("utf-8")
+
+def test_the_stdlib_fallback_matches_the_fast_path():
+    data = {"id": "chatcmpl-1", "choices": [{"index": 0, "message": {"content": "日本"}}], "usage": {"x": 1.5}}
+    assert json.loads(main._json_encoder.encode(data)) == json.loads(main.json_bytes(data))
+    assert main._json_encoder.encode({"a": np.array([1.0])}) == '{"a":[1.0]}'
+
+def test_unknown_types_are_an_error():
+    with pytest.raises(TypeError):
+        main.json_bytes({"when": object()})
+
+def test_fast_responses_render_with_json_bytes():
+    content = {"object": "chat.completion", "values": np.array([1.0, 2.0])}
+    response = main.FastJSONResponse(content=content, headers={"X-Cache": "miss"})
+    assert response.body == main.json_bytes(content)
+    assert response.headers["content-type"] == "application/json"
+    assert response.headers["x-cache"] == "miss"
+
+@pytest.mark.anyio
+async def test_timed_routes_stamp_the_arrival_before_the_handler():
+    import httpx
+
+    app = FastAPI()
+    app.router.route_class = main.TimedRoute
+
+    @app.post("/echo")
+    async def echo(body: dict, request: Request):
+        return {"received_at": request.scope["received_at"], "handled_at": time.perf_counter()}
+
+    before = time.perf_counter()
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        stamped = (await client.post("/echo", json={"a": 1})).json()
+    assert before <= stamped["received_at"] <= stamped["handled_at"]
+    assert main.app.router.route_class is main.TimedRoute
+
+def test_overhead_payloads_are_deterministic():
+    body = benchmark.overhead_payload("openai", 8)
+    assert body == benchmark.overhead_payload("openai", 8)
+    assert len(json.loads(body)["messages"]) == 8
+
+@pytest.mark.anyio
+async def test_overhead_is_measured_in_process_against_the_mock():
+    results = await benchmark.measure_overhead("mock", 100, 4)
+    assert set(results) == set(benchmark.ENDPOINTS)
+    for timing in results.values():
+        assert 0 < timing["best"]
+        assert timing["p50"] <= timing["max"]
@@ -0,0 +1,100 @@
+import json
+
+import pytest
+
+import main
+from conftest import MODEL_PATH, needs_model
+
+SYSTEM = "You are a helpful assistant who answers questions about the quick brown fox and the lazy dog. " * 2
+
+@pytest.fixture
+def weights(tmp_path):
+    path = tmp_path / "weights.gguf"
+    path.write_bytes(bytes(range(256)) * 64)
+    return str(path)
+
+def test_snapshots_round_trip(tmp_path, weights):
+    store = main.KVSnapshotStore(str(tmp_path / "kv"), "tiny", weights, 1024)
+    assert store.open([1, 2, 3]) is None
+    store.save([1, 2, 3], b"kv state")
+    view = store.open([1, 2, 3])
+    assert bytes(view) == b"kv state"
+    assert (store.built, store.loaded, store.rejected) == (1, 1, 0)
+    assert store.stats()["mapped_bytes"] > len(b"kv state")
+    store.close()
+    assert store.stats()["mapped_bytes"] == 0
+    with pytest.raises(ValueError):
+        bytes(view)
+
+@pytest.mark.parametrize("change", ["n_ctx", "weights", "corrupt"])
+def test_stale_snapshots_are_rejected(tmp_path, weights, change):
+    directory = str(tmp_path / "kv")
+    main.KVSnapshotStore(directory, "tiny", weights, 1024).save([1, 2, 3], b"kv state")
+    n_ctx = 1024
+    if change == "n_ctx":
+        n_ctx = 2048
+    elif change == "weights":
+        with open(weights, "r+b") as f:
+            f.write(b"retrained")
+    store = main.KVSnapshotStore(directory, "tiny", weights, n_ctx)
+    if change == "corrupt":
+        with open(store.path_for([1, 2, 3]), "r+b") as f:
+            f.write(b"XXXX")
+    assert store.open([1, 2, 3]) is None
+    assert store.rejected == 1
+
+def test_snapshot_prompts_must_be_a_list_of_strings(tmp_path):
+    path = tmp_path / "prompts.json"
+    path.write_text(json.dumps(["one", "two"]))
+    assert main.load_snapshot_prompts(str(path)) == ["one", "two"]
+    path.write_text(json.dumps({"prompt": "one"}))
+    with pytest.raises(ValueError, match="JSON list of system prompt strings"):
+        main.load_snapshot_prompts(str(path))
+
+def load(monkeypatch, tmp_path, **settings):
+    prompts = tmp_path / "prompts.json"
+    prompts.write_text(json.dumps([SYSTEM]))
+    monkeypatch.setattr(main, "KV_SNAPSHOT_PROMPTS", str(prompts))
+    monkeypatch.setattr(main, "KV_SNAPSHOT_DIR", str(tmp_path / "kv"))
+    for name, value in settings.items():
+        monkeypatch.setattr(main, name, value)
+    runtime = main.ModelRuntime("tiny", MODEL_PATH)
+    runtime.load()
+    return runtime
+
+def chat(runtime, content):
+    messages = [main.Message(role="system", content=SYSTEM), main.Message(role="user", content=content)]
+    prompt = main.render_chat_prompt(runtime, messages)
+    return main.generate_response(runtime, prompt, max_tokens=8, temperature=0, top_p=1.0, stop_tokens=[])["text"]
+
+@needs_model
+def test_snapshots_are_built_once_and_reused_after_a_restart(monkeypatch, tmp_path, runtime):
+    expected = chat(runtime, "hello")
+
+    first = load(monkeypatch, tmp_path)
+    try:
+        # One prefix per template (chat and anthropic)
+        assert (first.snapshots.built, first.snapshots.loaded) == (2, 2)
+    finally:
+        first.unload()
+
+    second = load(monkeypatch, tmp_path)
+    try:
+        assert (second.snapshots.built, second.snapshots.loaded, second.snapshots.rejected) == (0, 2, 0)
+        assert second.prefix_cache.stats()["pinned"] == 2
+        assert chat(second, "hello") == expected
+        assert second.prefix_cache.stats()["reused_tokens"] > 0
+    finally:
+        snapshots = second.snapshots
+        second.unload()
+    assert snapshots.stats()["mapped_bytes"] == 0
+
+@needs_model
+def test_the_batch_engine_restores_snapshots(monkeypatch, tmp_path, runtime):
+    expected = chat(runtime, "hello")
+    batched = load(monkeypatch, tmp_path, BATCH_SEQ_SLOTS=2)
+    try:
+        assert chat(batched, "hello") == expected
+        assert batched.batch_engine.stats()["prefix_reused_tokens"] > 0
+    finally:
+        batched.unload()
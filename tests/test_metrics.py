@@ -0,0 +1,90 @@
+import pytest
+
+import main
+from conftest import needs_model, serve
+
+def sample(text, series):
+    """Value of one series in Prometheus text output (0 when absent)."""
+    for line in text.splitlines():
+        name, _, value = line.rpartition(" ")
+        if name == series:
+            return float(value)
+    return 0.0
+
+def test_counter_renders_labelled_series():
+    counter = main.Counter("requests_total", "Requests.", ("endpoint",))
+    counter.inc("openai")
+    counter.inc("openai", amount=2)
+    counter.inc("anthropic")
+    assert counter.render() == [
+        "# HELP requests_total Requests.",
+        "# TYPE requests_total counter",
+        'requests_total{endpoint="openai"} 3',
+        'requests_total{endpoint="anthropic"} 1',
+    ]
+
+def test_gauge_reads_its_collector_at_scrape_time():
+    depth = [3]
+    gauge = main.Gauge("queued", "Queued jobs.", collect=lambda: depth[0])
+    assert gauge.render()[-1] == "queued 3"
+    depth[0] = 1
+    assert gauge.render()[-1] == "queued 1"
+    settable = main.Gauge("in_flight", "In flight.", ("endpoint",))
+    settable.inc("openai")
+    settable.inc("openai")
+    settable.dec("openai")
+    assert settable.render()[-1] == 'in_flight{endpoint="openai"} 1'
+
+def test_histogram_buckets_are_cumulative():
+    histogram = main.Histogram("latency", "Latency.", (0.1, 1.0), ("endpoint",))
+    histogram.observe(0.05, "openai")
+    histogram.observe(0.5, "openai")
+    histogram.observe(5.0, "openai", count=2)
+    assert histogram.render()[2:] == [
+        'latency_bucket{endpoint="openai",le="0.1"} 1',
+        'latency_bucket{endpoint="openai",le="1"} 2',
+        'latency_bucket{endpoint="openai",le="+Inf"} 4',
+        'latency_sum{endpoint="openai"} 10.55',
+        'latency_count{endpoint="openai"} 4',
+    ]
+
+def test_drained_counters_merge_into_another_registry():
+    worker, api = main.MetricsRegistry(), main.MetricsRegistry()
+    worker_counter = worker.register(main.Counter("cancelled_total", "Cancelled.", ("reason",)))
+    worker_gauge = worker.register(main.Gauge("in_flight", "In flight."))
+    api_counter = api.register(main.Counter("cancelled_total", "Cancelled.", ("reason",)))
+    api_counter.inc("deadline")
+    worker_counter.inc("deadline", amount=2)
+    worker_counter.inc("disconnect")
+    worker_gauge.set(5)
+
+    drained = worker.drain()
+    # Only counters are relayed, and draining starts them again from zero
+    assert drained == {"cancelled_total": [(("deadline",), 2.0), (("disconnect",), 1.0)]}
+    assert worker.drain() == {}
+    api.merge(drained)
+    text = api.render()
+    assert sample(text, 'cancelled_total{reason="deadline"}') == 3
+    assert sample(text, 'cancelled_total{reason="disconnect"}') == 1
+
+@needs_model
+@pytest.mark.anyio
+async def test_metrics_endpoint_counts_generations(monkeypatch):
+    body = {"messages": [{"role": "user", "content": "hello"}], "max_tokens": 6, "temperature": 0}
+    async with serve(monkeypatch, RESPONSE_CACHE="none") as client:
+        before = (await client.get("/metrics")).text
+        usage = (await client.post("/v1/chat/completions", json=body)).json()["usage"]
+        response = await client.get("/metrics")
+    after = response.text
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+
+    def delta(series):
+        return sample(after, series) - sample(before, series)
+
+    assert delta('llm_requests_total{endpoint="openai"}') == 1
+    assert delta('llm_prompt_tokens_total{endpoint="openai"}') == usage["prompt_tokens"]
+    assert delta('llm_completion_tokens_total{endpoint="openai"}') == usage["completion_tokens"]
+    assert delta('llm_queue_wait_seconds_count{endpoint="openai"}') == 1
+    assert delta('llm_token_latency_seconds_count{endpoint="openai"}') == usage["completion_tokens"]
+    assert sample(after, 'llm_requests_in_flight{endpoint="openai"}') == 0
+    assert sample(after, "llm_requests_queued") == 0
@@ -0,0 +1,97 @@
+import pytest
+
+import main
+from conftest import needs_model
+
+# Long enough to pass PREFIX_CACHE_MIN_TOKENS with the test model
+SHARED = "the quick brown fox jumps over the lazy dog " * 5
+
+def test_lookup_returns_the_longest_shared_prefix():
+    cache = main.PrefixCache(1 << 20, min_tokens=2)
+    cache.store([1, 2, 3], b"abc")
+    cache.store([1, 2, 3, 4, 5], b"abcde")
+    cache.store([1, 9], b"x")
+    assert cache.lookup([1, 2, 3, 4, 7]) == (4, (1, 2, 3, 4, 5), b"abcde")
+    assert cache.lookup([1, 2, 8]) == (2, (1, 2, 3), b"abc")
+    assert cache.lookup([7, 7]) == (0, None, None)
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["hit_rate"]) == (2, 1, 0.6667)
+
+def test_prefixes_shorter_than_min_tokens_miss():
+    cache = main.PrefixCache(1 << 20, min_tokens=3)
+    cache.store([1, 2], b"ab")
+    assert cache.stats()["entries"] == 0
+    cache.store([1, 2, 3], b"abc")
+    assert cache.lookup([1, 2, 9]) == (0, None, None)
+
+def test_least_recently_used_entries_are_evicted_over_budget():
+    cache = main.PrefixCache(10, min_tokens=1)
+    cache.store([1], b"aaaa")
+    cache.store([2], b"bbbb")
+    cache.lookup([1])
+    cache.store([3], b"cccc")
+    assert cache.lookup([2]) == (0, None, None)
+    assert cache.lookup([1])[2] == b"aaaa"
+    assert cache.lookup([3])[2] == b"cccc"
+    stats = cache.stats()
+    assert (stats["entries"], stats["size_bytes"], stats["evictions"]) == (2, 8, 1)
+
+def test_states_larger_than_the_budget_are_not_stored():
+    cache = main.PrefixCache(4, min_tokens=1)
+    cache.store([1], b"too large")
+    assert cache.stats()["entries"] == 0
+
+def test_restoring_a_key_replaces_its_size():
+    cache = main.PrefixCache(100, min_tokens=1)
+    cache.store([1], b"aaaa")
+    cache.store([1], b"aa")
+    assert cache.stats()["size_bytes"] == 2
+
+def test_pinned_entries_are_never_evicted():
+    cache = main.PrefixCache(4, min_tokens=1)
+    cache.pin([1, 2], b"pinned state")
+    for key in range(3, 10):
+        cache.store([key], b"xxxx")
+    assert cache.lookup([1, 2, 3]) == (2, (1, 2), b"pinned state")
+    # A stored state never replaces a pinned one
+    cache.store([1, 2], b"yyyy")
+    assert cache.lookup([1, 2])[2] == b"pinned state"
+    stats = cache.stats()
+    assert (stats["pinned"], stats["entries"]) == (1, 1)
+
+@needs_model
+def test_serial_generation_reuses_a_cached_prefix(runtime):
+    if runtime.prefix_cache is None:
+        pytest.skip("PREFIX_CACHE_BYTES is 0")
+    prompt = SHARED + "hello"
+
+    def generate(text):
+        return main.generate_response(runtime, text, max_tokens=8, temperature=0, top_p=1.0, stop_tokens=[])
+
+    cache, runtime.prefix_cache = runtime.prefix_cache, None
+    runtime.model.reset()
+    expected = generate(prompt)["text"]
+    runtime.prefix_cache = cache
+
+    generate(SHARED + "world")
+    # Evaluate something unrelated so the live context no longer shares the prefix
+    generate("dog " * 40)
+    reused = cache.stats()["reused_tokens"]
+    assert generate(prompt)["text"] == expected
+    tokens = [main.tokenize_prompt(runtime.model, text) for text in (prompt, SHARED + "world", "dog " * 40)]
+    shared = main.common_prefix_length(tokens[0], tokens[1]) - main.common_prefix_length(tokens[0], tokens[2])
+    assert cache.stats()["reused_tokens"] - reused == shared > 100
+
+@needs_model
+def test_batch_engine_reuses_a_cached_prefix(runtime):
+    engine = main.BatchEngine(runtime.model, n_slots=2, n_batch=64, n_ctx_per_slot=256,
+                              prefix_cache=main.PrefixCache(1 << 26, min_tokens=8))
+    engine.start()
+    try:
+        expected = engine.generate(SHARED + "hello", 8, 0.0, 1.0, [])["text"]
+        engine.generate(SHARED + "world", 8, 0.0, 1.0, [])
+        reused = engine.stats()["prefix_reused_tokens"]
+        assert engine.generate(SHARED + "hello", 8, 0.0, 1.0, [])["text"] == expected
+        assert engine.stats()["prefix_reused_tokens"] > reused
+    finally:
+        engine.stop(timeout=10)
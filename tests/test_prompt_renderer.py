@@ -0,0 +1,81 @@
+from types import SimpleNamespace
+
+import pytest
+
+import main
+from conftest import needs_model
+
+def chat(*pairs):
+    return [main.Message(role=role, content=content) for role, content in pairs]
+
+CONVERSATIONS = [
+    chat(("user", "hello world")),
+    chat(("system", "You are terse."), ("user", "hi"), ("assistant", "hello"), ("user", "and now?")),
+    chat(("user", " leading space"), ("assistant", "trailing space "), ("user", "")),
+    chat(("user", "multi\n\nline\n"), ("tool", "naïve café ☕ 日本"), ("user", "Human: quoted <b>markup</b>")),
+    chat(("critic", "unknown roles become user turns")),
+]
+
+def test_chatml_layout():
+    messages = chat(("system", "be brief"), ("user", "hi"), ("function", "42"))
+    assert main.CHATML_TEMPLATE.render_text(messages) == (
+        "<|im_start|>system\nbe brief<|im_end|>\n"
+        "<|im_start|>user\nhi<|im_end|>\n"
+        "<|im_start|>assistant\n42<|im_end|>\n"
+        "<|im_start|>assistant\n"
+    )
+    assert main.build_chatml_prompt(messages, add_assistant_prompt=False).endswith("42<|im_end|>\n")
+
+def test_anthropic_layout_puts_system_first_and_drops_unknown_roles():
+    messages = [main.AnthropicMessage(role="user", content="hi"), main.AnthropicMessage(role="system", content="rules"),
+                main.AnthropicMessage(role="critic", content="dropped")]
+    assert main.build_anthropic_prompt(messages) == "rules\n\nHuman: hi\n\nAssistant:"
+
+def test_template_is_picked_from_the_gguf_chat_template(monkeypatch):
+    monkeypatch.setattr(main, "PROMPT_TEMPLATE", "auto")
+
+    def llm(chat_template):
+        return SimpleNamespace(metadata={"tokenizer.chat_template": chat_template})
+
+    assert main.select_template(llm("{{ '<|start_header_id|>' }}...<|eot_id|>")).name == "llama3"
+    assert main.select_template(llm("<start_of_turn>user")).name == "gemma"
+    assert main.select_template(llm("")).name == "chatml"
+    monkeypatch.setattr(main, "PROMPT_TEMPLATE", "phi3")
+    assert main.select_template(llm("<start_of_turn>")).name == "phi3"
+    monkeypatch.setattr(main, "PROMPT_TEMPLATE", "nope")
+    with pytest.raises(ValueError, match="Unknown PROMPT_TEMPLATE"):
+        main.select_template(llm(""))
+
+@needs_model
+@pytest.mark.parametrize("renderer", ["chat_renderer", "anthropic_renderer"])
+@pytest.mark.parametrize("messages", CONVERSATIONS)
+def test_rendered_tokens_match_tokenizing_the_text(runtime, renderer, messages):
+    renderer = getattr(runtime, renderer)
+    text = renderer.template.render_text(messages)
+    assert renderer.render(messages) == runtime.model.tokenize(text.encode("utf-8"), add_bos=True, special=True)
+    prefix = renderer.template.render_text(messages, add_generation_prompt=False)
+    assert renderer.render_prefix(messages) == runtime.model.tokenize(prefix.encode("utf-8"), add_bos=True,
+                                                                      special=True)
+
+@needs_model
+def test_probe_picks_a_piecewise_mode_for_chatml(runtime):
+    assert runtime.chat_renderer.template.name == "chatml"
+    assert runtime.chat_renderer.mode in ("split", "message")
+
+@needs_model
+def test_a_new_turn_only_tokenizes_the_new_message(runtime):
+    renderer = main.PromptRenderer(runtime.chat_renderer.template, runtime.model)
+    history = chat(("system", "You are terse."), ("user", "first question"), ("assistant", "first answer"))
+    renderer.render(history)
+    calls = runtime.model.tokenizer_calls
+    hits = renderer.hits
+    renderer.render(history + chat(("user", "second question")))
+    assert runtime.model.tokenizer_calls - calls == 1
+    assert renderer.hits - hits == len(history)
+
+@needs_model
+def test_memoized_pieces_are_bounded(runtime):
+    renderer = main.PromptRenderer(runtime.chat_renderer.template, runtime.model, max_entries=2)
+    for word in ("one", "two", "three"):
+        renderer.render(chat(("user", word)))
+    assert renderer.stats()["entries"] == 2
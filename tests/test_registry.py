@@ -0,0 +1,139 @@
+import asyncio
+import os
+import shutil
+
+import pytest
+
+import main
+from conftest import MODEL_PATH, needs_model, serve
+
+pytestmark = pytest.mark.anyio
+
+ADMIN = {"Authorization": "Bearer secret"}
+
+def test_parse_model_specs():
+    specs = main.parse_model_specs(" a=/m/a.gguf ; b = /m/b.gguf;")
+    assert list(specs.items()) == [("a", "/m/a.gguf"), ("b", "/m/b.gguf")]
+    with pytest.raises(ValueError, match="is not name=path"):
+        main.parse_model_specs("a=/m/a.gguf;b")
+
+def test_without_models_the_default_serves_model_path():
+    assert list(main.parse_model_specs("").items()) == [(main.OPENAI_MODEL_MAP["default"], main.MODEL_PATH)]
+
+def test_model_files_must_be_ggufs_inside_model_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "MODEL_DIR", str(tmp_path))
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "model.gguf").write_bytes(b"GGUF")
+    (tmp_path / "notes.txt").write_text("")
+    assert main.resolve_model_file("sub/model.gguf") == os.path.realpath(tmp_path / "sub" / "model.gguf")
+    with pytest.raises(ValueError, match="inside MODEL_DIR"):
+        main.resolve_model_file("../outside.gguf")
+    with pytest.raises(ValueError, match="inside MODEL_DIR"):
+        main.resolve_model_file("/etc/passwd")
+    with pytest.raises(ValueError, match="No GGUF file"):
+        main.resolve_model_file("notes.txt")
+    with pytest.raises(ValueError, match="No GGUF file"):
+        main.resolve_model_file("missing.gguf")
+
+@pytest.fixture(scope="module")
+def copies():
+    """Two more GGUF files in MODEL_DIR, so the registry sees distinct models."""
+    if not os.path.exists(MODEL_PATH):
+        pytest.skip("needs the gguf package or TEST_MODEL_PATH for a test model")
+    paths = []
+    for name in ("second.gguf", "third.gguf"):
+        path = os.path.join(os.path.dirname(MODEL_PATH), name)
+        shutil.copyfile(MODEL_PATH, path)
+        paths.append(path)
+    yield paths
+    for path in paths:
+        os.remove(path)
+
+def chat(model):
+    return {"model": model, "messages": [{"role": "user", "content": "hello"}], "max_tokens": 4, "temperature": 0}
+
+async def wait_until(check, timeout=30.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not check():
+        assert asyncio.get_running_loop().time() < deadline
+        await asyncio.sleep(0.02)
+
+@needs_model
+async def test_model_management_needs_the_admin_token(monkeypatch):
+    async with serve(monkeypatch, ADMIN_TOKEN="") as client:
+        disabled = await client.post("/v1/models/smollm2-135m-instruct/load", headers=ADMIN)
+    async with serve(monkeypatch, ADMIN_TOKEN="secret") as client:
+        missing = await client.delete("/v1/models/smollm2-135m-instruct")
+        wrong = await client.delete("/v1/models/smollm2-135m-instruct", headers={"Authorization": "Bearer nope"})
+        header = await client.delete("/v1/models/smollm2-135m-instruct", headers={"X-Admin-Token": "secret"})
+    assert disabled.status_code == 403
+    assert missing.status_code == wrong.status_code == 401
+    # Past the gate: the default model cannot be unloaded
+    assert header.status_code == 409
+
+@needs_model
+async def test_requests_route_by_model_name(monkeypatch, copies):
+    models = f"tiny={MODEL_PATH};second={copies[0]}"
+    async with serve(monkeypatch, MODELS=models, ADMIN_TOKEN="secret") as client:
+        await wait_until(lambda: "second" in main.registry.runtimes)
+        listed = (await client.get("/v1/models")).json()["data"]
+        default = (await client.post("/v1/chat/completions", json=chat("gpt-4"))).json()
+        second = (await client.post("/v1/chat/completions", json=chat("second"))).json()
+        requests = {name: runtime.requests for name, runtime in main.registry.runtimes.items()}
+        unknown = await client.delete("/v1/models/nope", headers=ADMIN)
+        unregistered = await client.post("/v1/models/nope/load", headers=ADMIN)
+    assert {(model["id"], model["default"]) for model in listed} == {("tiny", True), ("second", False)}
+    # Unregistered names (such as the display names clients send) go to the default model
+    assert default["model"] == main.OPENAI_MODEL_MAP["default"]
+    assert second["model"] == "second"
+    assert requests == {"tiny": 1, "second": 1}
+    assert unknown.status_code == unregistered.status_code == 404
+
+@needs_model
+async def test_unloaded_models_reload_on_their_next_request(monkeypatch, copies):
+    models = f"tiny={MODEL_PATH};second={copies[0]}"
+    async with serve(monkeypatch, MODELS=models, ADMIN_TOKEN="secret") as client:
+        await wait_until(lambda: "second" in main.registry.runtimes)
+        runtime = main.registry.runtimes["second"]
+        deleted = await client.delete("/v1/models/second", headers=ADMIN)
+        await wait_until(lambda: runtime.model is None)
+        loads = main.registry.loads
+        response = await client.post("/v1/chat/completions", json=chat("second"))
+        reloaded = main.registry.runtimes["second"]
+    assert deleted.json() == {"id": "second", "object": "model", "deleted": True}
+    assert response.status_code == 200
+    assert main.registry.loads == loads + 1
+    assert reloaded is not runtime
+
+@needs_model
+async def test_a_new_version_is_swapped_in_while_requests_keep_flowing(monkeypatch, copies):
+    async with serve(monkeypatch, MODELS=f"tiny={MODEL_PATH}", ADMIN_TOKEN="secret") as client:
+        old = main.registry.runtimes["tiny"]
+        accepted = await client.post("/v1/models/tiny/load", headers=ADMIN, json={"path": "second.gguf"})
+        # The old version answers until the new one is ready
+        during = await client.post("/v1/chat/completions", json=chat("tiny"))
+        await wait_until(lambda: main.registry.runtimes["tiny"] is not old)
+        await wait_until(lambda: old.model is None)
+        after = await client.post("/v1/chat/completions", json=chat("tiny"))
+        path = main.registry.runtimes["tiny"].path
+        outside = await client.post("/v1/models/tiny/load", headers=ADMIN, json={"path": "../tiny.gguf"})
+    assert accepted.status_code == 202
+    assert accepted.json()["path"] == os.path.realpath(copies[0])
+    assert during.status_code == after.status_code == 200
+    assert main.registry.swaps == 1
+    assert path == os.path.realpath(copies[0])
+    assert outside.status_code == 400
+
+@needs_model
+async def test_idle_models_are_evicted_to_fit_the_memory_budget(monkeypatch, copies):
+    size = os.path.getsize(MODEL_PATH)
+    models = f"tiny={MODEL_PATH};second={copies[0]};third={copies[1]}"
+    async with serve(monkeypatch, MODELS=models, MODEL_MEMORY_BUDGET=size * 2 + size // 2) as client:
+        await wait_until(lambda: "second" in main.registry.runtimes)
+        # third did not fit at startup and loads on first use, evicting second but never the default
+        assert "third" not in main.registry.runtimes
+        response = await client.post("/v1/chat/completions", json=chat("third"))
+        loaded = set(main.registry.runtimes)
+    assert response.json()["model"] == "third"
+    assert loaded == {"tiny", "third"}
+    assert main.registry.evictions == 1
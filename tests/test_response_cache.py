@@ -0,0 +1,93 @@
+import os
+import time
+
+import pytest
+
+import main
+from conftest import needs_model, serve
+
+CHAT = {"messages": [{"role": "user", "content": "hello"}], "max_tokens": 8, "temperature": 0}
+
+def test_backend_is_abstract():
+    with pytest.raises(TypeError):
+        main.ResponseCacheBackend()
+
+def test_memory_cache_hit_and_miss():
+    cache = main.ResponseCache(main.MemoryResponseCache(4, 60))
+    assert cache.get("a") is None
+    cache.set("a", {"text": "x"})
+    assert cache.get("a") == {"text": "x"}
+    stats = cache.stats()
+    assert (stats["backend"], stats["entries"], stats["hits"], stats["misses"], stats["hit_rate"]) == \
+        ("memory", 1, 1, 1, 0.5)
+
+def test_memory_cache_evicts_the_least_recently_used():
+    backend = main.MemoryResponseCache(2, 60)
+    backend.set("a", {"n": 1})
+    backend.set("b", {"n": 2})
+    backend.get("a")
+    backend.set("c", {"n": 3})
+    assert backend.get("b") is None
+    assert backend.get("a") == {"n": 1} and backend.get("c") == {"n": 3}
+
+def test_memory_cache_expires_entries():
+    backend = main.MemoryResponseCache(2, 0.01)
+    backend.set("a", {"n": 1})
+    time.sleep(0.02)
+    assert backend.get("a") is None
+    assert backend.stats()["entries"] == 0
+
+def test_file_cache_round_trip_and_restart(tmp_path):
+    backend = main.FileResponseCache(str(tmp_path), 4, 60)
+    backend.set("a", {"text": "x"})
+    assert backend.get("a") == {"text": "x"}
+    assert backend.get("b") is None
+    # A new instance (another process or a restart) sees the same entries
+    reopened = main.FileResponseCache(str(tmp_path), 4, 60)
+    assert reopened.get("a") == {"text": "x"}
+    assert reopened.stats()["entries"] == 1
+
+def test_file_cache_evicts_the_oldest_files(tmp_path):
+    backend = main.FileResponseCache(str(tmp_path), 2, 60)
+    now = time.time()
+    for age, key in ((20, "a"), (10, "b")):
+        backend.set(key, {"key": key})
+        os.utime(backend._path(key), (now - age, now - age))
+    backend.set("c", {"key": "c"})
+    assert sorted(os.listdir(tmp_path)) == ["b.json", "c.json"]
+    assert backend.get("a") is None
+    assert backend.stats()["entries"] == 2
+
+def test_file_cache_expires_entries(tmp_path):
+    backend = main.FileResponseCache(str(tmp_path), 4, 60)
+    backend.set("a", {"n": 1})
+    os.utime(backend._path("a"), (time.time() - 120, time.time() - 120))
+    assert backend.get("a") is None
+    assert os.listdir(tmp_path) == []
+    assert backend.stats()["entries"] == 0
+
+def test_request_key_is_canonical():
+    key = main.request_key("m", "prompt", 8, 0.0, 1.0, ["</s>"])
+    assert key == main.request_key("m", "prompt", 8, 0.0, 1.0, ["</s>"])
+    assert key != main.request_key("m", "prompt", 9, 0.0, 1.0, ["</s>"])
+    assert key != main.request_key("other", "prompt", 8, 0.0, 1.0, ["</s>"])
+    assert main.request_key("m", "prompt", 8, 0.0, 1.0, None) == \
+        main.request_key("m", "prompt", 8, 0.0, 1.0, main.DEFAULT_STOP_TOKENS)
+
+def test_sampled_requests_are_not_cached():
+    assert main.request_key("m", "prompt", 8, 0.7, 1.0, None) is None
+
+@needs_model
+@pytest.mark.anyio
+async def test_identical_requests_are_served_from_the_cache(monkeypatch):
+    async with serve(monkeypatch, RESPONSE_CACHE="memory") as client:
+        first = await client.post("/v1/chat/completions", json=CHAT)
+        second = await client.post("/v1/chat/completions", json=CHAT)
+        sampled = await client.post("/v1/chat/completions", json={**CHAT, "temperature": 0.8})
+        stats = (await client.get("/health")).json()["response_cache"]
+    assert first.headers["X-Cache"] == "miss"
+    assert second.headers["X-Cache"] == "hit"
+    assert "X-Cache" not in sampled.headers
+    assert second.json()["choices"] == first.json()["choices"]
+    assert second.json()["usage"] == first.json()["usage"]
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 1, 1)
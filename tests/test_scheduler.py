@@ -0,0 +1,83 @@
+import asyncio
+import threading
+
+import pytest
+
+import main
+
+pytestmark = pytest.mark.anyio
+
+@pytest.fixture
+def scheduler():
+    started = main.InferenceScheduler(max_queue_depth=2, queue_timeout=0)
+    started.start()
+    yield started
+    started.stop(timeout=5)
+
+async def test_jobs_run_on_the_worker_thread(scheduler):
+    result, queue_wait = await scheduler.submit(lambda: threading.current_thread().name)
+    assert result == "inference-worker-0"
+    assert queue_wait >= 0
+    assert scheduler.stats()["completed"] == 1
+
+async def test_errors_reach_the_caller(scheduler):
+    def fail():
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError, match="boom"):
+        await scheduler.submit(fail)
+
+async def test_full_queue_rejects_at_once(scheduler):
+    release = threading.Event()
+    running = scheduler.enqueue(release.wait)
+    while scheduler.queue_depth:
+        await asyncio.sleep(0.001)
+    queued = [scheduler.enqueue(lambda: "queued") for _ in range(2)]
+    with pytest.raises(main.SchedulerOverloaded):
+        scheduler.enqueue(lambda: "rejected")
+    assert scheduler.stats()["rejected"] == 1
+    release.set()
+    assert await running.future is True
+    assert [await job.future for job in queued] == ["queued", "queued"]
+
+async def test_stop_fails_queued_jobs(scheduler):
+    release = threading.Event()
+    running = scheduler.enqueue(release.wait)
+    while scheduler.queue_depth:
+        await asyncio.sleep(0.001)
+    queued = scheduler.enqueue(lambda: "never")
+    threading.Timer(0.05, release.set).start()
+    scheduler.stop(timeout=5)
+    with pytest.raises(main.SchedulerUnavailable):
+        await queued.future
+    assert await running.future is True
+    with pytest.raises(main.SchedulerUnavailable):
+        scheduler.enqueue(lambda: "after stop")
+
+async def test_jobs_expire_in_the_queue():
+    scheduler = main.InferenceScheduler(max_queue_depth=4, queue_timeout=0.01)
+    scheduler.start()
+    try:
+        release = threading.Event()
+        running = scheduler.enqueue(release.wait)
+        expired = scheduler.enqueue(lambda: "too late")
+        await asyncio.sleep(0.05)
+        release.set()
+        await running.future
+        with pytest.raises(main.SchedulerUnavailable, match="waited"):
+            await expired.future
+        assert scheduler.stats()["expired"] == 1
+    finally:
+        scheduler.stop(timeout=5)
+
+async def test_health_answers_during_a_generation(monkeypatch):
+    from conftest import serve
+
+    async with serve(monkeypatch) as client:
+        body = {"messages": [{"role": "user", "content": "hello"}], "max_tokens": 200, "stop": []}
+        generation = asyncio.ensure_future(client.post("/v1/chat/completions", json=body))
+        while not main.scheduler.stats()["busy"] and not generation.done():
+            await asyncio.sleep(0.001)
+        health = await client.get("/health")
+        assert health.status_code == 200
+        assert (await generation).status_code == 200
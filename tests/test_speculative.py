@@ -0,0 +1,62 @@
+from types import SimpleNamespace
+
+import pytest
+
+import main
+from conftest import MODEL_PATH, needs_model
+
+# Repeats its n-grams, so prompt lookup always has drafts to propose
+PROMPT = "the quick brown fox jumps over the lazy dog " * 6
+
+def test_prompt_lookup_proposes_what_followed_the_last_ngram():
+    drafter = main.PromptLookupDrafter(n_draft=3, max_ngram_size=2)
+    seqs = [SimpleNamespace(slot=0, context_tokens=[7, 8, 9, 10, 11, 12, 7, 8]),
+            SimpleNamespace(slot=1, context_tokens=[1, 2, 3, 4])]
+    assert drafter.propose(seqs) == {0: [9, 10, 11]}
+
+def test_create_drafter_follows_the_setting(monkeypatch):
+    monkeypatch.setattr(main, "SPECULATIVE", "off")
+    assert main.create_drafter(None, 1, 256, 1) is None
+    monkeypatch.setattr(main, "SPECULATIVE", "prompt-lookup")
+    assert main.create_drafter(None, 1, 256, 1).name == "prompt-lookup"
+    monkeypatch.setattr(main, "SPECULATIVE", "draft")
+    monkeypatch.setattr(main, "DRAFT_MODEL_PATH", "")
+    with pytest.raises(ValueError, match="needs DRAFT_MODEL_PATH"):
+        main.create_drafter(None, 1, 256, 1)
+    monkeypatch.setattr(main, "SPECULATIVE", "medusa")
+    with pytest.raises(ValueError, match="Unknown SPECULATIVE mode"):
+        main.create_drafter(None, 1, 256, 1)
+
+def generate(llm, drafter, prompts, max_tokens=24):
+    engine = main.BatchEngine(llm, n_slots=2, n_batch=128, n_ctx_per_slot=512, drafter=drafter)
+    engine.start()
+    try:
+        results = [engine.generate(prompt, max_tokens, 0.0, 1.0, []) for prompt in prompts]
+        return results, engine.stats()
+    finally:
+        engine.stop(timeout=10)
+
+@needs_model
+def test_prompt_lookup_keeps_greedy_output_unchanged(runtime):
+    prompts = [PROMPT, "hello world"]
+    expected, _ = generate(runtime.model, None, prompts)
+    results, stats = generate(runtime.model, main.PromptLookupDrafter(4, 3), prompts)
+    assert [result["text"] for result in results] == [result["text"] for result in expected]
+    assert [result["completion_tokens"] for result in results] == [result["completion_tokens"] for result in expected]
+    assert stats["speculative"] == "prompt-lookup"
+    assert stats["draft_tokens"] > 0
+    assert stats["draft_tokens"] == sum(result["draft_tokens"] for result in results)
+    assert stats["accepted_draft_tokens"] == sum(result["accepted_draft_tokens"] for result in results)
+    assert 0 <= stats["accepted_draft_tokens"] <= stats["draft_tokens"]
+
+@needs_model
+def test_a_draft_model_identical_to_the_target_is_always_accepted(runtime):
+    prompts = [PROMPT, "hello world"]
+    expected, _ = generate(runtime.model, None, prompts)
+    drafter = main.DraftModelDrafter(MODEL_PATH, runtime.model, n_slots=2, n_ctx_per_slot=512, n_batch=128,
+                                     n_draft=4, n_threads=1)
+    results, stats = generate(runtime.model, drafter, prompts)
+    assert [result["text"] for result in results] == [result["text"] for result in expected]
+    assert stats["speculative"] == "draft"
+    assert stats["draft_tokens"] > 0
+    assert stats["acceptance_rate"] > 0.9
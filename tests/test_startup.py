@@ -0,0 +1,92 @@
+import asyncio
+import threading
+
+import pytest
+
+import main
+from conftest import MODEL_PATH, needs_model, serve
+
+pytestmark = pytest.mark.anyio
+
+CHAT = {"messages": [{"role": "user", "content": "hello"}], "max_tokens": 4, "temperature": 0}
+
+def test_prefetch_modes(tmp_path):
+    path = tmp_path / "model.gguf"
+    path.write_bytes(b"x" * 1000)
+    assert main.prefetch_model_file(str(path), "read") == 1000
+    assert main.prefetch_model_file(str(path), "willneed") == 0
+    assert main.prefetch_model_file(str(path), "off") == 0
+    assert main.prefetch_model_file(str(tmp_path / "missing.gguf"), "read") == 0
+    with pytest.raises(ValueError, match="Unknown MODEL_PREFETCH mode"):
+        main.prefetch_model_file(str(path), "eager")
+
+@pytest.fixture
+def held_load(monkeypatch):
+    """Make ModelRuntime.load wait until the returned event is set."""
+    release = threading.Event()
+    load = main.ModelRuntime.load
+
+    def slow_load(runtime):
+        release.wait(30)
+        load(runtime)
+
+    monkeypatch.setattr(main.ModelRuntime, "load", slow_load)
+    yield release
+    release.set()
+
+@needs_model
+async def test_health_is_503_until_the_model_is_ready(monkeypatch, held_load):
+    async with serve(monkeypatch, ready=False, MODEL_PREFETCH="read", WARMUP_TOKENS=2) as client:
+        loading = await client.get("/health")
+        # A request that arrives during the load waits for it instead of failing
+        pending = asyncio.ensure_future(client.post("/v1/chat/completions", json=CHAT))
+        await asyncio.sleep(0.1)
+        assert not pending.done()
+        held_load.set()
+        response = await pending
+        ready = await client.get("/health")
+    assert loading.status_code == 503
+    assert (loading.json()["status"], loading.json()["model_loaded"]) == ("loading", False)
+    assert response.status_code == 200
+    assert ready.status_code == 200
+    body = ready.json()
+    assert (body["status"], body["model_loaded"]) == ("ready", True)
+    assert body["models"]["ready_after_seconds"] > 0
+    startup = body["models"]["loaded"][0]["startup"]
+    assert {"prefetch_seconds", "load_seconds", "setup_seconds", "warmup_seconds", "total_seconds"} <= set(startup)
+    assert startup["total_seconds"] >= startup["load_seconds"]
+
+@needs_model
+async def test_without_warm_up_the_phase_is_skipped(monkeypatch):
+    async with serve(monkeypatch, WARMUP_TOKENS=0) as client:
+        startup = (await client.get("/health")).json()["models"]["loaded"][0]["startup"]
+    assert "warmup_seconds" not in startup
+
+@needs_model
+async def test_a_failed_load_reports_an_error(monkeypatch, tmp_path):
+    broken = tmp_path / "broken.gguf"
+    broken.write_bytes(b"not a gguf file")
+    async with serve(monkeypatch, ready=False, MODELS=f"broken={broken}") as client:
+        while "broken" not in main.registry.errors:
+            await asyncio.sleep(0.02)
+        health = await client.get("/health")
+    assert health.status_code == 503
+    assert health.json()["status"] == "error"
+    assert "broken" in health.json()["models"]["errors"]
+
+@needs_model
+def test_unload_waits_for_outstanding_leases():
+    runtime = main.ModelRuntime("tiny", MODEL_PATH)
+    runtime.load()
+    runtime.acquire()
+    unloaded = threading.Event()
+    thread = threading.Thread(target=lambda: (runtime.unload(), unloaded.set()))
+    thread.start()
+    assert not unloaded.wait(0.1)
+    assert runtime.model is not None
+    runtime.release()
+    assert unloaded.wait(10)
+    thread.join()
+    assert runtime.model is None
+    with pytest.raises(RuntimeError, match="has been unloaded"):
+        runtime.acquire()
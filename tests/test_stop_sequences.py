@@ -0,0 +1,133 @@
+import random
+
+import pytest
+
+import main
+from conftest import needs_model, serve
+
+def reference(text, stops):
+    """Text before the first stop sequence to complete (the longest one ending there), and that stop."""
+    for end in range(1, len(text) + 1):
+        ending = [stop for stop in stops if stop and text[:end].endswith(stop)]
+        if ending:
+            stop = max(ending, key=len)
+            return text[:end - len(stop)], stop
+    return text, None
+
+def scan(stops, pieces):
+    scanner = main.StopScanner(main.StopMatcher(tuple(stops)))
+    shown = []
+    for piece in pieces:
+        shown.append(scanner.feed(piece))
+        if scanner.stop_sequence is not None:
+            return "".join(shown), scanner.stop_sequence
+    shown.append(scanner.flush())
+    return "".join(shown), None
+
+def split(text, rng):
+    cuts = sorted(rng.sample(range(1, len(text)), min(len(text) - 1, rng.randint(0, 6)))) if len(text) > 1 else []
+    return [text[a:b] for a, b in zip([0] + cuts, cuts + [len(text)])]
+
+@pytest.mark.parametrize("stops, pieces, expected", [
+    (["</s>"], ["hello</", "s> world"], ("hello", "</s>")),
+    (["\nUser:"], ["fine\n", "Us", "er: hi"], ("fine", "\nUser:")),
+    (["abc", "bcd"], ["ab", "cd"], ("", "abc")),
+    (["bc", "abcd"], ["abcd"], ("a", "bc")),
+    (["cd", "abcd"], ["abcd"], ("", "abcd")),
+    (["xyz"], ["xy", "xy", "z"], ("xy", "xyz")),
+    (["xyz"], ["x", "y"], ("xy", None)),
+    ([], ["anything"], ("anything", None)),
+])
+def test_stops_across_chunk_boundaries(stops, pieces, expected):
+    assert scan(stops, pieces) == expected
+
+def test_only_possible_stop_prefixes_are_held_back():
+    scanner = main.StopScanner(main.StopMatcher(("<|im_end|>",)))
+    assert scanner.feed("hello <|im") == "hello "
+    assert scanner.feed("_start") == "<|im_start"
+    assert scanner.feed("<") == ""
+    assert scanner.flush() == "<"
+
+def test_random_texts_match_a_brute_force_search():
+    rng = random.Random(0)
+    for _ in range(2000):
+        stops = ["".join(rng.choice("abc") for _ in range(rng.randint(1, 4))) for _ in range(rng.randint(1, 4))]
+        text = "".join(rng.choice("abcd") for _ in range(rng.randint(0, 30)))
+        assert scan(stops, split(text, rng)) == reference(text, stops), (stops, text)
+
+def test_matchers_are_shared_per_stop_set():
+    matcher = main.compile_stop_matcher(["b", "a", "", "b"])
+    assert matcher.stops == ("b", "a")
+    assert main.compile_stop_matcher(["b", "a"]) is matcher
+    assert main.compile_stop_matcher(["a", "b"]) is not matcher
+
+def greedy(runtime, stops, max_tokens=24):
+    return main.generate_response(runtime, "the quick brown fox", max_tokens=max_tokens, temperature=0, top_p=1.0,
+                                  stop_tokens=stops)
+
+def pick_stop(text):
+    """A stretch of text whose first occurrence is well inside it."""
+    for start in range(4, len(text) - 3):
+        stop = text[start:start + 3]
+        if text.index(stop) == start and stop.strip() == stop:
+            return stop
+    pytest.skip("the test model's output is too short to pick a stop sequence from")
+
+@needs_model
+def test_generation_stops_before_the_stop_sequence(runtime):
+    full = greedy(runtime, [])
+    assert full["finish_reason"] == "length"
+    assert full["stop_sequence"] is None
+    assert full["completion_tokens"] == 24
+    stop = pick_stop(full["text"])
+    result = greedy(runtime, [stop])
+    assert result["text"] == full["text"][:full["text"].index(stop)].strip()
+    assert (result["finish_reason"], result["stop_sequence"]) == ("stop", stop)
+    assert result["completion_tokens"] < full["completion_tokens"]
+
+@needs_model
+def test_the_batch_engine_stops_like_the_serial_path(runtime):
+    full = greedy(runtime, [])
+    stop = pick_stop(full["text"])
+    engine = main.BatchEngine(runtime.model, n_slots=2, n_batch=64, n_ctx_per_slot=256)
+    engine.start()
+    try:
+        pieces = []
+        result = engine.generate("the quick brown fox", 24, 0.0, 1.0, [stop], on_text=pieces.append)
+    finally:
+        engine.stop(timeout=10)
+    assert result["text"] == greedy(runtime, [stop])["text"]
+    assert result["stop_sequence"] == stop
+    assert stop not in "".join(pieces)
+
+@needs_model
+def test_serial_streams_never_show_the_stop_sequence(runtime):
+    full = greedy(runtime, [])
+    stop = pick_stop(full["text"])
+    messages = []
+    result = main.generate_response_stream(runtime, "the quick brown fox", main.PipeStream(messages.append, 1),
+                                           max_tokens=24, temperature=0, top_p=1.0, stop_tokens=[stop])
+    streamed = "".join(payload[0] for kind, _, payload in messages if kind == "text")
+    assert stop not in streamed
+    assert streamed.strip() == result["text"]
+
+@needs_model
+@pytest.mark.anyio
+async def test_stop_reasons_in_the_apis(monkeypatch):
+    openai = {"messages": [{"role": "user", "content": "hello"}], "max_tokens": 6, "temperature": 0, "stop": []}
+    anthropic = {"model": "claude", "messages": openai["messages"], "max_tokens": 6, "temperature": 0}
+    async with serve(monkeypatch, RESPONSE_CACHE="none") as client:
+        full = (await client.post("/v1/chat/completions", json=openai)).json()
+        message = (await client.post("/v1/messages", json=anthropic)).json()
+        openai_stop = full["choices"][0]["message"]["content"][-2:]
+        anthropic_stop = message["content"][0]["text"][-2:]
+        stopped = (await client.post("/v1/chat/completions", json={**openai, "stop": [openai_stop]})).json()
+        stopped_message = (await client.post("/v1/messages",
+                                             json={**anthropic, "stop_sequences": [anthropic_stop]})).json()
+    assert (full["choices"][0]["finish_reason"], full["choices"][0]["stop_reason"]) == ("length", None)
+    assert (message["stop_reason"], message["stop_sequence"]) == ("max_tokens", None)
+    choice = stopped["choices"][0]
+    assert (choice["finish_reason"], choice["stop_reason"]) == ("stop", openai_stop)
+    assert openai_stop not in choice["message"]["content"]
+    assert (stopped_message["stop_reason"], stopped_message["stop_sequence"]) == ("stop_sequence", anthropic_stop)
+    assert anthropic_stop not in stopped_message["content"][0]["text"]
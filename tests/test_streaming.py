@@ -0,0 +1,85 @@
+import asyncio
+import json
+import threading
+
+import pytest
+
+import main
+from conftest import serve
+
+pytestmark = pytest.mark.anyio
+
+CHAT = {"messages": [{"role": "user", "content": "tell me about the fox"}], "max_tokens": 16, "temperature": 0, "stop": []}
+
+async def sse(client, path, body):
+    """(event, data) pairs of a streamed response."""
+    events, event = [], None
+    async with client.stream("POST", path, json=body) as response:
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/event-stream")
+        async for line in response.aiter_lines():
+            if line.startswith("event: "):
+                event = line[7:]
+            elif line.startswith("data: "):
+                data = line[6:]
+                events.append((event, data if data == "[DONE]" else json.loads(data)))
+                event = None
+    return events
+
+async def test_openai_stream_matches_the_completion(monkeypatch):
+    async with serve(monkeypatch, RESPONSE_CACHE="none") as client:
+        completion = (await client.post("/v1/chat/completions", json=CHAT)).json()
+        events = await sse(client, "/v1/chat/completions", {**CHAT, "stream": True})
+    chunks = [data for _, data in events[:-1]]
+    assert events[-1][1] == "[DONE]"
+    assert chunks[0]["choices"][0]["delta"] == {"role": "assistant", "content": ""}
+    assert chunks[-1]["choices"][0]["finish_reason"] == completion["choices"][0]["finish_reason"]
+    text = "".join(chunk["choices"][0]["delta"].get("content", "") for chunk in chunks)
+    assert text == completion["choices"][0]["message"]["content"]
+    assert {chunk["object"] for chunk in chunks} == {"chat.completion.chunk"}
+
+async def test_anthropic_stream_event_order(monkeypatch):
+    body = {"model": "claude", "messages": CHAT["messages"], "max_tokens": 8, "stream": True}
+    async with serve(monkeypatch) as client:
+        events = await sse(client, "/v1/messages", body)
+    names = [event for event, _ in events]
+    assert names[:2] == ["message_start", "content_block_start"]
+    assert names[-3:] == ["content_block_stop", "message_delta", "message_stop"]
+    assert set(names[2:-3]) <= {"content_block_delta"}
+    assert events[0][1]["message"]["usage"]["input_tokens"] > 0
+    # Every delta carries at least one token
+    assert events[-2][1]["usage"]["output_tokens"] >= len(names[2:-3])
+
+async def test_token_stream_blocks_the_writer_until_read():
+    stream = main.TokenStream(asyncio.get_running_loop(), max_buffer=2)
+    written = []
+
+    def write():
+        for i in range(5):
+            if not stream.put(str(i)):
+                break
+            written.append(i)
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    await asyncio.sleep(0.05)
+    # Two pieces fit the buffer; the third put waits for the reader
+    assert len(written) <= 3
+    received = []
+    async for text in stream:
+        received.append(text)
+        if len(received) == 5:
+            break
+    await asyncio.to_thread(writer.join)
+    assert received == ["0", "1", "2", "3", "4"]
+
+async def test_cancelled_token_stream_stops_the_writer():
+    stream = main.TokenStream(asyncio.get_running_loop(), max_buffer=1)
+    results = []
+    writer = threading.Thread(target=lambda: results.extend(stream.put("x") for _ in range(3)))
+    writer.start()
+    await asyncio.sleep(0.05)
+    stream.cancel()
+    await asyncio.to_thread(writer.join, 5)
+    assert not writer.is_alive()
+    assert results[-1] is False
@@ -0,0 +1,161 @@
+import http.server
+import json
+import threading
+import time
+
+import pytest
+
+import main
+from conftest import needs_model, serve
+
+TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+PARENT_ID = "00f067aa0ba902b7"
+
+@pytest.mark.parametrize("header, expected", [
+    (f"00-{TRACE_ID}-{PARENT_ID}-01", (TRACE_ID, PARENT_ID)),
+    (f" 00-{TRACE_ID.upper()}-{PARENT_ID}-00 ", (TRACE_ID, PARENT_ID)),
+    (None, (None, None)),
+    ("garbage", (None, None)),
+    (f"00-{'0' * 32}-{PARENT_ID}-01", (None, None)),
+    (f"00-{TRACE_ID}-{'0' * 16}-01", (None, None)),
+    (f"00-{TRACE_ID[:-1]}x-{PARENT_ID}-01", (None, None)),
+])
+def test_parse_traceparent(header, expected):
+    assert main.parse_traceparent(header) == expected
+
+def tracer(tmp_path, **settings):
+    options = {"sample_rate": 1.0, "slow_seconds": 1.0, "buffer": 100}
+    options.update(settings)
+    return main.Tracer(str(tmp_path / "traces.jsonl"), **options)
+
+def test_disabled_tracing_records_nothing():
+    disabled = main.Tracer("", 1.0, 1.0, 10)
+    trace = disabled.begin("openai", "chatcmpl-")
+    trace.span("decode", time.perf_counter())
+    trace.set(model="x")
+    trace.finish(500, ValueError("boom"))
+    assert trace.request_id.startswith("chatcmpl-")
+    assert (trace.spans, trace.attrs, trace.error) == ([], {}, None)
+    assert disabled.stats()["kept"] == 0
+
+def test_errors_and_slow_requests_are_kept_whatever_the_sample(tmp_path):
+    sampled_out = tracer(tmp_path, sample_rate=0.0, slow_seconds=0.05)
+    sampled_out.begin("openai", "chatcmpl-").finish(200)
+    sampled_out.begin("openai", "chatcmpl-").finish(503, main.SchedulerUnavailable("stopped"))
+    slow = sampled_out.begin("openai", "chatcmpl-")
+    slow.started -= 0.1
+    slow.finish(200)
+    assert (sampled_out.kept, sampled_out.sampled_out) == (2, 1)
+
+def test_a_full_buffer_drops_traces(tmp_path):
+    full = tracer(tmp_path, buffer=2)
+    for _ in range(3):
+        full.begin("openai", "chatcmpl-").finish(200)
+    assert (full.kept, full.dropped) == (2, 1)
+
+def test_records_time_spans_from_the_arrival(tmp_path):
+    trace = tracer(tmp_path).begin("openai", "chatcmpl-")
+    trace.generation({"prompt_tokens": 5, "completion_tokens": 3, "finish_reason": "length",
+                      "prefill_seconds": 0.02, "decode_seconds": 0.03}, queue_wait=0.01)
+    trace.set(model="tiny")
+    trace.finish(200)
+    record = trace.record()
+    assert [span["name"] for span in record["spans"]] == ["validate", "queue", "prefill", "decode"]
+    queue_span, prefill, decode = record["spans"][1:]
+    assert prefill["duration_ms"] == pytest.approx(20, abs=0.01)
+    assert decode["duration_ms"] == pytest.approx(30, abs=0.01)
+    assert queue_span["start_ms"] + queue_span["duration_ms"] == pytest.approx(prefill["start_ms"], abs=0.01)
+    assert (record["model"], record["prompt_tokens"], record["finish_reason"]) == ("tiny", 5, "length")
+    assert record["request_id"] == trace.request_id
+
+def test_otlp_payload_nests_spans_under_the_request(tmp_path):
+    trace = main.RequestTrace(tracer(tmp_path), "chatcmpl-1", TRACE_ID, PARENT_ID, "openai", time.perf_counter(),
+                              True)
+    trace.span("decode", trace.started)
+    trace.set(model="tiny", prompt_tokens=5, cached=False, latency=0.5, missing=None)
+    trace.finished = time.perf_counter()
+    trace.status = 500
+    trace.set_error(RuntimeError("boom"))
+    spans = main.otlp_payload([trace], "svc")["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    root, child = spans
+    assert (root["traceId"], root["parentSpanId"], root["kind"]) == (TRACE_ID, PARENT_ID, 2)
+    assert root["status"] == {"code": 2, "message": "RuntimeError: boom"}
+    attributes = {item["key"]: item["value"] for item in root["attributes"]}
+    assert attributes["http.status_code"] == {"intValue": "500"}
+    assert attributes["model"] == {"stringValue": "tiny"}
+    assert attributes["cached"] == {"boolValue": False}
+    assert attributes["latency"] == {"doubleValue": 0.5}
+    assert "missing" not in attributes
+    assert (child["name"], child["parentSpanId"], child["traceId"]) == ("decode", root["spanId"], TRACE_ID)
+    assert int(root["startTimeUnixNano"]) <= int(child["startTimeUnixNano"]) <= int(root["endTimeUnixNano"])
+
+@pytest.fixture
+def collector():
+    """A local OTLP/HTTP endpoint collecting the payloads posted to it."""
+    received = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            received.append(json.loads(self.rfile.read(int(self.headers["Content-Length"]))))
+            self.send_response(200)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/v1/traces", received
+    server.shutdown()
+
+def test_the_writer_logs_lines_and_exports_otlp(tmp_path, collector):
+    endpoint, received = collector
+    writer = main.Tracer(str(tmp_path / "traces.jsonl"), 1.0, 1.0, 100, endpoint, "svc")
+    writer.start()
+    for _ in range(3):
+        writer.begin("openai", "chatcmpl-").finish(200)
+    writer.event("model_loaded", model="tiny")
+    writer.stop()
+    lines = [json.loads(line) for line in (tmp_path / "traces.jsonl").read_text().splitlines()]
+    assert [line["type"] for line in lines] == ["request"] * 3 + ["model_loaded"]
+    assert writer.stats()["written"] == 4
+    assert writer.stats()["exported"] == 3
+    spans = [span for payload in received for span in payload["resourceSpans"][0]["scopeSpans"][0]["spans"]]
+    assert {span["traceId"] for span in spans} == {line["trace_id"] for line in lines[:3]}
+    assert received[0]["resourceSpans"][0]["resource"]["attributes"] == [
+        {"key": "service.name", "value": {"stringValue": "svc"}}
+    ]
+
+@needs_model
+@pytest.mark.anyio
+async def test_requests_are_traced_end_to_end(monkeypatch, tmp_path):
+    path = tmp_path / "traces.jsonl"
+    monkeypatch.setattr(main, "tracer", main.Tracer(str(path), 1.0, 10.0, 1000))
+    chat = {"messages": [{"role": "user", "content": "hello"}], "max_tokens": 4, "temperature": 0}
+    headers = {"traceparent": f"00-{TRACE_ID}-{PARENT_ID}-01"}
+    async with serve(monkeypatch, RESPONSE_CACHE="none", CONTEXT_POLICY="error") as client:
+        completion = await client.post("/v1/chat/completions", json=chat, headers=headers)
+        embedding = await client.post("/v1/embeddings", json={"input": ["one", "two"]})
+        too_long = [{"role": "user", "content": "the quick brown fox " * 300}]
+        rejected = await client.post("/v1/chat/completions", json={**chat, "messages": too_long})
+        batch_line = await main.BatchManager._execute({"custom_id": "line-1", "body": chat})
+    records = {record.get("request_id"): record
+               for record in map(json.loads, path.read_text().splitlines()) if record["type"] == "request"}
+    assert completion.headers["X-Request-Id"] == completion.json()["id"]
+    traced = records[completion.json()["id"]]
+    assert traced["trace_id"] == TRACE_ID
+    names = [span["name"] for span in traced["spans"]]
+    assert names[:2] == ["validate", "template"]
+    assert {"queue", "prefill", "decode", "serialize"} <= set(names)
+    assert (traced["status"], traced["completion_tokens"]) == (200, completion.json()["usage"]["completion_tokens"])
+    embedded = records[embedding.headers["X-Request-Id"]]
+    assert {"queue", "embed", "serialize"} <= {span["name"] for span in embedded["spans"]}
+    assert embedded["inputs"] == 2
+    assert rejected.status_code == 400
+    failed = [record for record in records.values() if record["status"] == 400]
+    assert [record["error"]["type"] for record in failed] == ["ContextLengthExceeded"]
+    assert "Traceback" in failed[0]["error"]["stack"]
+    batch_trace = records[batch_line["id"]]
+    assert (batch_trace["endpoint"], batch_trace["custom_id"], batch_trace["status"]) == ("batch", "line-1", 200)
+    assert "decode" in {span["name"] for span in batch_trace["spans"]}
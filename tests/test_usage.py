@@ -0,0 +1,65 @@
+import pytest
+
+import main
+from conftest import needs_model, serve
+
+PROMPT = "the quick brown fox jumps over the lazy dog"
+
+def generate(runtime, prompt, max_tokens=12):
+    return main.generate_response(runtime, prompt, max_tokens=max_tokens, temperature=0, top_p=1.0, stop_tokens=[])
+
+def stream(runtime, prompt, max_tokens=12):
+    messages = []
+    token_stream = main.PipeStream(messages.append, 1)
+    result = main.generate_response_stream(runtime, prompt, token_stream, max_tokens=max_tokens, temperature=0,
+                                           top_p=1.0, stop_tokens=[])
+    return result, messages
+
+@needs_model
+def test_prompt_is_tokenized_once(runtime):
+    calls = runtime.model.tokenizer_calls
+    result = generate(runtime, PROMPT)
+    assert runtime.model.tokenizer_calls - calls == 1
+    assert result["prompt_tokens"] == len(runtime.model.tokenize(PROMPT.encode()))
+
+@needs_model
+def test_token_prompts_are_not_tokenized(runtime):
+    tokens = runtime.model.tokenize(PROMPT.encode())
+    calls = runtime.model.tokenizer_calls
+    result = generate(runtime, tokens)
+    assert runtime.model.tokenizer_calls == calls
+    assert result["prompt_tokens"] == len(tokens)
+
+@needs_model
+def test_usage_adds_up(runtime):
+    result = generate(runtime, PROMPT, max_tokens=6)
+    assert result["total_tokens"] == result["prompt_tokens"] + result["completion_tokens"]
+    if result["finish_reason"] == "length":
+        assert result["completion_tokens"] == 6
+    else:
+        assert 0 < result["completion_tokens"] <= 6
+
+@needs_model
+def test_streaming_counts_match_the_completion(runtime):
+    expected = generate(runtime, PROMPT)
+    calls = runtime.model.tokenizer_calls
+    result, messages = stream(runtime, PROMPT)
+    assert runtime.model.tokenizer_calls - calls == 1
+    assert messages[0] == ("start", 1, expected["prompt_tokens"])
+    for key in ("text", "prompt_tokens", "completion_tokens", "total_tokens", "finish_reason"):
+        assert result[key] == expected[key]
+
+@needs_model
+@pytest.mark.anyio
+async def test_http_requests_tokenize_once(monkeypatch):
+    body = {"messages": [{"role": "user", "content": PROMPT}], "max_tokens": 8, "temperature": 0}
+
+    async def tokenizer_calls():
+        return (await client.get("/health")).json()["models"]["loaded"][0]["tokenizer_calls"]
+
+    async with serve(monkeypatch, RESPONSE_CACHE="none") as client:
+        before = await tokenizer_calls()
+        usage = (await client.post("/v1/chat/completions", json=body)).json()["usage"]
+        after = await tokenizer_calls()
+    assert after - before == 1
+    assert usage["total_tokens"] == usage["prompt_tokens"] + usage["completion_tokens"]
@@ -0,0 +1,78 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import main
+from conftest import MODEL_PATH, needs_model
+
+def test_parse_cpu_sets():
+    assert main.parse_cpu_sets("0-3;4,6-7; 9 ;") == [[0, 1, 2, 3], [4, 6, 7], [9]]
+    assert main.parse_cpu_sets("") == []
+
+def test_split_cpus_into_contiguous_sets():
+    assert main.split_cpus(list(range(8)), 2) == [[0, 1, 2, 3], [4, 5, 6, 7]]
+    assert main.split_cpus(list(range(7)), 3) == [[0, 1, 2], [3, 4], [5, 6]]
+
+def test_split_cpus_shares_when_there_are_too_few():
+    assert main.split_cpus([0], 2) == [[0], [0]]
+
+def test_pool_needs_a_core_set_per_worker():
+    with pytest.raises(ValueError, match="2 core sets for 3 workers"):
+        main.WorkerPool(3, [[0], [1]], MODEL_PATH)
+
+@pytest.fixture(scope="module")
+def pool():
+    cpus = main.available_cpus()
+    pool = main.WorkerPool(2, main.split_cpus(cpus, 2), MODEL_PATH)
+    pool.start(timeout=120)
+    yield pool
+    pool.stop()
+
+@needs_model
+def test_workers_are_pinned_to_their_core_sets(pool):
+    stats = pool.stats()["workers"]
+    assert [worker["cpus"] for worker in stats] == main.split_cpus(main.available_cpus(), 2)
+    for worker in stats:
+        assert worker["alive"] and worker["pid"] != os.getpid()
+        if hasattr(os, "sched_getaffinity"):
+            assert os.sched_getaffinity(worker["pid"]) == set(worker["cpus"])
+
+@needs_model
+def test_worker_output_matches_the_serial_path(runtime, pool):
+    expected = main.generate_response(runtime, "hello world", max_tokens=12, temperature=0, top_p=1.0, stop_tokens=[])
+    result = pool.generate("hello world", 12, 0.0, 1.0, [])
+    assert result["text"] == expected["text"]
+    assert result["completion_tokens"] == expected["completion_tokens"]
+
+@needs_model
+def test_streamed_text_is_relayed(pool):
+    pieces, started = [], []
+    result = pool.generate("the quick brown fox", 12, 0.0, 1.0, [], on_start=started.append, on_text=pieces.append)
+    assert started == [result["prompt_tokens"]]
+    assert "".join(pieces).strip() == result["text"]
+
+@needs_model
+def test_concurrent_requests_go_to_the_least_loaded_worker(pool):
+    completed = [worker["completed"] for worker in pool.stats()["workers"]]
+    with ThreadPoolExecutor(4) as executor:
+        list(executor.map(lambda _: pool.generate("the lazy dog", 48, 0.0, 1.0, []), range(4)))
+    stats = pool.stats()["workers"]
+    assert all(worker["completed"] > before for worker, before in zip(stats, completed))
+    assert all(worker["in_flight"] == 0 and worker["outstanding_tokens"] == 0 for worker in stats)
+
+@needs_model
+def test_errors_in_the_worker_are_raised(pool):
+    with pytest.raises(RuntimeError, match="exceed context window"):
+        pool.generate(list(range(5, 2000)), 4, 0.0, 1.0, [])
+
+@needs_model
+def test_a_dead_worker_is_routed_around(pool):
+    victim = pool.workers[0]
+    victim.process.kill()
+    deadline = time.monotonic() + 10
+    while victim.alive and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert not victim.alive and pool.ready
+    assert pool.generate("hello world", 4, 0.0, 1.0, [])["completion_tokens"] > 0